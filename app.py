@@ -4,7 +4,8 @@ from load_data import load_config
 from layout import layout
 from tabs.tab1_callbacks import register_callbacks as tab1_callbacks
 from tabs.tab2_callbacks import register_callbacks as tab2_callbacks
-from flask import Flask
+from flask import Flask, jsonify
+import tools.cache as cache
 
 server = Flask(__name__)
 
@@ -12,6 +13,18 @@ external_stylesheets = [dbc.themes.FLATLY, 'https://codepen.io/chriddyp/pen/bWLw
 app = dash.Dash(__name__, external_stylesheets=external_stylesheets,server=server, prevent_initial_callbacks=True)
 app.title = 'triqs_spectrometer'
 
+# every gunicorn worker keeps its stats file current, see cache.write_stats
+@server.after_request
+def write_cache_stats(response):
+    cache.write_stats('web')
+    return response
+
+# hit/miss counters of the server-side caches and memory use of all worker and pool processes
+@server.route('/stats/cache')
+def cache_stats():
+    cache.write_stats('web', force=True)
+    return jsonify(cache.aggregate_stats(cache.read_stats()))
+
 
 tb_data = {'use': False, 'loaded_hr': False, 'loaded_wout' : False}
 tb_kslice_data = dict(tb_data)
@@ -1,3 +1,6 @@
+import os
+import time
+import tempfile
 import numpy as np
 import base64
 import io
@@ -5,33 +8,52 @@ from h5 import HDFArchive
 
 import tools.wannier90 as tb_w90
 import tools.calc_akw as calc_akw
+import tools.array_store as store
 
 
-def load_config(contents, h5_filename, data):
-    data['config_filename'] = h5_filename
-    content_type, content_string = contents.split(',')
-    h5_bytestream = base64.b64decode(content_string)
-    try:
-        ar = HDFArchive(h5_bytestream)
-    except:
-        print('error in loading file')
-        data['error'] = True
+def spool_upload(contents, suffix=''):
+    """
+    Decode a base64 dcc.Upload content string chunk by chunk into a temporary spool file
+    and return its path, so that only one decoded copy of the file exists at a time
+    """
 
-    if 'tb_data' in ar:
-        data['tb_data'] = ar['tb_data']
-        data['tb_data']['e_mat'] = data['tb_data']['e_mat'].tolist()
+    start = contents.index(',') + 1
+    # chunks must be a multiple of 4 base64 characters
+    chunk = 4 * 2**18
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as fd:
+        for pos in range(start, len(contents), chunk):
+            fd.write(base64.b64decode(contents[pos:pos + chunk]))
+
+    return fd.name
+
+def read_config(path, data):
+    """
+    Read tb_data and sigma_data of a spectrometer.h5 config file into data
+    """
+
+    with HDFArchive(path, 'r') as ar:
+        has_tb, has_sigma = 'tb_data' in ar, 'sigma_data' in ar
+        if has_tb: data['tb_data'] = ar['tb_data']
+        if has_sigma: data['sigma_data'] = ar['sigma_data']
+
+    session = store.session(data)
+    if has_tb:
+        data['tb_data']['e_mat'] = store.save(data['tb_data']['e_mat'], session, 'e_mat')
         data['tb_data']['eps_nuk'] = data['tb_data']['eps_nuk'].tolist()
-        data['tb_data']['hopping'] = {str(key): value.tolist() for key, value in data['tb_data']['hopping'].items()}
+        data['tb_data']['hopping'] = store.save_hopping(data['tb_data']['hopping'], session)
+        if 'e_vecs' in data['tb_data']:
+            e_vecs = data['tb_data'].pop('e_vecs')
+            data['tb_data']['evecs_re'] = store.save(e_vecs.real, session, 'evecs_re')
+            data['tb_data']['evecs_im'] = store.save(e_vecs.imag, session, 'evecs_im')
         
-    if 'sigma_data' in ar:
-        data['sigma_data'] = ar['sigma_data']
-        data['sigma_data']['sigma_re'] =  data['sigma_data']['sigma'].real.tolist()
-        data['sigma_data']['sigma_im'] =  data['sigma_data']['sigma'].imag.tolist()
+    if has_sigma:
+        data['sigma_data']['sigma_re'] = store.save(data['sigma_data']['sigma'].real, session, 'sigma_re')
+        data['sigma_data']['sigma_im'] = store.save(data['sigma_data']['sigma'].imag, session, 'sigma_im')
         del data['sigma_data']['sigma']
         data['sigma_data']['w_dict']['w_mesh'] = data['sigma_data']['w_dict']['w_mesh'].tolist()
         data['sigma_data']['orbital_order'] = tuple(data['sigma_data']['orbital_order'])
 
-    if not 'sigma_data' in ar and not 'tb_data' in ar:
+    if not has_sigma and not has_tb:
         print('error in loading file')
         data['error'] = True
     else:
@@ -39,11 +61,31 @@ def load_config(contents, h5_filename, data):
 
     return data
 
+def load_config(contents, h5_filename, data):
+    start = time.perf_counter()
+    data['config_filename'] = h5_filename
+    path = spool_upload(contents, suffix='.h5')
+    try:
+        data = read_config(path, data)
+    except Exception:
+        print('error in loading file')
+        data['error'] = True
+    finally:
+        os.remove(path)
+
+    data['load_time'] = time.perf_counter() - start
+    print('loaded {} in {:.2f}s'.format(h5_filename, data['load_time']))
+
+    return data
+
 def load_w90_hr(contents):
-    content_type, content_string = contents.split(',')
-    w90_hr_stream = base64.b64decode(content_string).decode('utf-8')
-    hopping, n_wf = tb_w90.parse_hopping_from_wannier90_hr(w90_hr_stream)
-    #print('number of Wannier orbitals {}'.format(num_wann))
+    start = time.perf_counter()
+    path = spool_upload(contents)
+    try:
+        hopping, n_wf = tb_w90.parse_hopping_from_wannier90_hr_file(path)
+    finally:
+        os.remove(path)
+    print('number of Wannier orbitals {}, loaded in {:.2f}s'.format(n_wf, time.perf_counter() - start))
 
     return hopping, n_wf
 
@@ -67,23 +109,27 @@ def load_sigma_h5(contents , filename, orbital_order = None):
         h5['self_energy']['dmft_mu'] = dmft_mu
         h5['self_energy']['orbital_order'] = (0,1,2)
     '''
+    start = time.perf_counter()
     data = {'config_filename': filename}
 
-    content_type, content_string = contents.split(',')
-    h5_bytestream = base64.b64decode(content_string)
-    ar = HDFArchive(h5_bytestream)
-
-    # extract from h5
-    Sigma = ar['self_energy']['Sigma']
-    orbital_order = ar['self_energy']['orbital_order']
-    n_orb = ar['self_energy']['n_orb']
-    dc = ar['self_energy']['dc']
-    dmft_mu = ar['self_energy']['dmft_mu']
-    w_mesh = ar['self_energy']['w_mesh']
+    path = spool_upload(contents, suffix='.h5')
+    try:
+        with HDFArchive(path, 'r') as ar:
+            # extract from h5, the group is only readable while the archive is open
+            self_energy = ar['self_energy']
+            Sigma = self_energy['Sigma']
+            orbital_order = self_energy['orbital_order']
+            n_orb = self_energy['n_orb']
+            dc = self_energy['dc']
+            dmft_mu = self_energy['dmft_mu']
+            w_mesh = self_energy['w_mesh']
+            n_w = self_energy['n_w']
+    finally:
+        os.remove(path)
 
     # setup w_dict
-    w_dict = {'w_mesh' : w_mesh, 
-              'n_w' : ar['self_energy']['n_w'], 
+    w_dict = {'w_mesh' : w_mesh,
+              'n_w' : n_w,
               'window' : [w_mesh[0],w_mesh[-1]]}
     # TODO able to choose these
     spin = 'up'
@@ -92,13 +138,15 @@ def load_sigma_h5(contents , filename, orbital_order = None):
     # convert orbital order to list:
     sigma_interpolated = calc_akw.sigma_from_dmft(n_orb, orbital_order, Sigma, spin, block, dc, w_dict)
 
-    data['sigma_re'] = sigma_interpolated.real.tolist()
-    data['sigma_im'] = sigma_interpolated.imag.tolist()
+    session = store.session(data)
+    data['sigma_re'] = store.save(sigma_interpolated.real, session, 'sigma_re')
+    data['sigma_im'] = store.save(sigma_interpolated.imag, session, 'sigma_im')
     data['w_dict'] = w_dict
     data['dmft_mu'] = dmft_mu
     data['orbital_order'] = orbital_order
     data['n_orb'] = n_orb
-    print(sigma_interpolated.shape)
+    data['load_time'] = time.perf_counter() - start
+    print('loaded sigma {} in {:.2f}s'.format(sigma_interpolated.shape, data['load_time']))
 
     return data
 
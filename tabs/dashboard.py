@@ -126,6 +126,18 @@ def make_dashboard(tb_data, tb_kslice_data, akw_data, ak0_data, sigma_data, load
                                       type='number', debounce=True, style= {'width' : '60%'}),
                         ], style={'padding': '5px 5px'}
                         ),
+                        *([html.Div([
+                            html.P('kz:',style={'width' : '40%','display': 'inline-block', 'text-align': 'left', 'vertical-align': 'center'}
+                                ),
+                            dcc.Input(id=id('kz-values'), value='0', placeholder='kz, or comma-separated list of kz',
+                                      type='text', debounce=True, style= {'width' : '60%'}),
+                            dbc.Tooltip('one kz, or a comma-separated list of kz (units of Z) computed as one stack',
+                                        target=id('kz-values'),
+                                        style={'maxWidth': 300, 'width': 300, 'font-size': 14}),
+                            dbc.Alert('kz must be a number or a comma-separated list of numbers', id=id('kz-alert'),
+                                      dismissable=True, color='warning', fade=True, is_open=False),
+                        ], style={'padding': '5px 5px'}
+                        )] if tab_number == 2 else []),
                         html.Button('calc TB bands', id=id('calc-tb'), n_clicks=0, style= button_style ),
                     ], style={'backgroundColor': col_part,
                                'borderRadius': '15px',
@@ -204,6 +216,8 @@ def make_dashboard(tb_data, tb_kslice_data, akw_data, ak0_data, sigma_data, load
                         ],id=id('band-basis-tooltip'), style={'padding': '5px 5px'}
                         ),
                         html.Button('Calculate A(k,w)', id=id('calc-akw'), n_clicks=0, style= button_style),
+                        html.Div(id=id('job-progress'), style={'padding': '5px 5px'}),
+                        dcc.Interval(id=id('job-poll'), interval=500, disabled=True),
                     ], style={'backgroundColor': col_part,
                                'borderRadius': '15px',
                                'padding': '10px'}
@@ -241,6 +255,32 @@ def make_dashboard(tb_data, tb_kslice_data, akw_data, ak0_data, sigma_data, load
                             inputStyle={"margin-right": "5px"},
                             labelStyle={'display': 'inline-block', 'margin-left':'5px'}
                         ),
+                        *([html.Div([
+                            html.Div('A(k,ω) transport:'),
+                            dcc.RadioItems(
+                                id=id('akw-transport'),
+                                options=[{'label': i, 'value': i} for i in ['heatmap', 'image']],
+                                value='image',
+                                inputStyle={"margin-right": "5px"},
+                                labelStyle={'display': 'inline-block', 'margin-left':'5px'}
+                            ),
+                            dbc.Tooltip('heatmap: full-precision values with hover info; image: compressed 8-bit PNG layer',
+                                        target=id('akw-transport'),
+                                        style={'maxWidth': 300, 'width': 300, 'font-size': 14}),
+                        ])] if tab_number == 1 else []),
+                        *([html.Div([
+                            html.Div('Fermi surface:'),
+                            dcc.RadioItems(
+                                id=id('fs-mode'),
+                                options=[{'label': i, 'value': i} for i in ['2D slice', '3D']],
+                                value='2D slice',
+                                inputStyle={"margin-right": "5px"},
+                                labelStyle={'display': 'inline-block', 'margin-left':'5px'}
+                            ),
+                            dbc.Tooltip('2D slice: contours and A(k,0) in the k-plane; 3D: TB Fermi isosurfaces over the whole BZ on a #k-points³ grid',
+                                        target=id('fs-mode'),
+                                        style={'maxWidth': 300, 'width': 300, 'font-size': 14}),
+                        ])] if tab_number == 2 else []),
                         html.Div('Colorscale:'),
                         dcc.RadioItems(
                             id=id('colorscale-mode'),
@@ -20,6 +20,11 @@ import tools.calc_tb as tb
 import tools.calc_akw as akw
 import tools.gf_helpers as gf
 import tools.tools as tools
+import tools.array_store as store
+import tools.jobs as jobs
+import tools.viewport as viewport
+import tools.pyramid as pyramid
+from tools.transport import image_source
 from tabs.id_factory import id_factory
 
 
@@ -51,7 +56,9 @@ def register_callbacks(app):
     @app.callback(
         [Output(id('akw-data'), 'data'),
          Output(id('akw-bands'), 'on'),
-         Output(id('tb-alert'), 'is_open')],
+         Output(id('tb-alert'), 'is_open'),
+         Output(id('job-poll'), 'disabled'),
+         Output(id('job-progress'), 'children')],
         [Input(id('akw-data'), 'data'),
          Input(id('tb-data'), 'data'),
          Input(id('sigma-data'), 'data'),
@@ -63,35 +70,63 @@ def register_callbacks(app):
          Input(id('calc-akw'), 'n_clicks'),
          Input(id('akw-mode'), 'value'),
          Input(id('eta'), 'value'),
-         Input(id('band-basis'), 'on')],
+         Input(id('band-basis'), 'on'),
+         Input(id('job-poll'), 'n_intervals')],
          State(id('tb-alert'), 'is_open'),
          prevent_initial_call=True
         )
-    def update_akw(akw_data, tb_data, sigma_data, akw_switch, dft_mu, k_points, n_k, click_tb, click_akw, akw_mode, eta, band_basis, tb_alert):
+    def update_akw(akw_data, tb_data, sigma_data, akw_switch, dft_mu, k_points, n_k, click_tb, click_akw, akw_mode, eta, band_basis, n_poll, tb_alert):
         ctx = dash.callback_context
         trigger_id = ctx.triggered[0]["prop_id"].split(".")[0]
         print('{:20s}'.format('***update_akw***:'), trigger_id)
 
         if trigger_id == id('dft-mu') and not sigma_data['use']:
-            return akw_data, akw_switch, tb_alert
+            return akw_data, akw_switch, tb_alert, dash.no_update, dash.no_update
 
-        elif trigger_id in (id('calc-akw'), id('n-k'), id('akw-mode')) or ( trigger_id == id('k-points') and click_akw > 0 ):
+        elif trigger_id in (id('calc-akw'), id('n-k'), id('akw-mode')) or ( trigger_id == id('k-points') and click_akw > 0 ) \
+             or ( trigger_id in (id('eta'), id('dft-mu')) and akw_data.get('use', False) ):
+            # a new eta or mu only recomputes the invalidated stages of tools.pipeline
+            if eta in ('', None):
+                return akw_data, akw_switch, tb_alert, dash.no_update, dash.no_update
             if not sigma_data['use'] or not tb_data['use']:
-                return akw_data, akw_switch, not tb_alert
+                return akw_data, akw_switch, not tb_alert, dash.no_update, dash.no_update
 
             solve = True if akw_mode == 'QP dispersion' else False
             if not 'dmft_mu' in akw_data.keys():
                  akw_data['dmft_mu'] = float(tb_data['dft_mu']) - sigma_data['dmft_mu']
                  print(akw_data['dmft_mu'])
             akw_data['eta'] = float(eta)
-            alatt, akw_data['dmft_mu'] = akw.calc_alatt(tb_data, sigma_data, akw_data, solve, band_basis)
-            akw_data['Akw'] = alatt.tolist()
+            # run in the process pool, a previous job of this session is cancelled
+            owner = 'akw-' + store.session(akw_data)
+            akw_data['job'] = jobs.submit_akw(owner, tb_data, sigma_data, akw_data, solve, band_basis)
+            akw_data['job_solve'] = solve
+
+            return akw_data, akw_switch, tb_alert, False, 'A(k,ω): submitted'
+
+        elif trigger_id == id('job-poll') and 'job' in akw_data:
+            job_status = jobs.status(akw_data['job'])
+            if job_status['state'] == 'running':
+                return dash.no_update, dash.no_update, dash.no_update, False, 'A(k,ω): {:.0f}%'.format(100 * job_status['progress'])
+            if job_status['state'] != 'done':
+                return dash.no_update, dash.no_update, dash.no_update, True, 'A(k,ω): {}'.format(job_status['state'])
+
+            (alatt,), info = jobs.result(akw_data.pop('job'))
+            akw_data['dmft_mu'] = info['dmft_mu']
+            if 'akw_path' in info and not akw_data['job_solve']:
+                akw_data['akw_path'] = info['akw_path']
+            akw_data['Akw'] = store.save(alatt, store.session(akw_data), 'Akw')
+            if not akw_data['job_solve']:
+                akw_data['Akw_pyramid'] = pyramid.build(alatt, store.session(akw_data), 'Akw')
             akw_data['use'] = True
-            akw_data['solve'] = solve
-
+            akw_data['solve'] = akw_data.pop('job_solve')
+            akw_data['recomputed'] = info['recomputed']
             akw_switch = {'on': True}
+            recomputed = ', '.join(akw_data['recomputed']) if akw_data['recomputed'] else 'none'
+            print('A(k,w) recomputed stages: {}'.format(recomputed))
+
+            return akw_data, akw_switch, tb_alert, True, 'A(k,ω): done in {:.1f}s, recomputed: {}'.format(job_status['time'], recomputed)
 
-        return akw_data, akw_switch, tb_alert 
+        return akw_data, akw_switch, tb_alert, dash.no_update, dash.no_update
 
     # dashboard calculate TB
     @app.callback(
@@ -137,9 +172,8 @@ def register_callbacks(app):
         if trigger_id == id('upload-w90-hr'):
             print('loading w90 hr file...')
             hopping, n_wf = load_w90_hr(w90_hr)
-            hopping = {str(key): value.real.tolist() for key, value in hopping.items()}
             tb_data['n_wf'] = n_wf
-            tb_data['hopping'] = hopping
+            tb_data['hopping'] = store.save_hopping({key: value.real for key, value in hopping.items()}, store.session(tb_data))
             tb_data['loaded_hr'] = True
             orb_options = [{'label': str(k), 'value': str(k)} for i, k in enumerate(list(permutations([i for i in range(tb_data['n_wf'])])))]
 
@@ -168,7 +202,8 @@ def register_callbacks(app):
                 return tb_data, w90_hr_button, w90_wout_button, tb_switch, dft_mu, n_elect, orb_options, band_basis
 
             add_local = [0.] * tb_data['n_wf']
-            tb_data['dft_mu'] = akw.calc_mu(tb_data, float(n_elect), add_spin, add_local, mu_guess=float(dft_mu), eta=float(eta))
+            tb_data['dft_mu'], tb_data['mu_info'] = akw.calc_mu_adaptive(tb_data, float(n_elect), add_spin, add_local,
+                                                                         mu_guess=float(dft_mu), eta=float(eta))
 
             return tb_data, w90_hr_button, w90_wout_button, tb_switch, '{:.4f}'.format(tb_data['dft_mu']), n_elect, orb_options, band_basis
 
@@ -184,16 +219,14 @@ def register_callbacks(app):
             add_local = [0.] * tb_data['n_wf']
 
             k_mesh = {'n_k': int(n_k), 'k_path': k_points, 'kz': 0.0}
-            tb_data['k_mesh'], e_mat, e_vecs, tbl = tb.calc_tb_bands(tb_data, add_spin, float(dft_mu), add_local, k_mesh, fermi_slice=False, band_basis=band_basis)
+            tb_data['k_mesh'], e_mat, e_vecs, eps_nuk, evec_nuk = tb.calc_tb_path(tb_data, add_spin, float(dft_mu), add_local, k_mesh, band_basis=band_basis)
             # calculate Hamiltonian
-            tb_data['e_mat'] = e_mat.real.tolist()
+            session = store.session(tb_data)
+            tb_data['e_mat'] = store.save(e_mat.real, session, 'e_mat')
             if band_basis:
-                tb_data['evecs_re'] = e_vecs.real.tolist()
-                tb_data['evecs_im'] = e_vecs.imag.tolist()
-                tb_data['eps_nuk'] = np.einsum('iij -> ij', e_mat).real.tolist()
-            else:
-                tb_data['eps_nuk'], evec_nuk = tb.get_tb_bands(e_mat)
-                tb_data['eps_nuk'] = tb_data['eps_nuk'].tolist()
+                tb_data['evecs_re'] = store.save(e_vecs.real, session, 'evecs_re')
+                tb_data['evecs_im'] = store.save(e_vecs.imag, session, 'evecs_im')
+            tb_data['eps_nuk'] = eps_nuk.tolist()
             tb_data['bnd_low'] = np.min(np.array(tb_data['eps_nuk'][0])).real
             tb_data['bnd_high'] = np.max(np.array(tb_data['eps_nuk'][-1])).real
             tb_data['dft_mu'] = dft_mu
@@ -335,8 +368,6 @@ def register_callbacks(app):
                     tree = ast.parse(to_parse, mode='exec')
                     code = compile(tree, filename='test', mode='exec')
                     exec(code, namespace)
-                # curry
-                c_sigma = tools.curry(namespace['sigma'])
                 # get lambdas from dashboard if trigger, else default values
                 lambda_values = sigma_lambdas if '"type":"sigma-lambdas"' in trigger_id else [1, 1]
                 lambda_tuples = [key for key in zip(inspect.getfullargspec(namespace['sigma'])[0][1:], lambda_values)]
@@ -349,13 +380,13 @@ def register_callbacks(app):
                 w_min = -5
                 w_max = 5
                 n_w = 501
-                soc = False
 
-                w_mesh = MeshReFreq(omega_min=w_min, omega_max=w_max, n_max=n_w)
+                w_mesh = np.linspace(w_min, w_max, n_w)
                 w_dict = {'w_mesh' : w_mesh, 'n_w' : n_w, 'window' : [w_min, w_max]}
 
-                sigma_analytic = gf.sigma_analytic_to_gf(c_sigma, n_orb, w_dict, soc, lambda_values)
-                sigma_data.update(gf.sigma_analytic_to_data(sigma_analytic, w_dict, n_orb))
+                # one call of the user function on the whole mesh
+                sigma_analytic = gf.sigma_analytic(namespace['sigma'], n_orb, w_mesh, lambda_values)
+                sigma_data.update(gf.sigma_analytic_to_data(sigma_analytic, w_dict, n_orb, store.session(sigma_data)))
 
                 return_f_sigma = 'You have entered: \n{}'.format(f_sigma)
 
@@ -382,9 +413,11 @@ def register_callbacks(app):
          Input(id('colorscale'), 'value'),
          Input(id('tb-data'), 'data'),
          Input(id('akw-data'), 'data'),
-         Input(id('sigma-data'), 'data')],
+         Input(id('sigma-data'), 'data'),
+         Input(id('akw-transport'), 'value'),
+         Input(id('akw-view'), 'data')],
          prevent_initial_call=True)
-    def plot_Akw(tb_switch, akw_switch, colorscale, tb_data, akw_data, sigma_data):
+    def plot_Akw(tb_switch, akw_switch, colorscale, tb_data, akw_data, sigma_data, transport, view):
         
         ctx = dash.callback_context
         trigger_id = ctx.triggered[0]["prop_id"].split(".")[0]
@@ -426,29 +459,142 @@ def register_callbacks(app):
 
         if akw_switch:
             w_mesh = sigma_data['w_dict']['w_mesh']
+            # zoomed range of the view, or the full k-path and w mesh (always for QP dispersions)
+            k_range, w_range = (view['k'], view['w']) if 'k' in view and not akw_data['solve'] else ([k_mesh['k_disc'][0], k_mesh['k_disc'][-1]], [w_mesh[0], w_mesh[-1]])
             if akw_data['solve']:
-                z_data = np.array(akw_data['Akw'])
+                z_data = store.load(akw_data['Akw'])
                 for orb in range(z_data.shape[1]):
                     #fig.add_trace(go.Contour(x=k_mesh['k_disc'], y=w_mesh, z=z_data[:,:,orb].T,
                     #    colorscale=colorscale, contours=dict(start=0.1, end=1.5, coloring='lines'), ncontours=1, contours_coloring='lines'))
                     fig.add_trace(go.Scattergl(x=k_mesh['k_disc'], y=z_data[:,orb].T, showlegend=False, mode='markers',
                                                marker_color=px.colors.sequential.Viridis[0]))
             else:
-                z_data = np.log(np.array(akw_data['Akw']).T)
-                fig.add_trace(go.Heatmap(x=k_mesh['k_disc'], y=w_mesh, z=z_data,
-                                         colorscale=colorscale, reversescale=False, showscale=False,
-                                         zmin=np.min(z_data), zmax=np.max(z_data)))
+                # overview at the level of the pyramid matching the zoom, on the color range of the full map
+                pyr = akw_data['Akw_pyramid']
+                _, rows, cols, alatt = pyramid.fetch(pyr, [pyramid.axis_index(k_mesh['k_disc'], k_range), pyramid.axis_index(w_mesh, w_range)],
+                                                     viewport.figure_px)
+                k_disc, w_disc = pyramid.axis_values(k_mesh['k_disc'], rows), pyramid.axis_values(w_mesh, cols)
+                # float16 levels flush A below its smallest positive value to zero
+                tiny = float(np.finfo(np.float16).tiny)
+                z_data = np.log(np.maximum(alatt.T, tiny))
+                zmin, zmax = np.log(max(pyr['min'], tiny)), np.log(pyr['max'])
+                if transport == 'image':
+                    # quantized PNG layer instead of nested lists
+                    fig.add_layout_image(source=image_source(z_data, k_disc, colorscale, zmin, zmax), xref='x', yref='y',
+                                         x=k_disc[0], y=w_disc[-1], sizex=k_disc[-1] - k_disc[0],
+                                         sizey=w_disc[-1] - w_disc[0], sizing='stretch', layer='below')
+                else:
+                    fig.add_trace(go.Heatmap(x=k_disc, y=w_disc, z=z_data,
+                                             colorscale=colorscale, reversescale=False, showscale=False,
+                                             zmin=zmin, zmax=zmax))
+
+                # tiles of the zoomed range on top of the overview
+                tiles = viewport.render(tb_data, sigma_data, akw_data, view) if 'shown' in view else None
+                if tiles is not None:
+                    k_view, w_view, alatt_view = tiles
+                    z_view = np.log(alatt_view.T)
+                    if transport == 'image':
+                        dk, dw = k_view[1] - k_view[0], w_view[1] - w_view[0]
+                        fig.add_layout_image(source=image_source(z_view, k_view, colorscale, zmin, zmax),
+                                             xref='x', yref='y', x=k_view[0] - dk/2, y=w_view[-1] + dw/2,
+                                             sizex=k_view[-1] - k_view[0] + dk, sizey=w_view[-1] - w_view[0] + dw,
+                                             sizing='stretch', layer='below')
+                    else:
+                        fig.add_trace(go.Heatmap(x=k_view, y=w_view, z=z_view, colorscale=colorscale, reversescale=False,
+                                                 showscale=False, zmin=zmin, zmax=zmax))
 
             fig.update_layout(margin={'l': 40, 'b': 40, 't': 10, 'r': 40},
                               clickmode='event+select',
                               hovermode='closest',
-                              yaxis_range=[w_mesh[0], w_mesh[-1]],
+                              yaxis_range=w_range,
                               yaxis_title='ω (eV)',
-                              xaxis_range=[k_mesh['k_disc'][0], k_mesh['k_disc'][-1]],
+                              xaxis_range=k_range,
                               xaxis=dict(ticktext=['γ' if k == 'g' else k for k in k_mesh['k_point_labels']], tickvals=k_mesh['k_points']),
                               font=dict(size=16))
     
         return fig
+
+    def submit_tiles(view, tb_data, sigma_data, akw_data):
+        # missing tiles of the view are evaluated in the process pool, the job is polled by view-refine
+        if 'level' not in view:
+            return view
+        view['data_key'] = viewport.data_key(tb_data, sigma_data, akw_data)
+        indices = viewport.missing_tiles(tb_data, sigma_data, akw_data, view)
+        if indices:
+            view['job'] = jobs.submit_tiles('tiles-' + store.session(akw_data), tb_data, sigma_data, akw_data, view['level'], indices)
+        else:
+            view['shown'] = view['level']
+        return view
+
+    # zoomed range of the A(k,w) figure, refined from coarse to fine tiles
+    @app.callback(
+        [Output(id('akw-view'), 'data'),
+         Output(id('view-refine'), 'disabled')],
+        [Input(id('Akw'), 'relayoutData'),
+         Input(id('view-refine'), 'n_intervals'),
+         Input(id('tb-data'), 'data'),
+         Input(id('akw-data'), 'data')],
+        [State(id('akw-view'), 'data'),
+         State(id('sigma-data'), 'data')],
+         prevent_initial_call=True)
+    def update_view(relayout, n_refine, tb_data, akw_data, view, sigma_data):
+        ctx = dash.callback_context
+        trigger_id = ctx.triggered[0]["prop_id"].split(".")[0]
+
+        # a new k-path starts from the full range, a new eta or mu keeps the zoom
+        if trigger_id == id('tb-data'):
+            if view.get('path') == viewport.path_key(tb_data):
+                return dash.no_update, dash.no_update
+            return viewport.full_view(tb_data), True
+
+        # tiles of a new A(k,w) replace those of the previous one
+        if trigger_id == id('akw-data'):
+            if 'level' not in view or not akw_data['use'] or akw_data['solve'] \
+               or view.get('data_key') == viewport.data_key(tb_data, sigma_data, akw_data):
+                return dash.no_update, dash.no_update
+            view = dict(view)
+            view.pop('shown', None)
+            view = submit_tiles(view, tb_data, sigma_data, akw_data)
+            return view, viewport.is_refined(view)
+
+        if trigger_id == id('view-refine'):
+            if 'job' in view:
+                job_status = jobs.status(view['job'])
+                if job_status['state'] == 'running':
+                    return dash.no_update, False
+                view = dict(view)
+                job = view.pop('job')
+                if job_status['state'] == 'done':
+                    (tiles,), info = jobs.result(job)
+                    viewport.store_tiles(view['data_key'], info['level'], info['indices'], tiles)
+                    view['shown'] = view['level']
+                return view, viewport.is_refined(view)
+            if viewport.is_refined(view):
+                return dash.no_update, True
+            view = submit_tiles(viewport.refine(view), tb_data, sigma_data, akw_data)
+            return view, viewport.is_refined(view)
+
+        if not akw_data['use'] or akw_data['solve'] or not relayout:
+            return dash.no_update, dash.no_update
+        if 'xaxis.autorange' in relayout or 'yaxis.autorange' in relayout:
+            return viewport.full_view(tb_data), True
+
+        ranges = []
+        for axis, name in zip(('xaxis', 'yaxis'), ('k', 'w')):
+            if axis + '.range[0]' in relayout:
+                ranges.append([relayout[axis + '.range[0]'], relayout[axis + '.range[1]']])
+            elif axis + '.range' in relayout:
+                ranges.append(list(relayout[axis + '.range']))
+            else:
+                # an axis that is not part of the event keeps its range
+                ranges.append(view.get(name))
+        if ranges == [view.get('k'), view.get('w')]:
+            return dash.no_update, dash.no_update
+
+        view = submit_tiles(viewport.make_view(*ranges, tb_data, sigma_data), tb_data, sigma_data, akw_data)
+        print('{:20s}'.format('***update_view***:'), view)
+
+        return view, viewport.is_refined(view)
     
     # plot EDC 
     @app.callback(
@@ -505,7 +651,8 @@ def register_callbacks(app):
                 new_kpt = click_coordinates['points'][0]['x']
                 kpt_edc = np.argmin(np.abs(np.array(k_mesh['k_disc']) - new_kpt))
             
-            fig.add_trace(go.Scattergl(x=w_mesh, y=np.array(akw_data['Akw'])[kpt_edc,:], mode='lines',
+            Akw = store.load(akw_data['Akw'])
+            fig.add_trace(go.Scattergl(x=w_mesh, y=Akw[kpt_edc,:], mode='lines',
                 line=go.scattergl.Line(color='#AB63FA'), showlegend=False,
                                        hoverinfo='x+y+text'
                                     ))
@@ -513,7 +660,7 @@ def register_callbacks(app):
             fig.update_layout(margin={'l': 40, 'b': 40, 't': 10, 'r': 40},
                                 hovermode='closest',
                                 xaxis_range=[w_mesh[0], w_mesh[-1]],
-                                yaxis_range=[0, 1.01 * np.max(np.array(akw_data['Akw']))],
+                                yaxis_range=[0, 1.01 * np.max(Akw)],
                                 xaxis_title='ω (eV)',
                                 yaxis_title='A(ω)',
                                 font=dict(size=16),
@@ -588,14 +735,15 @@ def register_callbacks(app):
                 new_w = click_coordinates['points'][0]['y']
                 w_mdc = np.argmin(np.abs(np.array(w_mesh) - new_w))
         
-            fig.add_trace(go.Scattergl(x=k_mesh['k_disc'], y=np.array(akw_data['Akw'])[:, w_mdc], mode='lines', line=go.scattergl.Line(color='#AB63FA'),
+            Akw = store.load(akw_data['Akw'])
+            fig.add_trace(go.Scattergl(x=k_mesh['k_disc'], y=Akw[:, w_mdc], mode='lines', line=go.scattergl.Line(color='#AB63FA'),
                                        showlegend=True, name='ω = {:.3f} eV'.format(w_mesh[w_mdc]), hoverinfo='x+y+text'))
         
             fig.update_layout(margin={'l': 40, 'b': 40, 't': 10, 'r': 40},
                               hovermode='closest',
                               xaxis_range=[k_mesh['k_disc'][0], k_mesh['k_disc'][-1]],
                         #     yaxis_range=[0, 1.05 * np.max(np.array(akw_data['Akw'])[:, w_mdc])],
-                              yaxis_range=[0, 1.01 * np.max(np.array(akw_data['Akw']))],
+                              yaxis_range=[0, 1.01 * np.max(Akw)],
                               xaxis_title='k',
                               yaxis_title='A(k)',
                               font=dict(size=16),
@@ -626,17 +774,17 @@ def register_callbacks(app):
 
             # store everything as np arrays not as list to enable compression in h5 write!
             tb_data_store = tb_data.copy()
-            tb_data_store['e_mat'] = np.array(tb_data['e_mat'])
+            tb_data_store['e_mat'] = np.array(store.load(tb_data['e_mat']))
             if band_basis:
-                tb_data_store['e_vecs'] = np.array(tb_data['evecs_re']) + 1j * np.array(tb_data['evecs_im'])
+                tb_data_store['e_vecs'] = store.load_complex(tb_data['evecs_re'], tb_data['evecs_im'])
                 del tb_data_store['evecs_re']
                 del tb_data_store['evecs_im']
             tb_data_store['eps_nuk'] = np.array(tb_data['eps_nuk'])
-            tb_data_store['hopping'] = {str(key): np.array(value) for key, value in tb_data_store['hopping'].items()}
+            tb_data_store['hopping'] = {str(key): value for key, value in store.load_hopping(tb_data_store['hopping']).items()}
             return_data['tb_data'] = tb_data_store
 
             sigma_data_store = sigma_data.copy()
-            sigma_data_store['sigma'] = np.array(sigma_data['sigma_re']) + 1j * np.array(sigma_data['sigma_im'])
+            sigma_data_store['sigma'] = store.load_complex(sigma_data['sigma_re'], sigma_data['sigma_im'])
             del sigma_data_store['sigma_re']
             del sigma_data_store['sigma_im']
             sigma_data_store['w_dict']['w_mesh'] = np.array(sigma_data['w_dict']['w_mesh'])
@@ -22,7 +22,10 @@ def layout(tb_data, tb_kslice_data, akw_data, ak0_data, sigma_data, loaded_data)
                     id=id('Akw'),
                     style={'height': '84vh'},
                     clickData={'points': []}
-                )
+                ),
+                # zoomed range of the figure and its progressive refinement
+                dcc.Store(id=id('akw-view'), data={}),
+                dcc.Interval(id=id('view-refine'), interval=300, disabled=True)
             ], style={
                 'display': 'inline-block',
                 'width': '41%',
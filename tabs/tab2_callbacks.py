@@ -18,9 +18,24 @@ from triqs.gf import MeshReFreq
 from load_data import load_config, load_w90_hr, load_w90_wout, load_sigma_h5
 import tools.calc_tb as tb
 import tools.calc_akw as akw
+import tools.array_store as store
+import tools.jobs as jobs
+import tools.pyramid as pyramid
 from tabs.id_factory import id_factory
 
 
+def parse_kz(kz_values):
+    """
+    kz of the free-text input, a number or a comma-separated list of numbers, [0.] if empty
+    and None if not valid
+    """
+
+    try:
+        kz = [float(value) for value in str(kz_values).split(',') if value.strip()] or [0.]
+    except ValueError:
+        return None
+    return kz if np.all(np.isfinite(kz)) else None
+
 def register_callbacks(app):
     id = id_factory('tab2')
     id_tap = id_factory('tab1')
@@ -28,7 +43,8 @@ def register_callbacks(app):
     # dashboard calculate TB
     @app.callback(
         [Output(id('tb-kslice-data'), 'data'),
-         Output(id('tb-bands'), 'on')],
+         Output(id('tb-bands'), 'on'),
+         Output(id('kz-alert'), 'is_open')],
         [Input(id('tb-bands'), 'on'),
          Input(id('calc-tb'), 'n_clicks'),
          Input(id('add-spin'), 'value'),
@@ -37,8 +53,10 @@ def register_callbacks(app):
          Input(id('k-points'), 'data'),
          Input(id('tb-kslice-data'), 'data'),
          Input(id_tap('tb-data'), 'data')],
+         State(id('fs-mode'), 'value'),
+         State(id('kz-values'), 'value'),
          prevent_initial_call=True,)
-    def calc_tb(tb_switch, click_tb, add_spin, dft_mu, n_k, k_points, tb_kslice_data, tb_data):
+    def calc_tb(tb_switch, click_tb, add_spin, dft_mu, n_k, k_points, tb_kslice_data, tb_data, fs_mode, kz_values):
         ctx = dash.callback_context
         trigger_id = ctx.triggered[0]["prop_id"].split(".")[0]
         print('{:20s}'.format('***calc_tb***:'), trigger_id)
@@ -47,30 +65,51 @@ def register_callbacks(app):
         ## if not used before, copy data from tb_data
         #if tb_kslice_data['use'] != tb_data['use']:
 
+            # one kz gives a single slice, several kz a stack of slices computed in one pass
+            kz = parse_kz(kz_values)
+            if kz is None:
+                return dash.no_update, dash.no_update, True
+
+            # everything but the k-path data of tb_data
             for key in tb_data.keys():
                 if key not in ['k_mesh', 'k_disc', 'e_mat', 'eps_nuk', 'evecs_re', 'evecs_im', 'bnd_low', 'bnd_high']:
                     tb_kslice_data[key] = tb_data[key]
 
-            kz = 0.
-            k_mesh = {'n_k': int(n_k), 'k_path': k_points, 'kz': kz}
+            tb_kslice_data['kz'] = kz
+            k_mesh = {'n_k': int(n_k), 'k_path': k_points, 'kz': kz if len(kz) > 1 else kz[0]}
             k_mesh['Z'] = np.array([+0.25, +0.25, -0.25])
             add_local = [0.] * tb_kslice_data['n_wf']
 
             tb_kslice_data['k_mesh'], e_mat, e_vecs, tbl = tb.calc_tb_bands(tb_kslice_data, add_spin, float(dft_mu), add_local, k_mesh, fermi_slice=True)
             # calculate Hamiltonian
-            tb_kslice_data['e_mat'] = e_mat.real.tolist()
-            tb_kslice_data['eps_nuk'], evec_nuk = tb.get_tb_kslice(tbl, k_mesh, dft_mu)
+            tb_kslice_data['e_mat'] = store.save(e_mat.real, store.session(tb_kslice_data), 'e_mat')
+            # Fermi-surface contours as flat vertex arrays with offsets, the orbital character is not plotted
+            fs = tb.get_tb_kslice(tbl, k_mesh, dft_mu)
+            session = store.session(tb_kslice_data)
+            tb_kslice_data['fs_contours'] = {key: store.save(value, session, 'fs_' + key) for key, value in fs.items() if key != 'char'}
+            if fs_mode == '3D':
+                # decimate the isosurfaces of fine grids
+                k_mesh['step_size'] = max(1, int(n_k) // 50)
+                fs3d = tb.get_tb_fs3d(tbl, k_mesh)
+                tb_kslice_data['fs3d'] = {'verts': store.save(fs3d['verts'].astype(np.float32), session, 'fs3d_verts'),
+                                          'faces': store.save(fs3d['faces'].astype(np.int32), session, 'fs3d_faces'),
+                                          'vert_offsets': fs3d['vert_offsets'].tolist(), 'face_offsets': fs3d['face_offsets'].tolist(),
+                                          'band': fs3d['band'].tolist()}
+            else:
+                tb_kslice_data.pop('fs3d', None)
             tb_kslice_data['use'] = True
 
             tb_switch = {'on': True}
 
-        return tb_kslice_data, tb_switch
+        return tb_kslice_data, tb_switch, False
 
     # upload akw data
     @app.callback(
         [Output(id('ak0-data'), 'data'),
          Output(id('akw-bands'), 'on'),
-         Output(id('tb-alert'), 'is_open')],
+         Output(id('tb-alert'), 'is_open'),
+         Output(id('job-poll'), 'disabled'),
+         Output(id('job-progress'), 'children')],
         [Input(id('ak0-data'), 'data'),
          Input(id('tb-kslice-data'), 'data'),
          Input(id_tap('sigma-data'), 'data'),
@@ -82,33 +121,67 @@ def register_callbacks(app):
          Input(id('calc-akw'), 'n_clicks'),
          Input(id('calc-tb'), 'n_clicks'),
          Input(id('akw-mode'), 'value'),
-         Input(id('band-basis'), 'on')],
+         Input(id('band-basis'), 'on'),
+         Input(id('job-poll'), 'n_intervals')],
          State(id('tb-alert'), 'is_open'),
          prevent_initial_call=True
         )
-    def update_ak0(ak0_data, tb_kslice_data, sigma_data, akw_data, akw_switch, dft_mu, k_points, n_k, click_tb, click_akw, akw_mode, band_basis, tb_alert):
+    def update_ak0(ak0_data, tb_kslice_data, sigma_data, akw_data, akw_switch, dft_mu, k_points, n_k, click_tb, click_akw, akw_mode, band_basis, n_poll, tb_alert):
         ctx = dash.callback_context
         trigger_id = ctx.triggered[0]["prop_id"].split(".")[0]
         print('{:20s}'.format('***update_ak0***:'), trigger_id)
 
         if trigger_id == id('dft-mu') and not sigma_data['use']:
-            return ak0_data, akw_switch, tb_alert
+            return ak0_data, akw_switch, tb_alert, dash.no_update, dash.no_update
 
         elif trigger_id in (id('calc-akw'), id('n-k'), id('akw-mode')) or ( trigger_id == id('k-points') and click_akw > 0 ):
             if not sigma_data['use'] or not tb_kslice_data['use']:
-                return ak0_data, akw_switch, not tb_alert
+                return ak0_data, akw_switch, not tb_alert, dash.no_update, dash.no_update
 
             solve = True if akw_mode == 'QP dispersion' else False
             ak0_data['dmft_mu'] = akw_data['dmft_mu']
             ak0_data['eta'] = 0.01
-            ak0, ak0_data['dmft_mu'] = akw.calc_kslice(tb_kslice_data, sigma_data, ak0_data, solve, band_basis)
-            ak0_data['Akw'] = ak0.tolist()
-            ak0_data['use'] = True
-            ak0_data['solve'] = solve
+            # run in the process pool, a previous job of this session is cancelled
+            owner = 'kslice-' + store.session(ak0_data)
+            ak0_data['job'] = jobs.submit_kslice(owner, tb_kslice_data, sigma_data, ak0_data, solve, band_basis)
+            ak0_data['job_solve'] = solve
 
+            return ak0_data, akw_switch, tb_alert, False, 'A(k,0): submitted'
+
+        elif trigger_id == id('job-poll') and 'job' in ak0_data:
+            job_status = jobs.status(ak0_data['job'])
+            if job_status['state'] == 'running':
+                return dash.no_update, dash.no_update, dash.no_update, False, 'A(k,0): {:.0f}%'.format(100 * job_status['progress'])
+            if job_status['state'] != 'done':
+                return dash.no_update, dash.no_update, dash.no_update, True, 'A(k,0): {}'.format(job_status['state'])
+
+            (ak0,), info = jobs.result(ak0_data.pop('job'))
+            if 'akw_path' in info:
+                ak0_data['akw_path'] = info['akw_path']
+            ak0_data['Akw'] = store.save(ak0, store.session(ak0_data), 'Akw')
+            if not ak0_data['job_solve']:
+                ak0_data['Akw_pyramid'] = pyramid.build(ak0, store.session(ak0_data), 'Akw')
+            ak0_data['use'] = True
+            ak0_data['solve'] = ak0_data.pop('job_solve')
             akw_switch = {'on': True}
 
-        return ak0_data, akw_switch, tb_alert 
+            return ak0_data, akw_switch, tb_alert, True, 'A(k,0): done in {:.1f}s'.format(job_status['time'])
+
+        return ak0_data, akw_switch, tb_alert, dash.no_update, dash.no_update 
+
+    # kz slider of a stack of slices
+    @app.callback(
+        [Output(id('kz-slider'), 'max'),
+         Output(id('kz-slider'), 'marks'),
+         Output(id('kz-slider'), 'value')],
+        Input(id('tb-kslice-data'), 'data'),
+        State(id('kz-slider'), 'value'),
+        prevent_initial_call=True,
+        )
+    def update_kz_slider(tb_kslice_data, ikz):
+        kz = tb_kslice_data.get('kz', [0.])
+        marks = {ik: '{:.2f}'.format(value) for ik, value in enumerate(kz)}
+        return len(kz) - 1, marks, min(ikz, len(kz) - 1)
 
     # dashboard colors
     @app.callback(
@@ -129,12 +202,22 @@ def register_callbacks(app):
          Input(id('colorscale'), 'value'),
          Input(id('tb-kslice-data'), 'data'),
          Input(id('ak0-data'), 'data'),
-         Input(id_tap('sigma-data'), 'data')],
+         Input(id_tap('sigma-data'), 'data'),
+         Input(id('fs-mode'), 'value'),
+         Input(id('kz-slider'), 'value'),
+         Input(id('Ak0'), 'relayoutData')],
          prevent_initial_call=True)
-    def plot_ak0(tb_switch, akw_switch, colorscale, tb_kslice_data, ak0_data, sigma_data):
+    def plot_ak0(tb_switch, akw_switch, colorscale, tb_kslice_data, ak0_data, sigma_data, fs_mode, ikz, relayout):
         ctx = dash.callback_context
         trigger_id = ctx.triggered[0]["prop_id"].split(".")[0]
         print('{:20s}'.format('***update_ak0***:'), trigger_id)
+
+        # zoomed range of the figure, only zoom events redraw it
+        relayout = relayout or {}
+        k_ranges = [[relayout[axis + '.range[0]'], relayout[axis + '.range[1]']] if axis + '.range[0]' in relayout else [0, 1]
+                    for axis in ('xaxis', 'yaxis')]
+        if trigger_id == id('Ak0') and not any(key.endswith(('.range[0]', '.autorange')) for key in relayout):
+            return dash.no_update
         
         # initialize general figure environment
         layout = go.Layout()
@@ -148,6 +231,23 @@ def register_callbacks(app):
 
         if not tb_kslice_data['use']:
             return fig
+
+        if fs_mode == '3D':
+            if not tb_switch or 'fs3d' not in tb_kslice_data:
+                return fig
+            fs3d = tb_kslice_data['fs3d']
+            verts, faces = store.load(fs3d['verts']), store.load(fs3d['faces'])
+            colors = px.colors.qualitative.Plotly
+            fig = go.Figure()
+            for surface, band in enumerate(fs3d['band']):
+                v = verts[fs3d['vert_offsets'][surface]:fs3d['vert_offsets'][surface+1]]
+                f = faces[fs3d['face_offsets'][surface]:fs3d['face_offsets'][surface+1]] - fs3d['vert_offsets'][surface]
+                fig.add_trace(go.Mesh3d(x=v[:,0], y=v[:,1], z=v[:,2], i=f[:,0], j=f[:,1], k=f[:,2],
+                                        color=colors[band % len(colors)], opacity=0.6, flatshading=True,
+                                        name=f'tb band {band}', hoverinfo='name'))
+            fig.update_layout(margin={'l': 0, 'b': 0, 't': 10, 'r': 0}, font=dict(size=16),
+                              scene=dict(aspectmode='data', xaxis_title='kx', yaxis_title='ky', zaxis_title='kz'))
+            return fig
     
         sign = [1,-1]
         quarter = 0
@@ -155,30 +255,47 @@ def register_callbacks(app):
         k_mesh = tb_kslice_data['k_mesh']
         if tb_switch:
             quarters *= 2
-            eps_nuk = {int(key): np.array(value) for key, value in tb_kslice_data['eps_nuk'].items()}
+            fs = {key: store.load(value) for key, value in tb_kslice_data['fs_contours'].items()}
+            # contours of the selected kz, all in one trace separated by NaN
+            kz = tb_kslice_data.get('kz', [0.])
+            contours = np.flatnonzero(np.isclose(fs['kz'], kz[min(ikz, len(kz) - 1)]))
+            counts = np.diff(fs['offsets']).astype(int)[contours]
+            vertices = np.concatenate([np.arange(fs['offsets'][ic], fs['offsets'][ic+1], dtype=int) for ic in contours] or [np.zeros(0, dtype=int)])
+            k = fs['k'].reshape(-1, 3)[vertices]
+            breaks = np.cumsum(counts)[:-1]
+            labels = np.repeat(['tb band {}'.format(band) for band in fs['band'][contours]], counts)
             for qrt in list(product(*quarters))[quarter:quarter+1]:
-                for band in range(len(eps_nuk)):
-                    for segment in range(eps_nuk[band].shape[0]):
-                        #orbital_projected = evec_nuk[band][segment][plot_dict['proj_on_orb']]
-                        fig.add_trace(go.Scattergl(x=qrt[0] * eps_nuk[band][segment:segment+2,0], y=qrt[1] * eps_nuk[band][segment:segment+2,1],
-                                                   mode='lines', line=go.scattergl.Line(color=px.colors.sequential.Viridis[0]), showlegend=False,
-                                                   text=f'tb band {band}', hoverinfo='x+y+text'))
+                if len(contours) == 0: break
+                fig.add_trace(go.Scattergl(x=qrt[0] * np.insert(k[:,0], breaks, np.nan), y=qrt[1] * np.insert(k[:,1], breaks, np.nan),
+                                           mode='lines', line=go.scattergl.Line(color=px.colors.sequential.Viridis[0]), showlegend=False,
+                                           connectgaps=False, text=np.insert(labels, breaks, ''), hoverinfo='x+y+text'))
 
         if not ak0_data['use']:
             return fig
 
         if akw_switch:
-            n_kx, n_ky = np.array(tb_kslice_data['e_mat']).shape[2:4]
-            ak0 = np.array(ak0_data['Akw'])
-            kx = np.linspace(0, 1, ak0.shape[0])
-            ky = np.linspace(0, 1, ak0.shape[1])
             for qrt in list(product(*quarters))[quarter:quarter+1]:
                 if ak0_data['solve']:
+                    ak0 = store.load(ak0_data['Akw'])
+                    # select the kz slice of a stack
+                    if ak0.ndim == 4:
+                        ak0 = ak0[min(ikz, len(ak0) - 1)]
+                    kx = np.linspace(0, 1, ak0.shape[0])
+                    ky = np.linspace(0, 1, ak0.shape[1])
                     for ik1 in range(len(ky)):
                         for orb in range(tb_kslice_data['n_wf']):
                             fig.add_trace(go.Scattergl(x=kx, y=ak0[:,ik1,orb].T, showlegend=False, mode='markers',
                                                        marker_color=px.colors.sequential.Viridis[0]))
                 else:
-                    fig.add_trace(go.Heatmap(x=kx, y=ky, z=ak0.T, colorscale=colorscale, reversescale=False, showscale=False, zmin=np.min(ak0), zmax=np.max(ak0)))
+                    # tiles of the pyramid level matching the zoom, of the selected kz slice of a stack
+                    pyr = ak0_data['Akw_pyramid']
+                    n_kx, n_ky = pyr['shape'][-2:]
+                    select = (min(ikz, pyr['shape'][0] - 1),) if len(pyr['shape']) == 3 else ()
+                    _, rows, cols, ak0 = pyramid.fetch(pyr, [np.array(k_ranges[0]) * (n_kx - 1), np.array(k_ranges[1]) * (n_ky - 1)],
+                                                       select=select)
+                    fig.add_trace(go.Heatmap(x=rows / (n_kx - 1), y=cols / (n_ky - 1), z=ak0.T, colorscale=colorscale, reversescale=False,
+                                             showscale=False, zmin=pyr['min'], zmax=pyr['max']))
+
+        fig.update_layout(xaxis_range=k_ranges[0], yaxis_range=k_ranges[1])
 
         return fig
@@ -19,7 +19,15 @@ def layout(tb_data, tb_kslice_data, akw_data, ak0_data, sigma_data, loaded_data)
                     id=id('Ak0'),
                     style={'height': '84vh'},
                     clickData={'points': []}
-                    )
+                    ),
+                dcc.Slider(
+                    id=id('kz-slider'),
+                    min=0,
+                    max=0,
+                    value=0,
+                    step=1,
+                    updatemode='drag',
+                    ),
             ], style={
                 'display': 'inline-block',
                 'width': '41%',
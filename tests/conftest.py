@@ -0,0 +1,23 @@
+import os
+import sys
+import pytest
+
+# the app is run from the repository root, which holds load_data.py and the tools package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class App(object):
+    # collects the callbacks of a register_callbacks by name
+    def __init__(self):
+        self.callbacks = {}
+
+    def callback(self, *args, **kwargs):
+        def register(func):
+            self.callbacks[func.__name__] = func
+            return func
+        return register
+
+
+@pytest.fixture
+def app():
+    return App()
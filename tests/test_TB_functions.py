@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('triqs')
+pytest.importorskip('skimage')
+
+import tools.TB_functions as tbf
+from triqs.lattice.tight_binding import TBLattice
+
+
+def _lattice(dim):
+    # nearest-neighbour band -2 sum_i cos(2 pi k_i) in orbital 0 and a flat band at 5 in orbital 1
+    hopping = {(0, 0, 0): np.diag([0., 5.])}
+    for i in range(dim):
+        for sign in (1, -1):
+            R = [0, 0, 0]
+            R[i] = sign
+            hopping[tuple(R)] = np.diag([-1., 0.])
+    return TBLattice(units=np.eye(3), hopping=hopping, orbital_positions=[(0, 0, 0)] * 2, orbital_names=['0', '1'])
+
+
+def _band(k_points, dim):
+    return -2 * np.cos(2 * np.pi * k_points[:, :dim]).sum(axis=1)
+
+
+def test_kx_ky_fermi_surface_contours():
+    X, Y, Z = [1., 0., 0.], [0., 1., 0.], [0., 0., 1.]
+    kz, fermi = [0., 0.25], [-1., 0.]
+    fs = tbf.get_kx_ky_FS(X, Y, Z, _lattice(2), N_kxy=101, kz=kz, fermi=fermi)
+
+    offsets, n_contours = fs['offsets'], len(fs['band'])
+    assert offsets[0] == 0 and offsets[-1] == len(fs['k']) and np.all(np.diff(offsets) > 0)
+    assert len(offsets) == n_contours + 1 == len(fs['kz']) + 1 == len(fs['fermi']) + 1
+    # only the dispersive band crosses, for every kz and Fermi level
+    assert np.all(fs['band'] == 0)
+    assert {(k, f) for k, f in zip(fs['kz'], fs['fermi'])} == {(k, f) for k in kz for f in fermi}
+    assert fs['char'].shape == (len(fs['k']), 2) and np.allclose(fs['char'][:, 0], 1.)
+
+    # vertices (kx, ky) in [0, 0.5] on the contour of their Fermi level, and kz Z_z
+    counts = np.diff(offsets)
+    assert np.all((fs['k'][:, :2] >= 0.) & (fs['k'][:, :2] <= 0.5))
+    assert np.allclose(fs['k'][:, 2], np.repeat(fs['kz'], counts))
+    assert np.allclose(_band(2 * fs['k'], 2), np.repeat(fs['fermi'], counts), atol=1e-2)
+
+
+def test_kx_ky_fermi_surface_select_and_empty():
+    X, Y, Z = [1., 0., 0.], [0., 1., 0.], [0., 0., 1.]
+    fs = tbf.get_kx_ky_FS(X, Y, Z, _lattice(2), select=[0], N_kxy=21)
+    assert fs['char'].shape == (len(fs['k']), 1)
+
+    fs = tbf.get_kx_ky_FS(X, Y, Z, _lattice(2), N_kxy=21, fermi=10.)
+    assert fs['k'].shape == (0, 3) and fs['char'].shape == (0, 2)
+    assert fs['offsets'].tolist() == [0] and len(fs['band']) == 0
+
+
+def test_fermi_surface_3d():
+    tbl = _lattice(3)
+    fs = tbf.get_FS_3D(tbl, n_k=24, fermi=-1.)
+
+    verts, faces, vert_offsets, face_offsets = fs['verts'], fs['faces'], fs['vert_offsets'], fs['face_offsets']
+    assert fs['band'].tolist() == [0]
+    assert vert_offsets.tolist() == [0, len(verts)] and face_offsets.tolist() == [0, len(faces)]
+    assert faces.min() >= 0 and faces.max() < len(verts)
+
+    # vertices are cartesian, on the isosurface of the band in units of the reciprocal lattice vectors
+    k_mat = np.array(tbf.BrillouinZone(tbl.bl).units())
+    k_frac = verts @ np.linalg.inv(k_mat)
+    assert np.all(np.abs(k_frac) <= 0.5 + 1e-9)
+    assert np.allclose(_band(k_frac, 3), -1., atol=0.1)
+
+    # the grid is time-reversal symmetric, and decimation keeps the surface
+    fs_full = tbf.get_FS_3D(tbl, n_k=24, fermi=-1., time_reversal=False)
+    assert np.allclose(fs_full['verts'], verts) and np.array_equal(fs_full['faces'], faces)
+    fs_coarse = tbf.get_FS_3D(tbl, n_k=24, fermi=-1., step_size=2)
+    assert 0 < len(fs_coarse['faces']) < len(faces)
+
+
+def test_fermi_surface_3d_empty():
+    fs = tbf.get_FS_3D(_lattice(3), n_k=8, fermi=10.)
+    assert fs['verts'].shape == (0, 3) and fs['faces'].shape == (0, 3)
+    assert fs['vert_offsets'].tolist() == [0] and len(fs['band']) == 0
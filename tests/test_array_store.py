@@ -0,0 +1,55 @@
+import os
+import numpy as np
+import pytest
+
+import tools.array_store as store
+
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'store_dir', str(tmp_path))
+    monkeypatch.setattr(store, '_written', 0)
+
+
+def _store_bytes():
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(store.store_dir) for name in names)
+
+
+def test_save_load_round_trip():
+    array = np.arange(12.).reshape(3, 4)
+    handle = store.save(array, 'session', 'a')
+    assert store.is_handle(handle) and handle['shape'] == [3, 4]
+    assert np.array_equal(store.load(handle), array)
+    assert np.array_equal(store.load_complex(handle, handle), array + 1j * array)
+    # the content id does not depend on the session
+    assert store.content_id(handle) == store.content_id(store.save(array, 'other', 'a'))
+
+
+def test_hopping_round_trip():
+    hopping = {(0, 0, 0): np.eye(2), (1, 0, -1): np.ones((2, 2))}
+    loaded = store.load_hopping(store.save_hopping(hopping, 'session'))
+    assert set(loaded) == set(hopping) and all(np.array_equal(loaded[R], hopping[R]) for R in hopping)
+
+
+def test_eviction_is_amortized(monkeypatch):
+    scans = []
+    evict = store._evict
+    monkeypatch.setattr(store, '_evict', lambda: scans.append(1) or evict())
+    monkeypatch.setattr(store, 'max_bytes', 64 * 1024)
+    monkeypatch.setattr(store, 'evict_bytes', 16 * 1024)
+
+    # 1 kB arrays, the store is scanned once per 16 of them
+    for idx in range(200):
+        store.save(np.full(128, float(idx)), 'session', 'a')
+    assert len(scans) == 200 // 16
+    assert _store_bytes() <= store.max_bytes + store.evict_bytes + 200 * 128
+
+    # the newest arrays are kept
+    assert np.array_equal(store.load(store.save(np.full(128, 199.), 'session', 'a')), np.full(128, 199.))
+
+
+def test_evicted_handle_raises():
+    handle = store.save(np.zeros(4), 'session', 'a')
+    os.remove(store._path(handle))
+    with pytest.raises(KeyError):
+        store.load(handle)
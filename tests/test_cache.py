@@ -0,0 +1,95 @@
+import os
+import json
+import numpy as np
+import pytest
+
+import tools.cache as cache
+
+
+@pytest.fixture
+def stats_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'stats_dir', str(tmp_path / 'stats'))
+    monkeypatch.setattr(cache, 'caches', {})
+    monkeypatch.setattr(cache, '_stats_written', 0.0)
+    return tmp_path / 'stats'
+
+
+def test_hash_key():
+    a = {'x': np.arange(3.), 'y': [1, (2, 'z')]}
+    assert cache.hash_key(a) == cache.hash_key({'y': [1, (2, 'z')], 'x': np.arange(3.)})
+    assert cache.hash_key(a) != cache.hash_key(dict(a, x=np.arange(3)))
+    assert cache.hash_key([1, 2]) != cache.hash_key([[1, 2]])
+
+
+def test_lru_cache(monkeypatch):
+    monkeypatch.setattr(cache, 'caches', {})
+    lru = cache.LRUCache('lru', max_bytes=2 * 800)
+    for key in 'abc':
+        lru.put(key, np.zeros(100))
+        lru.get('a')
+    # b is the least recently used entry
+    assert 'a' in lru and 'b' not in lru and 'c' in lru
+    assert lru.get('b') is None
+    stats = lru.stats()
+    assert (stats['hits'], stats['misses'], stats['entries'], stats['bytes']) == (3, 1, 2, 1600)
+    assert stats['hit_rate'] == 0.75
+
+
+def test_disk_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(cache, 'caches', {})
+    disk = cache.DiskCache('disk', max_bytes=4000)
+    disk.path = str(tmp_path / 'disk')
+
+    value = (np.arange(6.).reshape(2, 3), {'mu': 1.5}, np.array(['a', 'b'], dtype=object))
+    disk.put('k', value)
+    loaded = disk.get('k')
+    assert np.array_equal(loaded[0], value[0]) and loaded[1] == value[1] and loaded[2].tolist() == ['a', 'b']
+
+    # entries are not overwritten, unless removed first
+    disk.put('k', np.zeros(2))
+    assert isinstance(disk.get('k'), tuple)
+    disk.remove('k')
+    assert 'k' not in disk and disk.get('k') is None
+
+    # the least recently used entries are evicted
+    for idx in range(5):
+        disk.put(str(idx), np.full(125, float(idx)))
+        os.utime(disk._entry(str(idx)), (idx, idx))
+    disk.put('5', np.full(125, 5.))
+    assert len(disk) < 6 and '5' in disk and '0' not in disk
+    assert disk.stats()['bytes'] <= disk.max_bytes
+
+
+def test_write_and_read_stats(stats_dir, monkeypatch):
+    lru = cache.LRUCache('lru')
+    lru.get('a')
+    cache.write_stats('web')
+
+    # at most once per stats_interval unless forced
+    lru.get('b')
+    cache.write_stats('web')
+    assert cache.read_stats()[0]['caches']['lru']['misses'] == 1
+    cache.write_stats('web', force=True)
+    processes = cache.read_stats()
+    assert len(processes) == 1
+    assert processes[0]['pid'] == os.getpid() and processes[0]['role'] == 'web'
+    assert processes[0]['caches']['lru']['misses'] == 2 and processes[0]['maxrss_kb'] > 0
+
+    # files of ended processes are removed
+    dead = os.fork()
+    if dead == 0:
+        os._exit(0)
+    os.waitpid(dead, 0)
+    (stats_dir / '{}.json'.format(dead)).write_text(json.dumps(dict(processes[0], pid=dead)))
+    assert [process['pid'] for process in cache.read_stats()] == [os.getpid()]
+    assert not (stats_dir / '{}.json'.format(dead)).exists()
+
+
+def test_aggregate_stats():
+    processes = [{'pid': 1, 'maxrss_kb': 100, 'caches': {'a': {'hits': 3, 'misses': 1}, 'b': {'hits': 0, 'misses': 0}}},
+                 {'pid': 2, 'maxrss_kb': 50, 'caches': {'a': {'hits': 1, 'misses': 3}}}]
+    stats = cache.aggregate_stats(processes)
+    assert stats['processes'] == processes and stats['maxrss_kb'] == 150
+    assert stats['caches'] == {'a': {'hits': 4, 'misses': 4, 'hit_rate': 0.5},
+                               'b': {'hits': 0, 'misses': 0, 'hit_rate': 0.0}}
+    assert cache.aggregate_stats([]) == {'processes': [], 'caches': {}, 'maxrss_kb': 0}
@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('triqs')
+
+import tools.calc_akw as akw
+
+
+def _hermitian(rng, *shape):
+    a = rng.normal(size=shape) + 1j * rng.normal(size=shape)
+    return (a + np.swapaxes(a, -1, -2).conjugate()) / 2
+
+
+def _problem(n_k=7, n_orb=3, n_w=41, seed=0):
+    rng = np.random.default_rng(seed)
+    e_k = _hermitian(rng, n_k, n_orb, n_orb)
+    w_mesh = np.linspace(-3, 3, n_w)
+    # full complex sigma with a causal (negative) imaginary part on the diagonal
+    sigma_w = 0.3 * _hermitian(rng, n_w, n_orb, n_orb) - 1j * (0.1 + 0.05 * w_mesh**2)[:, None, None] * np.eye(n_orb)
+    sigma_w += 0.05j * rng.normal(size=(n_w, n_orb, n_orb))
+    return e_k, sigma_w, w_mesh
+
+
+def _alatt_loop(e_k, sigma_w, w_mesh, eta, mu, e_vecs=None):
+    # the per-k and per-w inversion of calc_alatt before batching
+    n_k, n_orb = e_k.shape[:2]
+    alatt_k_w = np.zeros((n_k, len(w_mesh)))
+    for ik in range(n_k):
+        for iw, w in enumerate(w_mesh):
+            sigma = sigma_w[iw] if e_vecs is None else e_vecs[ik].conjugate().T @ sigma_w[iw] @ e_vecs[ik]
+            g = np.linalg.inv((w + 1j * eta + mu) * np.eye(n_orb) - e_k[ik] - sigma)
+            alatt_k_w[ik, iw] = -1.0 / np.pi * np.trace(g).imag
+    return alatt_k_w
+
+
+@pytest.mark.parametrize('mem', [None, 1])
+def test_alatt_inverse_matches_loop(mem):
+    e_k, sigma_w, w_mesh = _problem()
+    # mem=1 forces chunks of a single k-point
+    result = akw.alatt_inverse(e_k, sigma_w, w_mesh, 0.05, 0.2, mem=mem)
+    assert np.allclose(result, _alatt_loop(e_k, sigma_w, w_mesh, 0.05, 0.2), atol=1e-10)
+
+
+@pytest.mark.parametrize('mem', [None, 1])
+def test_alatt_inverse_band_basis_matches_loop(mem):
+    e_k, sigma_w, w_mesh = _problem(seed=1)
+    eps_k, e_vecs = np.linalg.eigh(e_k)
+    e_band = eps_k[:, :, None] * np.eye(e_k.shape[1])
+    result = akw.alatt_inverse(e_band, sigma_w, w_mesh, 0.05, 0.2, e_vecs=e_vecs, mem=mem)
+    expected = _alatt_loop(e_band, sigma_w, w_mesh, 0.05, 0.2, e_vecs=e_vecs)
+    assert np.allclose(result, expected, atol=1e-10)
+    # the trace is invariant under the rotation
+    assert np.allclose(result, _alatt_loop(e_k, sigma_w, w_mesh, 0.05, 0.2), atol=1e-10)
+
+
+def test_spectral_function_paths_match_loop():
+    e_k, sigma_w, w_mesh = _problem(seed=2)
+    scalar = np.diagonal(sigma_w, axis1=1, axis2=2)[:, :1, None] * np.eye(e_k.shape[1])
+    alatt_k_w, path = akw.spectral_function(e_k, scalar, w_mesh, 0.05, 0.2)
+    assert path == 'eigen'
+    assert np.allclose(alatt_k_w, _alatt_loop(e_k, scalar, w_mesh, 0.05, 0.2), atol=1e-10)
+
+    alatt_k_w, path = akw.spectral_function(e_k, sigma_w, w_mesh, 0.05, 0.2, mem=1)
+    assert path == 'inverse'
+    assert np.allclose(alatt_k_w, _alatt_loop(e_k, sigma_w, w_mesh, 0.05, 0.2), atol=1e-10)
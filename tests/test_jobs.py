@@ -0,0 +1,56 @@
+import os
+import time
+import pytest
+
+pytest.importorskip('triqs')
+
+import tools.jobs as jobs
+
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, 'job_dir', str(tmp_path / 'jobs'))
+    monkeypatch.setattr(jobs, 'max_workers', 1)
+
+
+def _square(x):
+    return [], {'value': x * x}
+
+
+def _crash():
+    # as a pool process killed by the OOM killer
+    os._exit(1)
+
+
+def _wait(job, timeout=30):
+    start = time.time()
+    while jobs.status(job)['state'] == 'running' and time.time() - start < timeout:
+        time.sleep(0.05)
+    return jobs.status(job)
+
+
+def test_job_done():
+    job = jobs._new_job('test', 'test', 1)
+    jobs._submit(job, _square, 0, 3)
+    assert _wait(job)['state'] == 'done'
+    assert jobs.result(job)[1]['value'] == 9
+
+
+def test_dead_pool_process_fails_job():
+    job = jobs._new_job('test', 'test', 1)
+    jobs._submit(job, _crash, 0)
+    assert _wait(job)['state'] == 'error'
+
+    # the next job gets a new pool
+    job = jobs._new_job('test', 'test', 1)
+    jobs._submit(job, _square, 0, 2)
+    assert _wait(job)['state'] == 'done'
+
+
+def test_dead_owner_process_fails_job():
+    job = jobs._new_job('test', 'test', 1)
+    meta = jobs._read_json(jobs._path(job, 'meta.json'))
+    # a pid that is not in use
+    jobs._write_json(jobs._path(job, 'meta.json'), dict(meta, pid=2**22 + 1))
+    assert jobs.status(job)['state'] == 'error'
+
@@ -0,0 +1,49 @@
+import base64
+
+import numpy as np
+import pytest
+
+triqs_gf = pytest.importorskip('triqs.gf')
+h5 = pytest.importorskip('h5')
+
+import tools.array_store as store
+from load_data import load_sigma_h5
+
+
+def _sigma_upload(tmp_path, n_orb=2, n_w=101, dc=0.5, dmft_mu=0.2):
+    mesh = triqs_gf.MeshReFreq(omega_min=-2.0, omega_max=2.0, n_max=n_w)
+    w_mesh = np.linspace(-2.0, 2.0, n_w)
+    Sigma = triqs_gf.BlockGf(name_list=['up_0'], block_list=[triqs_gf.GfReFreq(mesh=mesh, target_shape=[n_orb, n_orb])])
+    diag = (-0.3 * w_mesh - 0.1j * (1 + w_mesh**2))[:, None] * np.arange(1, n_orb + 1)
+    Sigma['up_0'].data[:, range(n_orb), range(n_orb)] = diag + dc
+
+    path = tmp_path / 'sigma.h5'
+    with h5.HDFArchive(str(path), 'w') as ar:
+        ar.create_group('self_energy')
+        ar['self_energy']['Sigma'] = Sigma
+        ar['self_energy']['w_mesh'] = w_mesh.tolist()
+        ar['self_energy']['n_w'] = n_w
+        ar['self_energy']['n_orb'] = n_orb
+        ar['self_energy']['dc'] = dc
+        ar['self_energy']['dmft_mu'] = dmft_mu
+        ar['self_energy']['orbital_order'] = tuple(range(n_orb))
+
+    contents = 'data:application/octet-stream;base64,' + base64.b64encode(path.read_bytes()).decode()
+    return contents, w_mesh, diag
+
+
+def test_load_sigma_h5_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr('tools.array_store.store_dir', str(tmp_path / 'store'))
+    contents, w_mesh, diag = _sigma_upload(tmp_path)
+
+    data = load_sigma_h5(contents, 'sigma.h5')
+
+    sigma = store.load_complex(data['sigma_re'], data['sigma_im'])
+    assert sigma.shape == (2, 2, len(w_mesh))
+    # dc is subtracted, the mesh of the file is kept
+    assert np.allclose(np.einsum('iiw -> iw', sigma), diag.T, atol=1e-12)
+    assert np.allclose(sigma[0, 1], 0.0)
+    assert data['n_orb'] == 2
+    assert data['dmft_mu'] == pytest.approx(0.2)
+    assert data['w_dict']['n_w'] == len(w_mesh)
+    assert data['w_dict']['window'] == [pytest.approx(-2.0), pytest.approx(2.0)]
@@ -0,0 +1,142 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('triqs')
+
+import tools.array_store as store
+import tools.calc_akw as akw
+import tools.pipeline as pipeline
+
+n_orb, n_k, n_w = 2, 9, 61
+
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    # every test starts from empty stage caches in its own directories
+    monkeypatch.setattr(store, 'store_dir', str(tmp_path / 'store'))
+    for stage in pipeline.stages.values():
+        stage.cache.clear()
+        if stage.disk_cache is not None:
+            monkeypatch.setattr(stage.disk_cache, 'path', str(tmp_path / stage.disk_cache.name))
+
+    # a synthetic BZ grid instead of the SumkDiscreteFromLattice one
+    rng = np.random.default_rng(0)
+    hopping_k = rng.normal(size=(27, n_orb, n_orb))
+    hopping_k = (hopping_k + hopping_k.transpose(0,2,1)) / 2
+    grid = (hopping_k, np.full(27, 1 / 27), np.linalg.eigvalsh(hopping_k))
+    monkeypatch.setattr(akw, 'bz_grid', lambda *args: grid)
+
+
+def _tb_data(dft_mu=0.3):
+    rng = np.random.default_rng(1)
+    h_k = rng.normal(size=(n_k, n_orb, n_orb))
+    h_k = (h_k + h_k.transpose(0,2,1)) / 2
+    return {'hopping': {'R': [[0, 0, 0]], 'H': store.save(np.eye(n_orb), 'test', 'hopping')},
+            'units': [[1, 0, 0], [0, 1, 0], [0, 0, 1]], 'n_wf': n_orb, 'add_spin': False, 'n_elect': 2.0,
+            'k_mesh': {'k_disc': list(range(n_k))}, 'dft_mu': dft_mu,
+            'e_mat': store.save((h_k - dft_mu * np.eye(n_orb)).transpose(1,2,0), 'test', 'e_mat')}
+
+
+def _sigma_data(scale=0.2, seed=2):
+    rng = np.random.default_rng(seed)
+    w_mesh = np.linspace(-4, 4, n_w)
+    sigma = scale * (rng.normal(size=(n_w, n_orb, n_orb)) + 1j * rng.normal(size=(n_w, n_orb, n_orb)))
+    sigma -= 1j * (0.1 + 0.05 * w_mesh**2)[:, None, None] * np.eye(n_orb)
+    sigma = sigma.transpose(1,2,0)
+    return {'sigma_re': store.save(sigma.real, 'test', 'sigma_re'), 'sigma_im': store.save(sigma.imag, 'test', 'sigma_im'),
+            'w_dict': {'w_mesh': w_mesh.tolist(), 'n_w': n_w, 'window': [-4, 4]}}
+
+
+def _run(tb_data, sigma_data, eta=0.05):
+    inputs = pipeline.inputs(tb_data, sigma_data, {'eta': eta, 'dmft_mu': 0.0})
+    return pipeline.run('akw', tb_data, sigma_data, inputs)
+
+
+def test_eta_recomputes_mu_and_akw():
+    tb_data, sigma_data = _tb_data(), _sigma_data()
+    _, recomputed = _run(tb_data, sigma_data)
+    assert set(recomputed) == set(pipeline.stages) - {'qp', 'akw_inverse'}
+
+    _, recomputed = _run(tb_data, sigma_data, eta=0.1)
+    assert recomputed == ['mu', 'akw']
+
+
+def test_dft_mu_recomputes_akw():
+    sigma_data = _sigma_data()
+    _run(_tb_data(), sigma_data)
+
+    tb_data = _tb_data(dft_mu=0.5)
+    alatt_k_w, recomputed = _run(tb_data, sigma_data)
+    assert recomputed == ['akw']
+
+    # the cached poles give the same A(k,w) as a direct evaluation from the new e_mat
+    inputs = pipeline.inputs(tb_data, sigma_data, {'eta': 0.05, 'dmft_mu': 0.0})
+    mu, _ = pipeline.run('mu', tb_data, sigma_data, inputs)
+    sigma = store.load_complex(sigma_data['sigma_re'], sigma_data['sigma_im']).transpose(2,0,1)
+    expected = akw.alatt_inverse(store.load(tb_data['e_mat']).transpose(2,0,1), sigma, sigma_data['w_dict']['w_mesh'],
+                                 0.05, tb_data['dft_mu'] - mu)
+    assert np.allclose(alatt_k_w, expected, atol=1e-10)
+
+
+def test_sigma_keeps_lattice_and_hk():
+    tb_data = _tb_data()
+    _run(tb_data, _sigma_data())
+
+    _, recomputed = _run(tb_data, _sigma_data(seed=3))
+    assert {'bz_eigen', 'mu', 'eigen', 'akw'} <= set(recomputed)
+    assert 'lattice' not in recomputed and 'hk' not in recomputed
+
+
+def test_band_basis_keeps_complex_hk():
+    # H(k) with complex hoppings, stored as its real part in the orbital basis
+    tb_data, sigma_data = _tb_data(), _sigma_data()
+    rng = np.random.default_rng(5)
+    h_k = rng.normal(size=(n_k, n_orb, n_orb)) + 1j * rng.normal(size=(n_k, n_orb, n_orb))
+    h_k = (h_k + h_k.conjugate().transpose(0,2,1)) / 2
+    eps_k, e_vecs = np.linalg.eigh(h_k - tb_data['dft_mu'] * np.eye(n_orb))
+    tb_data['e_mat'] = store.save((h_k - tb_data['dft_mu'] * np.eye(n_orb)).real.transpose(1,2,0), 'test', 'e_mat')
+    band_data = dict(tb_data, e_mat=store.save((eps_k[:, :, None] * np.eye(n_orb)).transpose(1,2,0), 'test', 'e_band'),
+                     evecs_re=store.save(e_vecs.real.transpose(1,2,0), 'test', 'evecs_re'),
+                     evecs_im=store.save(e_vecs.imag.transpose(1,2,0), 'test', 'evecs_im'))
+
+    inputs = pipeline.inputs(tb_data, sigma_data, {'eta': 0.05, 'dmft_mu': 0.0})
+    band_inputs = pipeline.inputs(band_data, sigma_data, {'eta': 0.05, 'dmft_mu': 0.0}, band_basis=True)
+    assert pipeline.key('hk', inputs) != pipeline.key('hk', band_inputs)
+
+    pipeline.run('hk', tb_data, sigma_data, inputs)
+    e_k, recomputed = pipeline.run('hk', band_data, sigma_data, band_inputs)
+    assert recomputed == ['hk']
+    assert np.allclose(e_k, h_k)
+
+
+def test_poles_match_inverse_for_non_hermitian_sigma():
+    rng = np.random.default_rng(4)
+    e_k = rng.normal(size=(n_k, 3, 3)) + 1j * rng.normal(size=(n_k, 3, 3))
+    e_k = (e_k + e_k.conjugate().transpose(0,2,1)) / 2
+    w_mesh = np.linspace(-3, 3, n_w)
+    sigma_w = 0.3 * (rng.normal(size=(n_w, 3, 3)) + 1j * rng.normal(size=(n_w, 3, 3))) - 0.2j * np.eye(3)
+
+    alatt_k_w = akw.alatt_poles(akw.resolvent_poles(e_k, sigma_w), w_mesh, 0.05, 0.1)
+    assert np.allclose(alatt_k_w, akw.alatt_inverse(e_k, sigma_w, w_mesh, 0.05, 0.1), atol=1e-8)
+
+
+def test_alatt_step_selects_engine():
+    import tools.jobs as jobs
+    tb_data, sigma_data = _tb_data(), _sigma_data()
+    akw_data = {'eta': 0.05, 'dmft_mu': 0.0}
+
+    # a full sigma goes through the batched resolvent
+    (alatt_k_w,), info = jobs._alatt_step(tb_data, sigma_data, akw_data, None, False, False)
+    assert info['akw_path'] == 'inverse'
+    assert 'akw_inverse' in info['recomputed'] and 'eigen' not in info['recomputed']
+    poles, _ = pipeline.run('akw', tb_data, sigma_data, pipeline.inputs(tb_data, sigma_data, akw_data))
+    assert np.allclose(alatt_k_w, poles, atol=1e-8)
+
+    # a scalar sigma re-broadens the closed-form poles
+    w_mesh = np.array(sigma_data['w_dict']['w_mesh'])
+    sigma = (-0.2 * w_mesh - 1j * (0.1 + 0.05 * w_mesh**2)) * np.eye(n_orb)[:, :, None]
+    scalar_data = dict(sigma_data, sigma_re=store.save(sigma.real, 'test', 'sigma_re'), sigma_im=store.save(sigma.imag, 'test', 'sigma_im'))
+    (alatt_k_w,), info = jobs._alatt_step(tb_data, scalar_data, akw_data, None, False, False)
+    assert info['akw_path'] == 'eigen'
+    assert {'eigen', 'akw'} <= set(info['recomputed'])
+    assert alatt_k_w.shape == (n_k, len(w_mesh))
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+import tools.array_store as store
+import tools.pyramid as pyramid
+
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'store_dir', str(tmp_path))
+
+
+def _map(shape=(300, 5000), peak=(123, 4321)):
+    array = np.random.default_rng(0).random(shape)
+    array[peak] = 4.0
+    return array
+
+
+def test_anisotropic_fetch_bounded_by_figure():
+    handle = pyramid.build(_map(), 'test', 'Akw')
+    level, rows, cols, values = pyramid.fetch(handle, [(0, 299), (0, 4999)], n_px=(600, 400))
+
+    assert values.shape[0] <= 600 and values.shape[1] <= 400
+    # the k axis is already below the figure resolution and is not pooled
+    assert level[0] == 0 and values.shape[0] == 300
+    assert values.shape == (len(rows), len(cols))
+    # max pooling keeps the peak
+    assert values.max() == 4.0
+
+
+def test_zoom_reads_full_resolution():
+    array = _map()
+    handle = pyramid.build(array, 'test', 'Akw')
+    level, rows, cols, values = pyramid.fetch(handle, [(100, 150), (4000, 4300)], n_px=(600, 400))
+
+    assert level == (0, 0)
+    assert rows[0] <= 100 and rows[-1] >= 150 and cols[0] <= 4000 and cols[-1] >= 4300
+    assert np.allclose(values, array[int(rows[0]):int(rows[-1])+1, int(cols[0]):int(cols[-1])+1], rtol=1e-3)
+
+
+@pytest.mark.parametrize('n_px', [(300, 300), (64, 600), (600, 64)])
+def test_fetch_within_n_px(n_px):
+    handle = pyramid.build(_map((1000, 3000), (1, 2)), 'test', 'Akw', pooling='mean')
+    for ranges in [[(0, 999), (0, 2999)], [(10.5, 700.2), (2000, 2999)], [(500, 501), (0, 2999)]]:
+        _, rows, cols, values = pyramid.fetch(handle, ranges, n_px=n_px)
+        assert values.shape[0] <= max(n_px[0], pyramid.tile) and values.shape[1] <= max(n_px[1], pyramid.tile)
+        # centers stay inside the map
+        assert rows.min() >= 0 and rows.max() <= 999 and cols.min() >= 0 and cols.max() <= 2999
+
+
+def test_stack_select():
+    stack = np.stack([_map((40, 600), (1, 2)), 2 * _map((40, 600), (1, 2))])
+    handle = pyramid.build(stack, 'test', 'Ak0')
+    _, _, _, values = pyramid.fetch(handle, [(0, 39), (0, 599)], n_px=(100, 300), select=(1,))
+
+    assert values.shape[0] == 40 and values.shape[1] <= 300
+    assert values.max() == 8.0
+
+
+def test_axis_index_round_trip():
+    values = np.cumsum(np.random.default_rng(1).random(50))
+    index = np.array([0, 3.5, 49])
+    assert np.allclose(pyramid.axis_index(values, pyramid.axis_values(values, index)), index)
@@ -0,0 +1,51 @@
+import types
+import numpy as np
+import pytest
+
+dash = pytest.importorskip('dash')
+pytest.importorskip('dash_extensions')
+pytest.importorskip('triqs')
+pytest.importorskip('h5')
+
+import tools.array_store as store
+from tabs.tab1_callbacks import register_callbacks
+
+
+@pytest.fixture
+def callbacks(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'store_dir', str(tmp_path))
+    monkeypatch.setattr(dash, 'callback_context', types.SimpleNamespace(triggered=[{'prop_id': 'tab1-akw-data.data'}]))
+    register_callbacks(app)
+    return app.callbacks
+
+
+def _data(solve):
+    k_disc = np.linspace(0, 2, 30)
+    w_mesh = np.linspace(-2, 2, 41)
+    tb_data = {'use': True, 'k_mesh': {'k_disc': k_disc.tolist(), 'k_points': [0., 1., 2.], 'k_point_labels': ['g', 'x', 'm']}}
+    sigma_data = {'use': True, 'w_dict': {'w_mesh': w_mesh.tolist(), 'n_w': 41, 'window': [-2, 2]}}
+    # QP poles (n_k, n_orb) when solving, else A(k,w) (n_k, n_w)
+    akw = np.tile(np.linspace(-1, 1, 2), (30, 1)) if solve else np.random.default_rng(0).random((30, 41)) + 0.1
+    akw_data = {'use': True, 'solve': solve, 'Akw': store.save(akw, 'test', 'Akw')}
+    return tb_data, akw_data, sigma_data
+
+
+@pytest.mark.parametrize('view', [{}, {'k': [0.5, 1.0], 'w': [-0.5, 0.5]}])
+def test_plot_akw_solve(callbacks, view):
+    tb_data, akw_data, sigma_data = _data(solve=True)
+    fig = callbacks['plot_Akw'](False, True, 'viridis', tb_data, akw_data, sigma_data, 'heatmap', view)
+
+    # QP dispersions are always shown on the full range
+    assert list(fig.layout.xaxis.range) == [0., 2.]
+    assert list(fig.layout.yaxis.range) == [-2., 2.]
+    assert len(fig.data) == 2
+
+
+def test_plot_akw_view(callbacks):
+    import tools.pyramid as pyramid
+    tb_data, akw_data, sigma_data = _data(solve=False)
+    akw_data['Akw_pyramid'] = pyramid.build(store.load(akw_data['Akw']), 'test', 'Akw')
+    fig = callbacks['plot_Akw'](False, True, 'viridis', tb_data, akw_data, sigma_data, 'heatmap', {'k': [0.5, 1.0], 'w': [-0.5, 0.5]})
+
+    assert list(fig.layout.xaxis.range) == [0.5, 1.0]
+    assert list(fig.layout.yaxis.range) == [-0.5, 0.5]
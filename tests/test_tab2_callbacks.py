@@ -0,0 +1,46 @@
+import types
+import pytest
+
+dash = pytest.importorskip('dash')
+pytest.importorskip('dash_extensions')
+pytest.importorskip('triqs')
+pytest.importorskip('h5')
+
+from tabs.tab2_callbacks import parse_kz, register_callbacks
+
+
+@pytest.mark.parametrize('text, kz', [('0', [0.]), ('', [0.]), ('0.5, -0.25,', [0.5, -0.25]), (0.5, [0.5]),
+                                      ('0.5,abc', None), ('½', None), ('nan', None)])
+def test_parse_kz(text, kz):
+    assert parse_kz(text) == kz
+
+
+def test_calc_tb_invalid_kz(app, monkeypatch):
+    monkeypatch.setattr(dash, 'callback_context', types.SimpleNamespace(triggered=[{'prop_id': 'tab2-calc-tb.n_clicks'}]))
+    register_callbacks(app)
+
+    tb_kslice_data = {'use': False}
+    result = app.callbacks['calc_tb']({'on': False}, 1, [], '0.0', 20, [], tb_kslice_data, {'use': True}, '2D', '0.5,abc')
+    assert result == (dash.no_update, dash.no_update, True)
+    assert tb_kslice_data == {'use': False}
+
+
+def test_calc_tb_stores_contour_handles(app, tmp_path, monkeypatch):
+    import numpy as np
+    import tools.array_store as store
+    import tools.calc_tb as tb
+    monkeypatch.setattr(store, 'store_dir', str(tmp_path))
+    monkeypatch.setattr(dash, 'callback_context', types.SimpleNamespace(triggered=[{'prop_id': 'tab2-calc-tb.n_clicks'}]))
+    monkeypatch.setattr(tb, 'calc_tb_bands', lambda *args, **kwargs: ({'n_k': 4}, np.zeros((1, 1, 16)), None, None))
+    fs = {'k': np.random.default_rng(0).random((10, 3)), 'offsets': np.array([0, 4, 10]), 'band': np.array([0, 1]),
+          'kz': np.zeros(2), 'fermi': np.zeros(2), 'char': np.ones((10, 3))}
+    monkeypatch.setattr(tb, 'get_tb_kslice', lambda *args: fs)
+    register_callbacks(app)
+
+    tb_data = {'use': True, 'n_wf': 1, 'hopping': {}, 'units': [], 'e_mat': 'path data'}
+    tb_kslice_data, _, alert = app.callbacks['calc_tb']({'on': False}, 1, [], '0.0', 4, [], {'use': False}, tb_data, '2D', '0')
+
+    assert not alert
+    assert set(tb_kslice_data['fs_contours']) == {'k', 'offsets', 'band', 'kz', 'fermi'}
+    assert all(store.is_handle(value) for value in tb_kslice_data['fs_contours'].values())
+    assert np.array_equal(store.load(tb_kslice_data['fs_contours']['k']), fs['k'])
@@ -0,0 +1,71 @@
+import zlib
+import struct
+import base64
+import numpy as np
+import pytest
+
+import tools.transport as transport
+
+
+def _decode_png(data):
+    # chunks of the minimal encoder: 8 bit RGB, no interlacing, filter type 0 on every scanline
+    assert data[:8] == b'\x89PNG\r\n\x1a\n'
+    chunks, pos = {}, 8
+    while pos < len(data):
+        length, = struct.unpack('>I', data[pos:pos+4])
+        tag, body = data[pos+4:pos+8], data[pos+8:pos+8+length]
+        crc, = struct.unpack('>I', data[pos+8+length:pos+12+length])
+        assert crc == zlib.crc32(tag + body) & 0xffffffff
+        chunks[tag] = body
+        pos += 12 + length
+    assert b'IEND' in chunks
+
+    n_cols, n_rows, depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', chunks[b'IHDR'])
+    assert (depth, color_type, interlace) == (8, 2, 0)
+    raw = np.frombuffer(zlib.decompress(chunks[b'IDAT']), dtype=np.uint8).reshape(n_rows, 1 + 3 * n_cols)
+    assert np.all(raw[:, 0] == 0)
+    return raw[:, 1:].reshape(n_rows, n_cols, 3)
+
+
+def test_quantize():
+    z = np.array([[0., 0.5, 1.], [np.nan, -np.inf, 2.]])
+    levels, (zmin, zmax) = transport.quantize(z)
+    assert levels.dtype == np.uint8 and (zmin, zmax) == (-0., 2.)
+    assert levels.tolist() == [[0, 64, 128], [0, 0, 255]]
+
+    # values outside the given range are clipped
+    levels, _ = transport.quantize(z, bits=12, zmin=0.5, zmax=1.)
+    assert levels.dtype == np.uint16 and levels.tolist() == [[0, 0, 4095], [0, 0, 4095]]
+
+    # constant maps do not divide by zero
+    assert np.all(transport.quantize(np.ones(3))[0] == 0)
+
+
+def test_colorscale_lut():
+    lut = transport.colorscale_lut('Viridis')
+    assert lut.shape == (256, 3) and lut.dtype == np.uint8
+    lut = transport.colorscale_lut(['rgb(0,0,0)', 'rgb(255,255,255)'], n_colors=3)
+    assert lut.tolist() == [[0, 0, 0], [128, 128, 128], [255, 255, 255]]
+    with pytest.raises(ValueError):
+        transport.colorscale_lut('not_a_colorscale')
+
+
+def test_png_bytes():
+    rgb = np.random.default_rng(0).integers(0, 256, size=(5, 7, 3), dtype=np.uint8)
+    assert np.array_equal(_decode_png(transport.png_bytes(rgb)), rgb)
+
+
+def test_image_source():
+    colorscale = ['rgb(0,0,0)', 'rgb(255,255,255)']
+    # non-uniform x, the last column is far from the others
+    x = np.array([0., 1., 2., 9.])
+    z = np.array([[0., 1., 2., 3.], [4., 5., 6., 7.]])
+    source = transport.image_source(z, x, colorscale, zmin=0., zmax=7.)
+    assert source.startswith('data:image/png;base64,')
+    image = _decode_png(base64.b64decode(source[len('data:image/png;base64,'):]))
+
+    # rows are flipped, columns resampled onto x = 0, 3, 6, 9 (nearest 0, 2, 9, 9)
+    lut = transport.colorscale_lut(colorscale)
+    expected, _ = transport.quantize(z[::-1][:, [0, 2, 3, 3]], 8, 0., 7.)
+    assert image.shape == (2, 4, 3)
+    assert np.array_equal(image, lut[expected])
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+
+import tools.array_store as store
+import tools.viewport as viewport
+
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    monkeypatch.setattr(store, 'store_dir', str(tmp_path / 'store'))
+    monkeypatch.setattr(viewport.tile_disk_cache, 'path', str(tmp_path / 'tiles'))
+    viewport.tile_cache.clear()
+    yield
+    viewport.tile_cache.clear()
+
+
+def _data(n_k=100, n_w=100):
+    hopping = store.save_hopping({(0, 0, 0): np.eye(2)}, 'session')
+    tb_data = {'k_mesh': {'k_disc': np.linspace(0., 2., n_k).tolist(), 'k_points_labels': ['G', 'X']},
+               'hopping': hopping, 'units': np.eye(3).tolist(), 'n_wf': 2, 'add_spin': False, 'dft_mu': 0.}
+    sigma = np.zeros((2, 2, n_w))
+    sigma_data = {'w_dict': {'w_mesh': np.linspace(-4., 4., n_w).tolist()},
+                  'sigma_re': store.save(sigma, 'session', 'sigma_re'), 'sigma_im': store.save(sigma, 'session', 'sigma_im')}
+    akw_data = {'eta': 0.01, 'dmft_mu': 0.}
+    return tb_data, sigma_data, akw_data
+
+
+def test_target_level():
+    full = [0., 1.]
+    assert viewport.target_level(full, full, viewport.tile_px) == 0
+    assert viewport.target_level([0., 0.5], full, viewport.tile_px) == 1
+    assert viewport.target_level([0., 0.25], full, 2 * viewport.tile_px) == 3
+    assert viewport.target_level([0.5, 0.5], full, viewport.tile_px) == viewport.max_level
+
+
+def test_make_view_and_refine():
+    tb_data, sigma_data, _ = _data()
+    view = viewport.make_view(None, [1., -1.], tb_data, sigma_data)
+    assert view['k'] == [0., 2.] and view['w'] == [-1., 1.]
+    assert view['path'] == viewport.path_key(tb_data)
+    assert view['level'] == [max(level - viewport.n_coarse, 0) for level in view['target']]
+
+    levels = [view['level']]
+    while not viewport.is_refined(view):
+        view = viewport.refine(view)
+        levels.append(view['level'])
+    assert view['level'] == view['target']
+    # every axis is refined one level at a time
+    assert all(0 <= b - a <= 1 for prev, cur in zip(levels, levels[1:]) for a, b in zip(prev, cur))
+    assert not viewport.is_refined(dict(view, job='id'))
+
+    # the overview already resolves the figure
+    tb_data, sigma_data, _ = _data(n_k=2000, n_w=2000)
+    view = viewport.make_view(None, None, tb_data, sigma_data)
+    assert 'target' not in view and viewport.is_refined(view)
+
+
+def test_path_key():
+    tb_data, _, _ = _data()
+    assert viewport.path_key(dict(tb_data, dft_mu=1.)) == viewport.path_key(tb_data)
+    k_mesh = dict(tb_data['k_mesh'], k_disc=np.linspace(0., 3., 100).tolist())
+    assert viewport.path_key(dict(tb_data, k_mesh=k_mesh)) != viewport.path_key(tb_data)
+    assert viewport.full_view(tb_data) == {'path': viewport.path_key(tb_data)}
+
+
+def test_tile_indices_cover_view():
+    full = [0., 1.]
+    assert list(viewport._tile_indices(full, full, 2)) == [0, 1, 2, 3]
+    assert list(viewport._tile_indices([0.3, 0.6], full, 2)) == [1, 2]
+    assert list(viewport._tile_indices([0.25, 0.5], full, 2)) == [1]
+    # outside the full range
+    assert list(viewport._tile_indices([-1., 0.1], full, 2)) == [0]
+
+    points = viewport.axis_points(full, 2, 1)
+    assert len(points) == viewport.tile_px and 0.25 < points[0] < points[-1] < 0.5
+
+
+def test_store_and_render_tiles(monkeypatch):
+    tb_data, sigma_data, akw_data = _data()
+    view = viewport.make_view([0.1, 0.9], [-1., 1.], tb_data, sigma_data)
+    level = view['level']
+    view['shown'] = level
+
+    missing = viewport.missing_tiles(tb_data, sigma_data, akw_data, view)
+    assert len(missing) > 1
+    assert viewport.render(tb_data, sigma_data, akw_data, view) is None
+
+    key = viewport.data_key(tb_data, sigma_data, akw_data)
+    tile = lambda index: np.full((viewport.tile_px, viewport.tile_px), 10. * index[0] + index[1])
+    # tiles are added to the entry of the level in several batches
+    viewport.store_tiles(key, level, missing[:1], [tile(missing[0])])
+    assert viewport.missing_tiles(tb_data, sigma_data, akw_data, view) == missing[1:]
+    viewport.store_tiles(key, level, missing[1:], [tile(index) for index in missing[1:]])
+    assert viewport.missing_tiles(tb_data, sigma_data, akw_data, view) == []
+    assert len(viewport.tile_disk_cache) == 1
+
+    # read back from the disk cache shared by the worker processes
+    viewport.tile_cache.clear()
+    k_disc, w_mesh, alatt_k_w = viewport.render(tb_data, sigma_data, akw_data, view)
+    assert alatt_k_w.shape == (len(k_disc), len(w_mesh))
+    # the edges of the tiles, half a pixel beyond the outer points, cover the view
+    dk, dw = (k_disc[1] - k_disc[0]) / 2, (w_mesh[1] - w_mesh[0]) / 2
+    assert k_disc[0] - dk <= 0.1 and k_disc[-1] + dk >= 0.9 and w_mesh[0] - dw <= -1. and w_mesh[-1] + dw >= 1.
+    assert np.all(np.diff(k_disc) > 0) and np.all(np.diff(w_mesh) > 0)
+    i_k, i_w = missing[-1]
+    assert alatt_k_w[-1, -1] == 10. * i_k + i_w
+
+    # other data does not see the tiles
+    assert viewport.missing_tiles(tb_data, sigma_data, dict(akw_data, eta=0.1), view) == missing
@@ -0,0 +1,62 @@
+import numpy as np
+
+import tools.wannier90 as w90
+
+
+def _hr_file(num_wann=2, nrpts=17, seed=0):
+    # R vectors in a non-sorted order, degeneracies spread over two lines of 15
+    rng = np.random.default_rng(seed)
+    R_vecs = [tuple(R) for R in rng.permutation([(x, y, z) for x in (-1, 0, 1) for y in (-1, 0, 1) for z in (-1, 0, 1)])[:nrpts]]
+    deg = rng.integers(1, 5, size=nrpts)
+    t = rng.normal(size=(nrpts, num_wann, num_wann)) + 1j * rng.normal(size=(nrpts, num_wann, num_wann))
+
+    lines = ['written on 17Oct2026 at 12:00:00', str(num_wann), str(nrpts)]
+    lines += [' '.join(str(d) for d in deg[i:i+15]) for i in range(0, nrpts, 15)]
+    for R, t_R in zip(R_vecs, t):
+        # wannier90 runs over m fastest, with orbitals counted from 1
+        for n in range(num_wann):
+            for m in range(num_wann):
+                lines.append('{:5d}{:5d}{:5d}{:5d}{:5d}{:12.6f}{:12.6f}'.format(*R, m + 1, n + 1, t_R[m, n].real, t_R[m, n].imag))
+
+    expected = {R: np.round(t_R, 6) / d for R, t_R, d in zip(R_vecs, t, deg)}
+    return '\n'.join(lines) + '\n', expected, R_vecs
+
+
+def _assert_hopping(hopping, expected):
+    assert list(hopping) == list(expected)
+    for R in expected:
+        assert np.allclose(hopping[R], expected[R], atol=1e-12)
+
+
+def test_parse_hr(tmp_path):
+    content, expected, R_vecs = _hr_file()
+    hopping, num_wann = w90.parse_hopping_from_wannier90_hr(content)
+    assert num_wann == 2
+    _assert_hopping(hopping, expected)
+
+    path = tmp_path / 'wannier90_hr.dat'
+    path.write_text(content)
+    hopping, num_wann = w90.parse_hopping_from_wannier90_hr_file(str(path))
+    assert num_wann == 2
+    _assert_hopping(hopping, expected)
+
+    # dense keeps the order of the R vectors in the file
+    (R_dense, H_R), _ = w90.parse_hopping_from_wannier90_hr_file(str(path), dense=True)
+    assert [tuple(R) for R in R_dense] == R_vecs
+    assert np.allclose(H_R, np.array([expected[R] for R in R_vecs]))
+
+
+def test_parse_hr_single_point(tmp_path):
+    content, expected, _ = _hr_file(num_wann=1, nrpts=1)
+    path = tmp_path / 'wannier90_hr.dat'
+    path.write_text(content)
+    hopping, num_wann = w90.parse_hopping_from_wannier90_hr_file(str(path))
+    assert num_wann == 1
+    _assert_hopping(hopping, expected)
+
+
+def test_parse_lattice_vectors():
+    content = '\n'.join([' Lattice Vectors (Bohr)', '  a_1     2.000000   0.000000   0.000000',
+                         '  a_2     0.000000   2.000000   0.000000', '  a_3     0.000000   0.000000   4.000000', ''])
+    vectors = w90.parse_lattice_vectors_from_wannier90_wout(content)
+    assert np.allclose(vectors, np.diag([2., 2., 4.]) * w90.units.Bohr)
@@ -3,6 +3,7 @@ from tools.wannier90 import *
 from triqs.lattice.tight_binding import *
 import skimage.measure
 import copy
+import itertools
 from matplotlib import cm
 
 def extend_wannier90_to_spin(hopping, num_wann):
@@ -12,77 +13,96 @@ def extend_wannier90_to_spin(hopping, num_wann):
         hopping_spin[key] = np.kron(np.eye(2), value)
     return hopping_spin, 2 * num_wann
 
-def energies_on_bz_paths(paths, tb_lattice, n_pts=50):
+# memory budget in bytes for one chunk of the Fourier transform H(R) -> H(k)
+max_mem = 2**27
 
-    """ Given a list of k-point paths compute the eigen energies along
-    the paths using n_pts discrete points for each sub-path. """
+def hopping_array(hopping):
+    """ R vectors (n_R, 3) and stacked hopping matrices (n_R, n_orb, n_orb) of a hopping dict. """
 
-    # -- Get the reciprocal lattice vectors
-    bz = BrillouinZone(tb_lattice.bl)
-    k_mat = np.array(bz.units())
+    R = np.array([list(key) for key in hopping.keys()], dtype=float)
+    H_R = np.array([np.asarray(value) for value in hopping.values()], dtype=complex)
+    return R, H_R
+
+def fourier_hk(R, H_R, k_points, mem=None):
+
+    """ H(k) = sum_R exp(2 pi i k.R) H(R) for arbitrary k-points (N_k, 3) given in
+    units of the reciprocal lattice vectors. Each chunk of k-points, sized to the
+    memory budget, is a single matrix product. Returns a (N_k, n_orb, n_orb) array. """
+
+    mem = max_mem if mem is None else mem
+    k_points = np.atleast_2d(np.asarray(k_points, dtype=float))
+    n_k = k_points.shape[0]
+    n_R, n_orb = H_R.shape[:2]
+    H_flat = H_R.reshape(n_R, n_orb * n_orb)
+
+    # phases and the chunk of H(k) are alive at the same time
+    chunk = int(max(1, min(n_k, mem // ((n_R + n_orb**2) * np.dtype(complex).itemsize))))
+    H_k = np.empty((n_k, n_orb, n_orb), dtype=complex)
+    for start in range(0, n_k, chunk):
+        stop = min(start + chunk, n_k)
+        phase = np.exp(2j * np.pi * np.dot(k_points[start:stop, :R.shape[1]], R.T))
+        H_k[start:stop] = np.dot(phase, H_flat).reshape(stop - start, n_orb, n_orb)
+
+    return H_k
+
+def tbl_hk(TBL, k_points, mem=None):
+    """ H(k) of a TBLattice for k-points (N_k, 3), see fourier_hk. """
 
-    n_paths = len(paths)
-    n_orb = tb_lattice.NOrbitalsInUnitCell
+    return fourier_hk(*hopping_array(TBL.hopping_dict()), k_points, mem)
 
-    k = np.zeros(n_pts * n_paths)
-    E = np.zeros((n_orb, n_pts * n_paths))
+def _bz_path_points(paths, k_mat, n_pts):
+
+    """ k-points (in units of the reciprocal lattice vectors) and accumulated path
+    length for a list of k-point paths with n_pts points per sub-path. The endpoint
+    is only included for the last sub-path. """
+
+    k_points = np.zeros((n_pts * len(paths), len(paths[0][0])))
+    k = np.zeros(n_pts * len(paths))
 
     k_length = 0. # accumulative k-path length
 
     for pidx, (ki, kf) in enumerate(paths):
+        
+        # if this is the last section, add the endpoint!
+        endpoint = pidx == len(paths) - 1
 
         s, e = pidx * n_pts, (pidx+1) * n_pts
-        E[:, s:e] = energies_on_bz_path(tb_lattice.tb, ki, kf, n_pts)
+        a = np.linspace(0., 1., num=n_pts, endpoint=endpoint)
+        k_points[s:e] = np.asarray(ki)[None, :] + a[:, None] * (np.asarray(kf) - np.asarray(ki))[None, :]
 
         dk = np.dot(k_mat.T, (ki - kf))
-        a = np.linspace(0., 1., num=n_pts, endpoint=False)
         k_vec = a[:, None] * dk[None, :]
 
         k[s:e] = np.linalg.norm(k_vec, axis=1) + k_length
         k_length += np.linalg.norm(dk)
 
-    #K = np.concatenate((k[::n_pts], [2 * k[-1] - k[-2]])) # add last point for K-grid
     K = np.concatenate((k[::n_pts], [k[-1]])) # add last point for K-grid
 
-    return k, K, E
-
+    return k_points, k, K
 
-def energy_matrix_on_bz_paths(paths, TBL, n_pts=50):
+def energies_on_bz_paths(paths, tb_lattice, n_pts=50):
 
     """ Given a list of k-point paths compute the eigen energies along
     the paths using n_pts discrete points for each sub-path. """
 
-    # -- Get the reciprocal lattice vectors
-    bz = BrillouinZone(TBL.bl)
-    k_mat = np.array(bz.units())
+    k, K, E = energy_matrix_on_bz_paths(paths, tb_lattice, n_pts)
 
-    n_paths = len(paths)
-    n_orb = TBL.NOrbitalsInUnitCell
+    return k, K, np.linalg.eigvalsh(E.transpose(2,0,1)).T
 
-    k = np.zeros(n_pts * n_paths)
-    E = np.zeros((n_orb, n_orb, n_pts * n_paths),dtype=complex)
 
-    k_length = 0. # accumulative k-path length
-
-    for pidx, (ki, kf) in enumerate(paths):
-        
-        # if this is the last section, add the endpoint!
-        if pidx == len(paths)-1:
-             endpoint = True
-        else: 
-            endpoint = False
+def energy_matrix_on_bz_paths(paths, TBL, n_pts=50):
 
-        s, e = pidx * n_pts, (pidx+1) * n_pts
-        E[:,:, s:e] = energy_matrix_on_bz_path(TBL.tb, ki, kf, n_pts)
+    """ Given a list of k-point paths compute the eigen energies along
+    the paths using n_pts discrete points for each sub-path. """
 
-        dk = np.dot(k_mat.T, (ki - kf))
-        a = np.linspace(0., 1., num=n_pts, endpoint=endpoint)
-        k_vec = a[:, None] * dk[None, :]
+    # -- Get the reciprocal lattice vectors
+    bz = BrillouinZone(TBL.bl)
+    k_mat = np.array(bz.units())
 
-        k[s:e] = np.linalg.norm(k_vec, axis=1) + k_length
-        k_length += np.linalg.norm(dk)
+    k_points, k, K = _bz_path_points(paths, k_mat, n_pts)
 
-    K = np.concatenate((k[::n_pts], [k[-1]])) # add last point for K-grid
+    # all sub-paths in one Fourier transform
+    E = tbl_hk(TBL, k_points).transpose(1,2,0)
 
     return k, K, E
 
@@ -94,40 +114,119 @@ def fract_ind_to_val(x,ind):
     int_ind_p1 = [int(indi)+1 for indi in ind]
     return x[int_ind] + (x[int_ind_p1] - x[int_ind])*(np.array(ind)-np.array(int_ind))
 
-def get_kx_ky_FS(X,Y,Z,tbl,k_trans_back,select=None,N_kxy=10,kz=0.0, fermi=0.0):
-
-    kx = np.linspace(0,0.5,N_kxy)
-    ky = np.linspace(0,0.5,N_kxy)
-
-    if select is None: select = np.array(range(tbl.NOrbitalsInUnitCell))
-
-    E_FS = np.zeros((tbl.NOrbitalsInUnitCell,N_kxy,N_kxy))
-    for kyi in range(N_kxy):
-        path_FS = [(Y/(N_kxy-1)*kyi +kz*Z, X+Y/(N_kxy-1)*kyi+kz*Z)]
-        du, du, E_FS[:,:,kyi] = energies_on_bz_paths(path_FS, tbl, n_pts=N_kxy)
-
-    contours = {}
-    FS_kx_ky = {}
-    char = {}
-    for ib in range(np.shape(E_FS)[0]):
-        contours[ib] = skimage.measure.find_contours(E_FS[ib,:,:],fermi)
-
-    i = 0   
-    for cb in contours:
-        for ci in range(np.shape(contours[cb])[0]):
-            FS_kx_ky[i] = np.vstack([fract_ind_to_val(kx,contours[cb][ci][:,0]),
-				fract_ind_to_val(ky,contours[cb][ci][:,1]),
-				kz*Z[2]*np.ones(len(contours[cb][ci][:,0]))]).T.reshape(-1,3)
-            char[i] = {}
-            for n in range(len(FS_kx_ky[i][:,0])):
-                p = np.dot(FS_kx_ky[i][n,:], k_trans_back)
-                MAT = energy_matrix_on_bz_path(tbl.tb, p,p, n_pts=1)
-                E, v = np.linalg.eigh(MAT[select[:,np.newaxis],select,0])
-                idx = np.argmin(np.abs(E))
-
-                char[i][n] = [np.round(np.real(v[ib,idx]*np.conjugate(v[ib,idx])),4) for ib in range(len(select))]
-            i += 1
-    return FS_kx_ky, char
+def get_kx_ky_FS(X, Y, Z, tbl, select=None, N_kxy=10, kz=0.0, fermi=0.0, mem=None):
+
+    """ Fermi-surface contours of the slices k = a X + b Y + kz Z, a, b in [0, 1], for one or
+    several kz and Fermi levels. H(k) of all slices is evaluated in one Fourier transform, and
+    H(k) and the eigenvectors of all contour vertices in a second batch. Contours are returned
+    as flat arrays: vertices 'k' (n_vertices, 3) as (kx, ky, kz Z_z) with kx, ky in [0, 0.5],
+    'offsets' (n_contours + 1) into the vertices, and per contour its 'band', 'kz' and 'fermi'.
+    'char' (n_vertices, len(select)) is the orbital character of the eigenstate of the selected
+    orbitals closest to the contour's Fermi level. """
+
+    R, H_R = hopping_array(tbl.hopping_dict())
+    n_orb = H_R.shape[1]
+    if select is None: select = np.arange(n_orb)
+    select = np.asarray(select)
+    kz = np.atleast_1d(np.asarray(kz, dtype=float))
+    fermi = np.atleast_1d(np.asarray(fermi, dtype=float))
+    X, Y, Z = (np.asarray(vec, dtype=float) for vec in (X, Y, Z))
+
+    a = np.linspace(0., 1., N_kxy)
+    k_grid = a[None,:,None,None] * X + a[None,None,:,None] * Y + kz[:,None,None,None] * Z
+    E_FS = np.linalg.eigvalsh(fourier_hk(R, H_R, k_grid.reshape(-1, 3), mem)).reshape(len(kz), N_kxy, N_kxy, n_orb)
+
+    # contours in fractional grid coordinates
+    frac, offsets, band, kz_c, fermi_c = [], [0], [], [], []
+    for ikz, ef, ib in itertools.product(range(len(kz)), range(len(fermi)), range(n_orb)):
+        for contour in skimage.measure.find_contours(E_FS[ikz,:,:,ib], fermi[ef]):
+            frac.append(contour / (N_kxy - 1))
+            offsets.append(offsets[-1] + len(contour))
+            band.append(ib)
+            kz_c.append(kz[ikz])
+            fermi_c.append(fermi[ef])
+
+    offsets, band = np.array(offsets), np.array(band, dtype=int)
+    kz_c, fermi_c = np.array(kz_c), np.array(fermi_c)
+    if len(band) == 0:
+        return {'k': np.zeros((0, 3)), 'offsets': offsets, 'band': band, 'kz': kz_c, 'fermi': fermi_c,
+                'char': np.zeros((0, len(select)))}
+
+    frac = np.concatenate(frac)
+    counts = np.diff(offsets)
+    kz_v, fermi_v = np.repeat(kz_c, counts), np.repeat(fermi_c, counts)
+
+    # eigenvectors of the selected orbitals at all vertices in one batch
+    k_points = frac[:,0,None] * X + frac[:,1,None] * Y + kz_v[:,None] * Z
+    H_k = fourier_hk(R, H_R, k_points, mem)[:, select[:,None], select]
+    E, v = np.linalg.eigh(H_k)
+    idx = np.argmin(np.abs(E - fermi_v[:,None]), axis=1)
+    v_F = np.take_along_axis(v, idx[:,None,None], axis=2)[:,:,0]
+    char = np.round(np.abs(v_F)**2, 4)
+
+    k = np.column_stack([0.5 * frac, kz_v * Z[2]])
+
+    return {'k': k, 'offsets': offsets, 'band': band, 'kz': kz_c, 'fermi': fermi_c, 'char': char}
+
+def bz_grid_energies(R, H_R, n_k, time_reversal=True, mem=None):
+
+    """ Band energies on the full n_k^3 grid k = (i - n_k//2) / n_k, in units of the reciprocal
+    lattice vectors, returned as (n_k, n_k, n_k, n_orb) with Gamma at index n_k//2. H(k) is built
+    and diagonalized in chunks sized to the memory budget. With time_reversal, E(-k) = E(k) is
+    used and only one k-point of every (k, -k) pair is diagonalized. """
+
+    mem = max_mem if mem is None else mem
+    n_R, n_orb = H_R.shape[:2]
+    idx = np.arange(n_k)
+    grid = np.stack(np.meshgrid(idx, idx, idx, indexing='ij'), axis=-1).reshape(-1, 3)
+    # flat index of -k
+    minus = ((2 * (n_k // 2) - grid) % n_k) @ np.array([n_k**2, n_k, 1])
+    flat = np.arange(n_k**3)
+    irred = flat[flat <= minus] if time_reversal else flat
+
+    # phases, H(k) and the eigensolver workspace of a chunk are alive at the same time
+    chunk = int(max(1, mem // ((n_R + 3 * n_orb**2) * np.dtype(complex).itemsize)))
+    E = np.empty((n_k**3, n_orb))
+    for start in range(0, len(irred), chunk):
+        ik = irred[start:start + chunk]
+        k_points = (grid[ik] - n_k // 2) / n_k
+        E[ik] = np.linalg.eigvalsh(fourier_hk(R, H_R, k_points, mem))
+    if time_reversal:
+        E[minus[irred]] = E[irred]
+
+    return E.reshape(n_k, n_k, n_k, n_orb)
+
+def get_FS_3D(tbl, n_k=50, fermi=0.0, step_size=1, time_reversal=True, mem=None):
+
+    """ Fermi isosurfaces of all bands of a TBLattice over the whole BZ by marching cubes on
+    an n_k^3 grid (see bz_grid_energies). step_size > 1 decimates the surfaces. Vertices are
+    cartesian, with surfaces of all bands in flat arrays: 'verts' (n_verts, 3), 'faces'
+    (n_faces, 3) indexing into verts, 'vert_offsets' / 'face_offsets' per surface and its 'band'. """
+
+    R, H_R = hopping_array(tbl.hopping_dict())
+    k_mat = np.array(BrillouinZone(tbl.bl).units())
+    E = bz_grid_energies(R, H_R, n_k, time_reversal, mem)
+    # close the surfaces at the zone boundary with the periodic image of the first plane
+    E = np.pad(E, ((0, 1), (0, 1), (0, 1), (0, 0)), mode='wrap')
+
+    verts, faces, vert_offsets, face_offsets, band = [], [], [0], [0], []
+    for ib in range(E.shape[-1]):
+        if not E[...,ib].min() < fermi < E[...,ib].max():
+            continue
+        v, f, _, _ = skimage.measure.marching_cubes(E[...,ib], level=fermi, spacing=(1. / n_k,) * 3,
+                                                    step_size=step_size, allow_degenerate=False)
+        verts.append((v - (n_k // 2) / n_k) @ k_mat)
+        faces.append(f + vert_offsets[-1])
+        vert_offsets.append(vert_offsets[-1] + len(v))
+        face_offsets.append(face_offsets[-1] + len(f))
+        band.append(ib)
+
+    if not band:
+        return {'verts': np.zeros((0, 3)), 'faces': np.zeros((0, 3), dtype=int), 'vert_offsets': np.array(vert_offsets),
+                'face_offsets': np.array(face_offsets), 'band': np.array(band, dtype=int)}
+
+    return {'verts': np.concatenate(verts), 'faces': np.concatenate(faces), 'vert_offsets': np.array(vert_offsets),
+            'face_offsets': np.array(face_offsets), 'band': np.array(band, dtype=int)}
 
 def load_data_generic(path, name='w2w'):
     hopping, num_wann = parse_hopping_from_wannier90_hr_dat(path + name +'_hr.dat')
@@ -0,0 +1,146 @@
+"""
+Server-side store for large arrays. Arrays are written once as .npy files and memory-mapped on
+access, so that dcc.Store objects only carry small handles instead of nested JSON lists.
+Files are grouped per session and named by a content hash (the dataset id).
+"""
+
+import os
+import uuid
+import tempfile
+import threading
+import numpy as np
+
+from tools.cache import hash_key
+
+store_dir = os.environ.get('SPECTROMETER_STORE_DIR', os.path.join(tempfile.gettempdir(), 'triqs_spectrometer_store'))
+# total size of the store before the least recently used files are removed
+max_bytes = int(os.environ.get('SPECTROMETER_STORE_BYTES', 2**32))
+# bytes a process writes before it scans the store for eviction again, so that a save does not walk
+# the whole store and the store exceeds max_bytes by at most this much per process
+evict_bytes = max(max_bytes // 16, 1)
+
+_lock = threading.Lock()
+_written = 0
+
+def session(data):
+    """
+    Session id of a data dict (tb_data, sigma_data, ...), created on first use
+    """
+
+    if 'session' not in data:
+        data['session'] = uuid.uuid4().hex
+    return data['session']
+
+def is_handle(value):
+    return isinstance(value, dict) and value.get('array_store', False)
+
+def _path(handle):
+    return os.path.join(store_dir, handle['session'], handle['id'] + '.npy')
+
+def save(array, session, name='array'):
+    """
+    Store an array for a session and return its handle
+    """
+
+    array = np.ascontiguousarray(array)
+    handle = {'array_store': True, 'session': session, 'id': '{}-{}'.format(name, hash_key(array)[:16]),
+              'shape': list(array.shape), 'dtype': str(array.dtype)}
+    path = _path(handle)
+    if os.path.exists(path):
+        os.utime(path)
+        return handle
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file first, so that readers never see a partial array
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with open(tmp_path, 'wb') as fd:
+        np.save(fd, array)
+    os.replace(tmp_path, path)
+    _add_written(array.nbytes)
+
+    return handle
+
+def load(value):
+    """
+    Array behind a handle as a read-only memory map. Plain (nested) lists, as in older
+    configs, are converted to arrays.
+    """
+
+    if not is_handle(value):
+        return np.array(value)
+
+    path = _path(value)
+    if not os.path.exists(path):
+        raise KeyError('array {} of session {} is no longer in the store'.format(value['id'], value['session']))
+    os.utime(path)
+    return np.asarray(np.load(path, mmap_mode='r'))
+
+def load_complex(re_value, im_value):
+    """
+    Complex array from separately stored real and imaginary parts
+    """
+
+    return load(re_value) + 1j * load(im_value)
+
+def save_hopping(hopping, session):
+    """
+    Store a hopping dict {R: H(R)} as one stacked (n_R, n_wf, n_wf) array
+    """
+
+    R = [list(map(int, eval(key) if isinstance(key, str) else key)) for key in hopping.keys()]
+    return {'R': R, 'H': save(np.array(list(hopping.values())), session, 'hopping')}
+
+def load_hopping(value):
+    """
+    Hopping dict {R: H(R)} from save_hopping or from the older {str(R): list} form
+    """
+
+    if 'H' in value and is_handle(value['H']):
+        H = load(value['H'])
+        return {tuple(R): np.array(H[idx], dtype=complex) for idx, R in enumerate(value['R'])}
+    return {eval(key): np.array(H, dtype=complex) for key, H in value.items()}
+
+def _add_written(nbytes):
+    global _written
+    with _lock:
+        _written += nbytes
+        if _written < evict_bytes:
+            return
+        _written = 0
+    _evict()
+
+def _evict():
+    with _lock:
+        files = []
+        for root, _, names in os.walk(store_dir):
+            for name in names:
+                if name.endswith('.npy'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+def content_id(value):
+    """
+    value with every handle replaced by its content id, to key shared caches independently of the session
+    """
+
+    if is_handle(value):
+        return value['id']
+    if isinstance(value, dict):
+        return {key: content_id(item) for key, item in value.items() if key != 'session'}
+    if isinstance(value, (list, tuple)):
+        return [content_id(item) for item in value]
+    return value
@@ -0,0 +1,310 @@
+"""
+Server-side caches for computed results, keyed on a content hash of their inputs. LRUCache lives in
+the memory of one process, DiskCache is shared by all worker processes through a local directory.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import tempfile
+import resource
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# all caches by name, for monitoring
+caches = {}
+
+def _update_hash(h, obj):
+    if isinstance(obj, np.ndarray):
+        h.update('a{}{}'.format(obj.dtype, obj.shape).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    elif isinstance(obj, dict):
+        h.update('d{}'.format(len(obj)).encode())
+        for key in sorted(obj, key=str):
+            _update_hash(h, key)
+            _update_hash(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update('l{}'.format(len(obj)).encode())
+        for item in obj:
+            _update_hash(h, item)
+    else:
+        h.update(repr(obj).encode())
+        h.update(b';')
+
+def hash_key(*args):
+    """
+    Content hash of (nested) dicts, lists, tuples, numpy arrays and scalars
+    """
+
+    h = hashlib.sha1()
+    _update_hash(h, args)
+    return h.hexdigest()
+
+def nbytes(value):
+    """
+    Approximate memory footprint of a cached value
+    """
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(nbytes(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(nbytes(item) for item in value)
+    return sys.getsizeof(value)
+
+class LRUCache(object):
+    """
+    Least-recently-used cache evicting entries once their total size exceeds max_bytes
+    """
+
+    def __init__(self, name, max_bytes=2**28):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        caches[name] = self
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self.hits += 1
+                self._data.move_to_end(key)
+                return self._data[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = nbytes(value)
+        with self._lock:
+            if key in self._data:
+                self._bytes -= self._data.pop(key)[1]
+            self._data[key] = (value, size)
+            self._bytes += size
+            # always keep the newest entry, even if it alone exceeds the budget
+            while self._bytes > self.max_bytes and len(self._data) > 1:
+                _, (_, evicted) = self._data.popitem(last=False)
+                self._bytes -= evicted
+        return value
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'entries': len(self._data), 'bytes': self._bytes, 'max_bytes': self.max_bytes}
+
+cache_dir = os.environ.get('SPECTROMETER_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'triqs_spectrometer_cache'))
+# total size of each disk cache before the least recently used entries are removed
+max_disk_bytes = int(os.environ.get('SPECTROMETER_CACHE_BYTES', 2**32))
+
+def _json_default(obj):
+    if hasattr(obj, 'item'):
+        return obj.item()
+    raise TypeError('{} is not JSON serializable'.format(type(obj)))
+
+class DiskCache(object):
+    """
+    Cache shared by all processes on a host. Every entry is a directory holding numeric arrays as .npy
+    files, memory-mapped on access, and everything else in a JSON file. Values are single items or tuples
+    of items. Entries are evicted least-recently-used once their total size exceeds max_bytes.
+    Hit/miss counters are per process.
+    """
+
+    def __init__(self, name, max_bytes=None):
+        self.name = name
+        self.max_bytes = max_disk_bytes if max_bytes is None else max_bytes
+        self.path = os.path.join(cache_dir, name)
+        self.hits = 0
+        self.misses = 0
+        caches[name] = self
+
+    def _entry(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key, default=None):
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry, 'meta.json')) as fd:
+                meta = json.load(fd)
+            items = []
+            for item in meta['items']:
+                if 'npy' in item:
+                    items.append(np.asarray(np.load(os.path.join(entry, item['npy']), mmap_mode='r')))
+                else:
+                    items.append(np.array(item['json']) if item['array'] else item['json'])
+            os.utime(entry)
+        except (FileNotFoundError, ValueError):
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        return tuple(items) if meta['tuple'] else items[0]
+
+    def put(self, key, value):
+        items = value if isinstance(value, tuple) else (value,)
+        meta = {'tuple': isinstance(value, tuple), 'items': []}
+
+        # write into a temporary directory first, so that readers never see a partial entry
+        os.makedirs(self.path, exist_ok=True)
+        tmp_entry = os.path.join(self.path, '.{}.tmp'.format(uuid.uuid4().hex))
+        os.makedirs(tmp_entry)
+        for idx, item in enumerate(items):
+            if isinstance(item, np.ndarray) and item.dtype != object:
+                np.save(os.path.join(tmp_entry, '{}.npy'.format(idx)), np.ascontiguousarray(item))
+                meta['items'].append({'npy': '{}.npy'.format(idx)})
+            else:
+                is_array = isinstance(item, np.ndarray)
+                meta['items'].append({'json': item.tolist() if is_array else item, 'array': is_array})
+        with open(os.path.join(tmp_entry, 'meta.json'), 'w') as fd:
+            json.dump(meta, fd, default=_json_default)
+
+        try:
+            os.rename(tmp_entry, self._entry(key))
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        self._evict()
+
+        return value
+
+    def __contains__(self, key):
+        return os.path.exists(os.path.join(self._entry(key), 'meta.json'))
+
+    def remove(self, key):
+        shutil.rmtree(self._entry(key), ignore_errors=True)
+
+    def _scan(self):
+        entries = []
+        if not os.path.isdir(self.path):
+            return entries
+        for key in os.listdir(self.path):
+            if key.startswith('.'):
+                continue
+            entry = self._entry(key)
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                entries.append((os.stat(entry).st_mtime, size, entry))
+            except FileNotFoundError:
+                continue
+        return entries
+
+    def _evict(self):
+        entries = self._scan()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+    def __len__(self):
+        return len(self._scan())
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def stats(self):
+        entries = self._scan()
+        requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'entries': len(entries), 'bytes': sum(size for _, size, _ in entries), 'max_bytes': self.max_bytes,
+                'path': self.path}
+
+def stats():
+    """
+    Hit/miss counters and sizes of all caches
+    """
+
+    return {name: cache.stats() for name, cache in caches.items()}
+
+# every process writes its stats here as <pid>.json, at most once per stats_interval seconds
+stats_dir = os.path.join(cache_dir, 'stats')
+stats_interval = 10.0
+_stats_written = 0.0
+
+def write_stats(role, force=False):
+    """
+    Write the cache stats and the peak memory use of this process to stats_dir, so that the stats
+    of all gunicorn workers and pool processes can be read from any of them
+    """
+
+    global _stats_written
+    now = time.time()
+    if not force and now - _stats_written < stats_interval:
+        return
+    _stats_written = now
+
+    os.makedirs(stats_dir, exist_ok=True)
+    path = os.path.join(stats_dir, '{}.json'.format(os.getpid()))
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with open(tmp_path, 'w') as fd:
+        json.dump({'pid': os.getpid(), 'role': role, 'time': now, 'caches': stats(),
+                   'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}, fd, default=_json_default)
+    os.replace(tmp_path, path)
+
+def read_stats():
+    """
+    Stats of all live processes written by write_stats, the files of ended processes are removed
+    """
+
+    processes = []
+    names = os.listdir(stats_dir) if os.path.isdir(stats_dir) else []
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(stats_dir, name)
+        try:
+            os.kill(int(name[:-5]), 0)
+        except ProcessLookupError:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+        except (ValueError, PermissionError):
+            pass
+        try:
+            with open(path) as fd:
+                processes.append(json.load(fd))
+        except (FileNotFoundError, ValueError):
+            continue
+
+    return sorted(processes, key=lambda process: process['pid'])
+
+def aggregate_stats(processes):
+    """
+    Hit/miss counters of every cache summed over the processes of read_stats, and their total peak memory use
+    """
+
+    totals = {}
+    for process in processes:
+        for name, stats in process['caches'].items():
+            total = totals.setdefault(name, {'hits': 0, 'misses': 0})
+            total['hits'] += stats['hits']
+            total['misses'] += stats['misses']
+    for total in totals.values():
+        requests = total['hits'] + total['misses']
+        total['hit_rate'] = total['hits'] / requests if requests else 0.0
+
+    return {'processes': processes, 'caches': totals,
+            'maxrss_kb': sum(process['maxrss_kb'] for process in processes)}
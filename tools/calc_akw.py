@@ -13,8 +13,9 @@ from matplotlib.ticker import MaxNLocator, AutoMinorLocator
 from matplotlib.colors import LogNorm
 from matplotlib import cm, colors
 from scipy.optimize import brentq
-from scipy.interpolate import interp1d
+from scipy.interpolate import interp1d, CubicSpline, PchipInterpolator
 import itertools
+import time
 import matplotlib.pyplot as plt
 
 # triqs
@@ -23,26 +24,211 @@ from tools.TB_functions import *
 from h5 import HDFArchive
 from triqs.gf import BlockGf
 from triqs.gf import GfReFreq, MeshReFreq
-from triqs.utility.dichotomy import dichotomy
 import tools.tools as tools
+from tools.cache import LRUCache, DiskCache, hash_key
+import tools.array_store as store
 
 upscale = lambda quantity, n_orb: quantity * np.identity(n_orb)
 
-def calc_alatt(tb_data, sigma_data, akw_data, solve=False, band_basis=False):
+# memory budget in bytes for one chunk of the batched resolvent
+max_mem = 2**28
+
+def _chunk_size(n_items, item_bytes, mem=None):
+    """
+    Number of items per chunk such that one chunk stays within the memory budget
+    """
+
+    mem = max_mem if mem is None else mem
+    return int(max(1, min(n_items, mem // max(item_bytes, 1))))
+
+def rotate_sigma(sigma_w, e_vecs, mem=None):
+    """
+    Rotate sigma (n_w, n_orb, n_orb) into the band basis of each k-point in e_vecs (n_k, n_orb, n_orb),
+    U_k^dagger sigma(w) U_k as one contraction (with an optimized contraction path) per chunk of k-points.
+    Returns (n_k, n_w, n_orb, n_orb).
+    """
+
+    n_k, n_orb = e_vecs.shape[:2]
+    e_vecs_dag = e_vecs.conjugate().transpose(0,2,1)
+
+    # the intermediate product and the result chunk are alive at the same time
+    chunk = _chunk_size(n_k, 2 * sigma_w.size * np.dtype(complex).itemsize, mem)
+    sigma_rot = np.empty((n_k,) + sigma_w.shape, dtype=complex)
+    for start in range(0, n_k, chunk):
+        stop = min(start + chunk, n_k)
+        sigma_rot[start:stop] = np.einsum('kij,wjl,klm->kwim', e_vecs_dag[start:stop], sigma_w, e_vecs[start:stop], optimize=True)
+
+    return sigma_rot
+
+def alatt_inverse(e_k, sigma_w, w_mesh, eta, mu, e_vecs=None, mem=None):
+    """
+    Batched A(k,w) = -1/pi Tr Im G(k,w) for H(k) given as (n_k, n_orb, n_orb) and sigma as (n_w, n_orb, n_orb).
+    The resolvent is built for chunks of k-points sized to the memory budget and only its trace is kept.
+    If e_vecs (n_k, n_orb, n_orb) are given, sigma is rotated into the band basis of each k-point.
+    """
+
+    n_k, n_orb = e_k.shape[:2]
+    n_w = len(w_mesh)
+    # w + i eta + mu is the same for all k
+    w_term = (np.asarray(w_mesh) + 1j * eta + mu)[:, None, None] * np.eye(n_orb)
+
+    # the resolvent, its inverse and the (optional) rotated sigma with its intermediate are alive at the same time
+    n_arrays = 2 if e_vecs is None else 4
+    chunk = _chunk_size(n_k, n_arrays * n_w * n_orb**2 * np.dtype(complex).itemsize, mem)
+    alatt_k_w = np.zeros((n_k, n_w))
+    for start in range(0, n_k, chunk):
+        stop = min(start + chunk, n_k)
+        sigma_k = sigma_w[None] if e_vecs is None else rotate_sigma(sigma_w, e_vecs[start:stop], mem)
+        g_inv = w_term[None] - e_k[start:stop, None] - sigma_k
+        alatt_k_w[start:stop] = -1.0/np.pi * np.trace(np.linalg.inv(g_inv), axis1=2, axis2=3).imag
+
+    return alatt_k_w
+
+def sigma_structure(sigma_w, tol=1e-10):
+    """
+    Classify sigma (n_w, n_orb, n_orb) as 'scalar' (proportional to identity), 'diagonal' or 'full'
+    """
+
+    diag = np.diagonal(sigma_w, axis1=1, axis2=2)
+    if np.any(np.abs(sigma_w - diag[..., None] * np.eye(sigma_w.shape[1])) > tol):
+        return 'full'
+    if np.any(np.abs(diag - diag[:, :1]) > tol):
+        return 'diagonal'
+    return 'scalar'
+
+def _is_diagonal(e_k, tol=1e-10):
+    return not np.any(np.abs(e_k - np.diagonal(e_k, axis1=1, axis2=2)[..., None] * np.eye(e_k.shape[1])) > tol)
+
+def alatt_eigen(eps_k, sigma_diag, w_mesh, eta, mu, mem=None):
+    """
+    Closed-form A(k,w) for eigenvalues eps_k (n_k, n_orb) and a sigma (n_w, n_orb) that is diagonal
+    in the same basis, i.e. no matrix inversion per k and w
+    """
+
+    n_k, n_orb = eps_k.shape
+    n_w = len(w_mesh)
+    w_term = (np.asarray(w_mesh) + 1j * eta + mu)[:, None] - sigma_diag
+
+    chunk = _chunk_size(n_k, 2 * n_w * n_orb * np.dtype(complex).itemsize, mem)
+    alatt_k_w = np.zeros((n_k, n_w))
+    for start in range(0, n_k, chunk):
+        stop = min(start + chunk, n_k)
+        alatt_k_w[start:stop] = -1.0/np.pi * np.sum(1.0 / (w_term[None] - eps_k[start:stop, None]), axis=2).imag
+
+    return alatt_k_w
+
+def spectral_function(e_k, sigma_w, w_mesh, eta, mu, e_vecs=None, mem=None):
+    """
+    A(k,w) for H(k) (n_k, n_orb, n_orb) and sigma (n_w, n_orb, n_orb). If sigma is proportional to
+    the identity, or diagonal together with H(k), the closed-form eigenvalue path is taken instead of
+    inverting the resolvent. Returns A(k,w) and the name of the path taken ('eigen', 'diagonal' or 'inverse').
+    """
+
+    structure = sigma_structure(sigma_w)
+    if structure == 'scalar':
+        # a scalar sigma is invariant under the band-basis rotation
+        eps_k = np.diagonal(e_k, axis1=1, axis2=2).real if _is_diagonal(e_k) else np.linalg.eigvalsh(e_k)
+        return alatt_eigen(eps_k, np.diagonal(sigma_w, axis1=1, axis2=2), w_mesh, eta, mu, mem), 'eigen'
+    if structure == 'diagonal' and e_vecs is None and _is_diagonal(e_k):
+        return alatt_eigen(np.diagonal(e_k, axis1=1, axis2=2), np.diagonal(sigma_w, axis1=1, axis2=2),
+                           w_mesh, eta, mu, mem), 'diagonal'
+
+    return alatt_inverse(e_k, sigma_w, w_mesh, eta, mu, e_vecs, mem), 'inverse'
+
+def resolvent_poles(e_k, sigma_w, mem=None, eps_k=None):
+    """
+    Eigenvalues lambda_n(k,w) of H(k) + sigma(w) for H(k) (n_k, n_orb, n_orb) and sigma (n_w, n_orb, n_orb)
+    as (n_k, n_w, n_orb). Since Tr G(k,w) = sum_n 1 / (w + i eta + mu - lambda_n(k,w)), A(k,w) follows
+    from them for any eta and mu without further matrix operations, see alatt_poles. A sigma proportional
+    to the identity, or diagonal together with H(k), only shifts the eigenvalues eps_k of H(k).
+    """
+
+    structure = sigma_structure(sigma_w)
+    sigma_diag = np.diagonal(sigma_w, axis1=1, axis2=2)
+    if structure == 'scalar':
+        if eps_k is None:
+            eps_k = np.diagonal(e_k, axis1=1, axis2=2).real if _is_diagonal(e_k) else np.linalg.eigvalsh(e_k)
+        return eps_k[:, None, :] + sigma_diag[None]
+    if structure == 'diagonal' and _is_diagonal(e_k):
+        return np.diagonal(e_k, axis1=1, axis2=2).real[:, None, :] + sigma_diag[None]
+
+    n_k, n_orb = e_k.shape[:2]
+    n_w = sigma_w.shape[0]
+    chunk = _chunk_size(n_k, 2 * n_w * n_orb**2 * np.dtype(complex).itemsize, mem)
+    poles = np.empty((n_k, n_w, n_orb), dtype=complex)
+    for start in range(0, n_k, chunk):
+        stop = min(start + chunk, n_k)
+        poles[start:stop] = np.linalg.eigvals(e_k[start:stop, None] + sigma_w[None])
+
+    return poles
+
+def alatt_poles(poles, w_mesh, eta, mu, mem=None):
+    """
+    A(k,w) = -1/pi Im sum_n 1 / (w + i eta + mu - lambda_n(k,w)) from the poles (n_k, n_w, n_orb) of resolvent_poles
+    """
+
+    n_k, n_w, n_orb = poles.shape
+    w_term = np.asarray(w_mesh) + 1j * eta + mu
+
+    chunk = _chunk_size(n_k, 2 * n_w * n_orb * np.dtype(complex).itemsize, mem)
+    alatt_k_w = np.zeros((n_k, n_w))
+    for start in range(0, n_k, chunk):
+        stop = min(start + chunk, n_k)
+        alatt_k_w[start:stop] = -1.0/np.pi * np.sum(1.0 / (w_term[None, :, None] - poles[start:stop]), axis=2).imag
+
+    return alatt_k_w
+
+def qp_dispersion(e_k, sigma_w, w_mesh, mu, mem=None):
+    """
+    Quasiparticle poles for H(k) (n_k, n_orb, n_orb) and sigma (n_w, n_orb, n_orb): the frequencies at which
+    the eigenvalues of w + mu - H(k) - Re sigma(w) change sign. Eigenvalues are computed for the full (k, w)
+    grid in chunks, and the first sign change along w of each band is located by linear interpolation
+    between mesh points. Returns (n_k, n_orb), zero where a band has no pole inside the mesh.
+    """
+
+    n_k, n_orb = e_k.shape[:2]
+    w_mesh = np.asarray(w_mesh, dtype=float)
+    n_w = len(w_mesh)
+    # hermitian part of sigma, i.e. the real part on the diagonal
+    sigma_h = 0.5 * (sigma_w + sigma_w.conjugate().transpose(0,2,1))
+    w_term = (w_mesh + mu)[:, None, None] * np.eye(n_orb) - sigma_h
+
+    chunk = _chunk_size(n_k, 2 * n_w * n_orb**2 * np.dtype(complex).itemsize, mem)
+    poles = np.zeros((n_k, n_orb))
+    for start in range(0, n_k, chunk):
+        stop = min(start + chunk, n_k)
+        e_val = np.linalg.eigvalsh(w_term[None] - e_k[start:stop, None])
+
+        sign_change = np.signbit(e_val[:, 1:]) != np.signbit(e_val[:, :-1])
+        iw = np.argmax(sign_change, axis=1)[:, None, :]
+        e_lo = np.take_along_axis(e_val, iw, axis=1)[:, 0]
+        e_hi = np.take_along_axis(e_val, iw + 1, axis=1)[:, 0]
+        w_lo, w_hi = w_mesh[iw[:, 0]], w_mesh[iw[:, 0] + 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            w_pole = w_lo - e_lo * (w_hi - w_lo) / (e_hi - e_lo)
+        poles[start:stop] = np.where(np.any(sign_change, axis=1), w_pole, 0.0)
+
+    return poles
+
+def _k_block(array, n_orb, k_range=None):
+    """
+    k-points k_range = (start, stop) of the flattened k-mesh of an (n_orb, n_orb, ...) array as
+    (n_k, n_orb, n_orb). Only the block is read from a memory-mapped array.
+    """
+
+    array = array.reshape(n_orb, n_orb, -1)
+    start, stop = (0, array.shape[2]) if k_range is None else k_range
+    return array[:,:,start:stop].transpose(2,0,1)
+
+def alatt_mu(tb_data, sigma_data, akw_data):
+    """
+    Chemical potential of the interacting lattice for calc_alatt, i.e. the one giving tb_data['n_elect']
+    electrons with sigma, starting from akw_data['dmft_mu']
+    """
 
-    # read data
     n_orb = tb_data['n_wf']
-    eta = upscale(1j * akw_data['eta'], n_orb)
     w_dict = sigma_data['w_dict']
-    w_vec = np.array(w_dict['w_mesh'])[:,None,None] * np.eye(n_orb)
-    e_mat = np.array(tb_data['e_mat'])
-    n_k = e_mat.shape[2]
-
-    # sigma
-    sigma = np.array(sigma_data['sigma_re']) + 1j * np.array(sigma_data['sigma_im'])
-    sigma_rot = sigma.copy()
-    if band_basis:
-        e_vecs = np.array(tb_data['evecs_re']) + 1j * np.array(tb_data['evecs_im'])
+    sigma = store.load_complex(sigma_data['sigma_re'], sigma_data['sigma_im'])
 
     # TODO add local
     add_local = [0.] * tb_data['n_wf']
@@ -50,64 +236,120 @@ def calc_alatt(tb_data, sigma_data, akw_data, solve=False, band_basis=False):
     Sigma_triqs = GfReFreq(mesh=triqs_mesh , target_shape = [n_orb,n_orb])
     Sigma_triqs.data[:,:,:] = sigma.transpose((2,0,1))
     
-    new_mu = calc_mu(tb_data, tb_data['n_elect'],  tb_data['add_spin'], add_local, 
-                     mu_guess= akw_data['dmft_mu'], Sigma=Sigma_triqs, eta=akw_data['eta'])
+    return calc_mu(tb_data, tb_data['n_elect'],  tb_data['add_spin'], add_local, 
+                   mu_guess= akw_data['dmft_mu'], Sigma=Sigma_triqs, eta=akw_data['eta'])
+
+def alatt_chunk(tb_data, sigma_data, akw_data, mu, k_range=None, solve=False, band_basis=False):
+    """
+    A(k,w), or the quasiparticle poles with solve, for the k-points k_range of tb_data['e_mat'] and
+    mu = dft_mu - dmft_mu. Returns the result and the evaluation path.
+    """
+
+    n_orb = tb_data['n_wf']
+    w_dict = sigma_data['w_dict']
+    e_k = _k_block(store.load(tb_data['e_mat']), n_orb, k_range)
+    sigma = store.load_complex(sigma_data['sigma_re'], sigma_data['sigma_im'])
+
+    if solve:
+        # quasiparticle poles, located to sub-grid accuracy
+        return qp_dispersion(e_k, sigma.transpose(2,0,1), w_dict['w_mesh'], mu), 'solve'
+
+    # if evecs are given sigma is transformed into band basis per k-point
+    e_vecs = None
+    if band_basis:
+        e_vecs = _k_block(store.load(tb_data['evecs_re']), n_orb, k_range) + 1j * _k_block(store.load(tb_data['evecs_im']), n_orb, k_range)
+    return spectral_function(e_k, sigma.transpose(2,0,1), w_dict['w_mesh'], akw_data['eta'], mu, e_vecs=e_vecs)
+
+def calc_alatt(tb_data, sigma_data, akw_data, solve=False, band_basis=False):
+
+    new_mu = alatt_mu(tb_data, sigma_data, akw_data)
 
     # now subtract the new mu from the dft mu to get the DMFT mu (the hoppings below are already cleaned from the dft_mu)
-    mu = upscale(float(tb_data['dft_mu']) - new_mu, n_orb)
+    mu = float(tb_data['dft_mu']) - new_mu
 
+    alatt_k_w, path = alatt_chunk(tb_data, sigma_data, akw_data, mu, solve=solve, band_basis=band_basis)
     if not solve:
+        akw_data['akw_path'] = path
+        print('A(k,w) evaluated via {} path'.format(path))
 
-        def invert_and_trace(w, eta, mu, e_mat, sigma):
-            # inversion is automatically vectorized over first axis of 3D array (omega first index now)
-            Glatt =  np.linalg.inv(w + eta[None,...] + mu[None,...] - e_mat[None,...] - sigma.transpose(2,0,1) )
-            return -1.0/np.pi * np.trace( Glatt, axis1=1, axis2=2).imag
-
-        alatt_k_w = np.zeros((n_k, w_dict['n_w']))
-        for ik in range(n_k):
-            # if evecs are given transform sigma into band basis
-            if band_basis:
-                sigma_rot = np.einsum('ij,jkw->ikw',
-                                      e_vecs[:,:,ik].conjugate().transpose(),
-                                      np.einsum('ijw,jk->ikw', sigma, e_vecs[:,:,ik]))
-            alatt_k_w[ik, :] = invert_and_trace(w_vec, eta, mu, e_mat[:,:,ik], sigma_rot)
+    return alatt_k_w, new_mu
+
+def _kslice_crossings(e_mat, sigma_0, eta, mu):
+    """
+    Fermi-level crossings of the bands of w=0 + mu - H(k) - Sigma(0) on one (n_kx, n_ky) slice, found
+    along both k directions. Returns (n_kx, n_ky, n_orb), NaN where there is no crossing.
+    """
+
+    n_orb, _, n_kx, n_ky = e_mat.shape
+    assert n_kx == n_ky, 'Not implemented for N_kx != N_ky'
+    alatt_k_w = np.zeros((n_kx, n_ky, n_orb))
+    for it in range(2):
+        kslice = np.zeros((n_kx, n_ky, n_orb))
+        if it == 0:
+            kslice_interp = lambda ik, orb: interp1d(range(n_kx), kslice[:, ik, orb])
+        else:
+            kslice_interp = lambda ik, orb: interp1d(range(n_kx), kslice[ik, :, orb])
+
+        for ik1 in range(n_kx):
+            e_temp = e_mat[:,:,:,ik1] if it == 0 else e_mat[:,:,ik1,:]
+            for ik2 in range(n_kx):
+                e_val, _ = np.linalg.eigh( eta + mu - e_temp[:,:,ik2] - sigma_0)
+                k1, k2 = [ik2, ik1] if it == 0 else [ik1, ik2]
+                kslice[k1, k2] = e_val
             
-    else:
-        alatt_k_w = np.zeros((n_k, n_orb))
-        kslice = np.zeros((w_dict['n_w'], n_orb))
-        kslice_interp = lambda orb: interp1d(w_dict['w_mesh'], kslice[:, orb])
-
-        for ik in range(n_k):
-            for iw, w in enumerate(w_dict['w_mesh']):
-                np.fill_diagonal(sigma[:,:,iw], np.diag(sigma[:,:,iw]).real)
-                kslice[iw], _ = np.linalg.eigh( upscale(w, n_orb) + eta + mu - e_mat[:,:,ik] - sigma[:,:,iw])
-                
             for orb in range(n_orb):
-                w_min, w_max = w_dict['window']
                 try:
-                    x0 = brentq( kslice_interp(orb), w_min, w_max)
-                    w_bin = int( (x0 - w_min) / ((w_max - w_min)/ w_dict['n_w']) )
-                    alatt_k_w[ik, orb] = w_dict['w_mesh'][w_bin]
+                    x0 = brentq( kslice_interp(ik1, orb), 0, n_kx - 1)
+                    k1, k2 = [int(np.floor(x0)), ik1] if it == 0 else [ik1, int(np.floor(x0))]
+                    alatt_k_w[k1, k2, orb] += 1
                 except ValueError:
                     pass
 
-    return alatt_k_w, new_mu
+    alatt_k_w[np.where(alatt_k_w > 1)] = 1
+    alatt_k_w[np.where(alatt_k_w < 1)] = None
+    for ik1 in range(n_ky):
+        for orb in range(n_orb):
+            try:
+                cross = np.where(alatt_k_w[:,ik1,orb] == 1)[0]
+                for idx in cross:
+                    alatt_k_w[idx, ik1, orb] = np.linspace(0, 1, n_ky)[ik1 + 1]
+            except(IndexError):
+                pass
+
+    return alatt_k_w
+
+def kslice_chunk(tb_data, sigma_data, akw_data, mu, k_range=None):
+    """
+    A(k, w=0) for the k-points k_range of the flattened k-slice(s) tb_data['e_mat'] and mu = dft_mu - dmft_mu.
+    Returns the (n_k,) result and the evaluation path.
+    """
+
+    n_orb = tb_data['n_wf']
+    w_dict = sigma_data['w_dict']
+    e_k = _k_block(store.load(tb_data['e_mat']), n_orb, k_range)
+    sigma = store.load_complex(sigma_data['sigma_re'], sigma_data['sigma_im'])
+    iw0 = np.where(np.sign(w_dict['w_mesh']) == True)[0][0]-1
+
+    alatt_k_w, path = spectral_function(e_k, sigma[None,:,:,iw0], [w_dict['w_mesh'][iw0]], akw_data['eta'], mu)
+    return alatt_k_w[:,0], path
 
 def calc_kslice(tb_data, sigma_data, akw_data, solve=False, band_basis=False):
+    """
+    A(k, w=0) on a (n_kx, n_ky) k-slice, or on a stack of slices (n_kz, n_kx, n_ky) if tb_data['e_mat']
+    is (n_orb, n_orb, n_kz, n_kx, n_ky). All slices share Sigma(w=0) and mu and are evaluated in one pass.
+    """
 
     # read data
     n_orb = tb_data['n_wf']
     eta = upscale(1j * akw_data['eta'], n_orb)
     w_dict = sigma_data['w_dict']
-    w_vec = np.array(w_dict['w_mesh'])[:,None,None] * np.eye(n_orb)
-    e_mat = np.array(tb_data['e_mat'])
-    n_kx, n_ky = e_mat.shape[2:4]
+    e_mat = store.load(tb_data['e_mat'])
+    k_shape = e_mat.shape[2:]
 
     # sigma
-    sigma = np.array(sigma_data['sigma_re']) + 1j * np.array(sigma_data['sigma_im'])
-    sigma_rot = sigma.copy()
+    sigma = store.load_complex(sigma_data['sigma_re'], sigma_data['sigma_im'])
     if band_basis:
-        e_vecs = np.array(tb_data['evecs_re']) + 1j * np.array(tb_data['evecs_im'])
+        e_vecs = store.load_complex(tb_data['evecs_re'], tb_data['evecs_im'])
     iw0 = np.where(np.sign(w_dict['w_mesh']) == True)[0][0]-1
     tools.print_matrix(sigma[:,:,iw0], n_orb, 'Zero-frequency Sigma')
 
@@ -124,46 +366,12 @@ def calc_kslice(tb_data, sigma_data, akw_data, solve=False, band_basis=False):
     mu = upscale(float(tb_data['dft_mu']) - new_mu, n_orb)
 
     if not solve:
-        alatt_k_w = np.zeros((n_kx, n_ky))
-        invert_and_trace = lambda w, eta, mu, e_mat, sigma: -1.0/np.pi * np.trace( np.linalg.inv( w + eta + mu - e_mat - sigma ).imag )
-
-        for ikx, iky in itertools.product(range(n_kx), range(n_ky)):
-            alatt_k_w[ikx, iky] = invert_and_trace(upscale(w_dict['w_mesh'][iw0], n_orb), eta, mu, e_mat[:,:,ikx,iky], sigma[:,:,iw0])
+        alatt_k_w, akw_data['akw_path'] = kslice_chunk(tb_data, sigma_data, akw_data, float(tb_data['dft_mu']) - new_mu)
+        alatt_k_w = alatt_k_w.reshape(k_shape)
     else:
-        assert n_kx == n_ky, 'Not implemented for N_kx != N_ky'
-        alatt_k_w = np.zeros((n_kx, n_ky, n_orb))
-        for it in range(2):
-            kslice = np.zeros((n_kx, n_ky, n_orb))
-            if it == 0:
-                kslice_interp = lambda ik, orb: interp1d(range(n_kx), kslice[:, ik, orb])
-            else:
-                kslice_interp = lambda ik, orb: interp1d(range(n_kx), kslice[ik, :, orb])
-
-            for ik1 in range(n_kx):
-                e_temp = e_mat[:,:,:,ik1] if it == 0 else e_mat[:,:,ik1,:]
-                for ik2 in range(n_kx):
-                    e_val, _ = np.linalg.eigh( eta + mu - e_temp[:,:,ik2] - sigma[:,:,iw0])
-                    k1, k2 = [ik2, ik1] if it == 0 else [ik1, ik2]
-                    kslice[k1, k2] = e_val
-                
-                for orb in range(n_orb):
-                    try:
-                        x0 = brentq( kslice_interp(ik1, orb), 0, n_kx - 1)
-                        k1, k2 = [int(np.floor(x0)), ik1] if it == 0 else [ik1, int(np.floor(x0))]
-                        alatt_k_w[k1, k2, orb] += 1
-                    except ValueError:
-                        pass
-
-        alatt_k_w[np.where(alatt_k_w > 1)] = 1
-        alatt_k_w[np.where(alatt_k_w < 1)] = None
-        for ik1 in range(n_ky):
-            for orb in range(n_orb):
-                try:
-                    cross = np.where(alatt_k_w[:,ik1,orb] == 1)[0]
-                    for idx in cross:
-                        alatt_k_w[idx, ik1, orb] = np.linspace(0, 1, n_ky)[ik1 + 1]
-                except(IndexError):
-                    pass
+        e_slices = e_mat.reshape(n_orb, n_orb, -1, *k_shape[-2:])
+        alatt_k_w = np.array([_kslice_crossings(e_slices[:,:,iz], sigma[:,:,iw0], eta, mu) for iz in range(e_slices.shape[2])])
+        alatt_k_w = alatt_k_w.reshape(*k_shape, n_orb)
 
     return alatt_k_w, new_mu
 
@@ -186,71 +394,234 @@ def sumk(mu, Sigma, bz_weights, hopping, eta=0.0):
 
     return Gloc
 
-def calc_mu(tb_data, n_elect, add_spin, add_local, mu_guess= 0.0, Sigma=None, eta=0.0):
+def _trapezoid_weights(w_mesh):
     """
-    This function determines the chemical potential based on tb_data, an optional sigma and a number of electrons.
+    Integration weights of the trapezoidal rule on a (non-uniform) mesh
+    """
+
+    weights = np.zeros(len(w_mesh))
+    dw = np.diff(w_mesh)
+    weights[:-1] += dw / 2
+    weights[1:] += dw / 2
+    return weights
+
+def density_function(hopping, bz_weights, Sigma=None, eta=0.0, mem=None, eps_k=None):
+    """
+    Returns dens(mu), the total density per spin at T=0 of H(k) on a discrete BZ grid.
+    H(k) is diagonalized once here and the eigenvalues are reused for every mu. Without Sigma
+    the integral over w < 0 is done in closed form (lower bound -5 as the default mesh of sumk),
+    otherwise the real part of Sigma is used on its mesh as in sumk. Only a Sigma that is not
+    proportional to the identity requires inverting the resolvent on every call.
+    Precomputed eigenvalues of H(k) can be passed as eps_k.
+    """
+
+    bz_weights = np.asarray(bz_weights)
+    hopping = np.asarray(hopping)
+    eta = max(eta, 1e-8)
+
+    if eps_k is None:
+        eps_k = np.linalg.eigvalsh(hopping)
+
+    if Sigma is None:
+        w_min = -5.0
+        def dens(mu):
+            occ = np.arctan((mu - eps_k) / eta) - np.arctan((w_min + mu - eps_k) / eta)
+            return np.sum(bz_weights[:, None] * occ) / np.pi
+        return dens
+
+    w_mesh = np.array([w.value for w in Sigma.mesh])
+    occupied = w_mesh <= 0
+    w_occ = w_mesh[occupied]
+    weights = _trapezoid_weights(w_occ)
+    sigma_w = Sigma.data[occupied].real
+
+    if sigma_structure(sigma_w) == 'scalar':
+        sigma_diag = np.diagonal(sigma_w, axis1=1, axis2=2)
+        def dens(mu):
+            return np.dot(bz_weights, alatt_eigen(eps_k, sigma_diag, w_occ, eta, mu, mem).dot(weights))
+        return dens
+
+    # the poles of the resolvent do not depend on mu, so they are computed once for all calls
+    return density_poles(resolvent_poles(hopping, sigma_w, mem), bz_weights, w_occ, eta, mem)
+
+def density_poles(poles, bz_weights, w_occ, eta=0.0, mem=None):
     """
+    Returns dens(mu) as density_function for the poles (n_k, n_w, n_orb) of H(k) + Re sigma(w) on the
+    occupied part w_occ of the mesh (see resolvent_poles)
+    """
+
+    bz_weights = np.asarray(bz_weights)
+    weights = _trapezoid_weights(w_occ)
+    eta = max(eta, 1e-8)
 
     def dens(mu):
-        # 2 times for spin degeneracy
-        sp_factor = 1 if add_spin else 2
-        dens = sp_factor*sumk(mu = mu, Sigma = Sigma, bz_weights=SK.bz_weights, hopping=SK.hopping, eta=eta).total_density()
-        return dens.real
+        return np.dot(bz_weights, alatt_poles(poles, w_occ, eta, mu, mem).dot(weights))
+
+    return dens
+
+def find_mu(dens, n_elect, mu_guess=0.0, step=0.1, xtol=1e-6, max_loops=100):
+    """
+    Solve dens(mu) = n_elect for a density that increases with mu. Starting from mu_guess
+    (usually the previous mu) the root is bracketed with a growing step and then refined with Brent's method.
+    """
+
+    f = lambda mu: dens(mu) - n_elect
+    mu_a, f_a = mu_guess, f(mu_guess)
+    if f_a == 0.0:
+        return mu_a
+    direction = 1.0 if f_a < 0 else -1.0
+
+    for _ in range(max_loops):
+        mu_b = mu_a + direction * step
+        f_b = f(mu_b)
+        if np.sign(f_b) != np.sign(f_a):
+            return brentq(f, min(mu_a, mu_b), max(mu_a, mu_b), xtol=xtol)
+        mu_a, f_a = mu_b, f_b
+        step *= 2
+
+    raise RuntimeError('could not bracket the chemical potential starting from {:.4f}'.format(mu_guess))
+
+# H(k) on discrete BZ grids and its eigenvalues, reused between calls on the same Hamiltonian
+bz_grid_cache = LRUCache('bz_grid', max_bytes=2**28)
+# shared by all worker processes
+bz_grid_disk_cache = DiskCache('bz_grid_disk')
+mu_disk_cache = DiskCache('mu_disk')
+
+def bz_grid(tb_data, add_spin, add_local, n_k):
+    """
+    H(k), BZ weights and eigenvalues of H(k) on a SumkDiscreteFromLattice grid with n_k points per direction
+    """
+
+    key = hash_key(store.content_id(tb_data['hopping']), tb_data['units'], tb_data['n_wf'], bool(add_spin), list(add_local), n_k)
+    grid = bz_grid_cache.get(key)
+    if grid is None:
+        grid = bz_grid_disk_cache.get(key)
+    if grid is not None:
+        return bz_grid_cache.put(key, grid)
 
     # set up Wannier Hamiltonian
-    n_k = 10
     n_orb_rescale = 2 * tb_data['n_wf'] if add_spin else tb_data['n_wf']
     H_add_loc = np.zeros((n_orb_rescale, n_orb_rescale), dtype=complex)
     if add_spin: H_add_loc += tools.lambda_matrix_w90_t2g(add_local)
 
-    if not Sigma:
-        Sigma = GfReFreq(mesh=MeshReFreq(omega_min=-5, omega_max=1, n_max=1001) , target_shape = [tb_data['n_wf'],tb_data['n_wf']])
-
-    hopping = {eval(key): np.array(value, dtype=complex) for key, value in tb_data['hopping'].items()}
+    hopping = store.load_hopping(tb_data['hopping'])
     tb = tools.get_TBL(hopping, tb_data['units'], tb_data['n_wf'], extend_to_spin=add_spin, add_local=H_add_loc)
 
     SK = SumkDiscreteFromLattice(lattice=tb, n_points=n_k)
+    hopping_k = np.array(SK.hopping)
+
+    grid = (hopping_k, np.array(SK.bz_weights), np.linalg.eigvalsh(hopping_k))
+    return bz_grid_cache.put(key, bz_grid_disk_cache.put(key, grid))
+
+def calc_mu(tb_data, n_elect, add_spin, add_local, mu_guess= 0.0, Sigma=None, eta=0.0, n_k=10):
+    """
+    This function determines the chemical potential based on tb_data, an optional sigma and a number of electrons.
+    """
+
+    hopping_k, bz_weights, eps_k = bz_grid(tb_data, add_spin, add_local, n_k)
 
-    mu, density = dichotomy(dens, mu_guess, n_elect, 1e-3, 0.5, max_loops = 100, x_name="chemical potential", y_name="density", verbosity=3)
+    # 2 times for spin degeneracy
+    sp_factor = 1 if add_spin else 2
+    dens = density_function(hopping_k, bz_weights, Sigma=Sigma, eta=eta, eps_k=eps_k)
+    mu = find_mu(lambda mu: sp_factor * dens(mu), n_elect, mu_guess)
+    print('chemical potential: {:.4f}, density: {:.4f}'.format(mu, sp_factor * dens(mu)))
 
     return mu
 
-def sigma_from_dmft(n_orb, orbital_order, sigma, spin, block, dc, w_dict, linearize= False):
+def calc_mu_adaptive(tb_data, n_elect, add_spin, add_local, mu_guess= 0.0, Sigma=None, eta=0.0,
+                     n_k_start=6, n_k_max=40, dens_tol=1e-3):
     """
-    Takes a sigma obtained from DMFT and interpolates on a given mesh
+    Determines the chemical potential as calc_mu, but refines the BZ grid until the density at the
+    current mu changes by less than dens_tol. Returns mu and a dict with the grid size n_k, the density,
+    whether the refinement converged and the time spent in seconds.
+    """
+
+    # the non-interacting mu is shared between sessions and worker processes
+    if Sigma is None:
+        key = hash_key(store.content_id(tb_data['hopping']), tb_data['units'], tb_data['n_wf'], n_elect, bool(add_spin),
+                       list(add_local), mu_guess, n_k_start, n_k_max, dens_tol)
+        cached = mu_disk_cache.get(key)
+        if cached is not None:
+            return cached
+
+    start = time.perf_counter()
+    sp_factor = 1 if add_spin else 2
+
+    n_k, mu, converged = n_k_start, mu_guess, False
+    while True:
+        hopping_k, bz_weights, eps_k = bz_grid(tb_data, add_spin, add_local, n_k)
+        dens = density_function(hopping_k, bz_weights, Sigma=Sigma, eta=eta, eps_k=eps_k)
+        # density on the refined grid at the mu of the previous grid
+        if n_k > n_k_start and abs(sp_factor * dens(mu) - n_elect) < dens_tol:
+            converged = True
+            break
+        mu = find_mu(lambda mu: sp_factor * dens(mu), n_elect, mu)
+        if n_k >= n_k_max:
+            break
+        n_k = min(int(np.ceil(1.5 * n_k)), n_k_max)
+
+    info = {'n_k': n_k, 'density': float(sp_factor * dens(mu)), 'converged': converged, 'time': time.perf_counter() - start}
+    print('chemical potential: {:.4f}, density: {:.4f}, n_k: {}, converged: {}, time: {:.2f}s'.format(
+          mu, info['density'], n_k, converged, info['time']))
+
+    if Sigma is None:
+        mu_disk_cache.put(key, (float(mu), info))
+    return mu, info
+
+def resample_sigma(w_src, sigma_src, w_dst, kind='linear'):
+    """
+    Interpolate sigma (n_w_src, n_orb, n_orb) from the mesh w_src onto w_dst for all matrix elements at
+    once. kind is 'linear', 'cubic' (cubic spline) or 'pchip' (monotone cubic, which does not overshoot
+    and so keeps the sign of Im sigma, i.e. causality). Outside w_src the boundary values are used, as
+    in np.interp.
+    """
+
+    w_src = np.asarray(w_src, dtype=float)
+    w_dst = np.clip(np.asarray(w_dst, dtype=float), w_src[0], w_src[-1])
+
+    if kind == 'linear':
+        idx = np.clip(np.searchsorted(w_src, w_dst), 1, len(w_src) - 1)
+        weight = ((w_dst - w_src[idx - 1]) / (w_src[idx] - w_src[idx - 1]))[:, None, None]
+        return (1 - weight) * sigma_src[idx - 1] + weight * sigma_src[idx]
+    if kind == 'cubic':
+        return CubicSpline(w_src, sigma_src, axis=0)(w_dst)
+    if kind == 'pchip':
+        return PchipInterpolator(w_src, sigma_src.real, axis=0)(w_dst) + 1j * PchipInterpolator(w_src, sigma_src.imag, axis=0)(w_dst)
+
+    raise ValueError('unknown interpolation {}, expected linear, cubic or pchip'.format(kind))
+
+def sigma_from_dmft(n_orb, orbital_order, sigma, spin, block, dc, w_dict, linearize= False, kind='linear'):
+    """
+    Takes a sigma obtained from DMFT and interpolates on a given mesh, see resample_sigma for kind.
+    With linearize = (w_min, w_max) the diagonal elements are replaced by a linear fit within that window.
     """
 
     block_spin = spin + '_' + str(block) # if with_sigma == 'calc' else spin
     SOC = True if spin == 'ud' else False
-    w_mesh_dmft = [x.real for x in sigma[block_spin].mesh]
-    w_mesh = w_dict['w_mesh']
-    sigma_mat = {block_spin: sigma[block_spin].data.real - np.eye(n_orb) * dc + 1j * sigma[block_spin].data.imag}
-
-    # rotate sigma from orbital_order_dmft to orbital_order, where 0,1,2 is the basis given by the Wannier Ham
-    change_of_basis = tools.change_basis(n_orb, orbital_order,  (0,1,2))
-    sigma_mat[block_spin] = np.einsum('ij, kjl -> kil', np.linalg.inv(change_of_basis), np.einsum('ijk, kl -> ijl', sigma_mat[block_spin], change_of_basis))
+    mesh = sigma[block_spin].mesh
+    w_mesh_dmft = np.linspace(mesh.omega_min, mesh.omega_max, len(mesh))
+    w_mesh = np.asarray(w_dict['w_mesh'])
+    sigma_mat = sigma[block_spin].data - np.eye(n_orb) * dc
 
-    sigma_interpolated = np.zeros((n_orb, n_orb, w_dict['n_w']), dtype=complex)
-    
     if linearize:
         print('Linearizing Sigma at zero frequency:')
-        eta = eta * 1j
+        sigma_interpolated = np.zeros((len(w_mesh), n_orb, n_orb), dtype=complex)
         iw0 = np.where(np.sign(w_mesh_dmft) == True)[0][0]-1
-        if SOC: sigma_interpolated += np.expand_dims(sigma_mat[block_spin][iw0,:,:], axis=-1)
-        # linearize diagonal elements of sigma
+        if SOC: sigma_interpolated += sigma_mat[iw0]
+        # linear fit of all diagonal elements of sigma at once
+        window = np.logical_and(w_mesh_dmft >= linearize[0], w_mesh_dmft <= linearize[1])
+        first_order, zeroth_order = np.polyfit(w_mesh_dmft[window], np.einsum('wii -> wi', sigma_mat[window]).real, 1)
         for ct in range(n_orb):
-            _, _, fit_params = _linefit(w_mesh_dmft, sigma_mat[block_spin][:,ct,ct], specs['linearize']['window'])
-            zeroth_order, first_order = fit_params[::-1].real
-            print('Zeroth and first order fit parameters: [{0:.4f}, {1:.4f}]'.format(zeroth_order,first_order))
-            sigma_interpolated[ct,ct] = zeroth_order + w_dict['w_mesh'] * first_order
-
+            print('Zeroth and first order fit parameters: [{0:.4f}, {1:.4f}]'.format(zeroth_order[ct], first_order[ct]))
+        sigma_interpolated[:, range(n_orb), range(n_orb)] = zeroth_order + w_mesh[:, None] * first_order
     else:
-        eta = 0 * 1j
-        # interpolate sigma
-        interpolate_sigma = lambda w_mesh, w_mesh_dmft, orb1, orb2: np.interp(w_mesh, w_mesh_dmft, sigma_mat[block_spin][:, orb1, orb2])
+        sigma_interpolated = resample_sigma(w_mesh_dmft, sigma_mat, w_mesh, kind)
 
-        for ct1, ct2 in itertools.product(range(n_orb), range(n_orb)):
-            if ct1 != ct2 and not SOC: continue
-            sigma_interpolated[ct1,ct2] = interpolate_sigma(w_mesh, w_mesh_dmft, ct1, ct2)
-    
-    return sigma_interpolated
+    # rotate sigma from orbital_order_dmft to orbital_order, where 0,1,2,... is the basis given by the Wannier Ham,
+    # on the output mesh only
+    change_of_basis = tools.change_basis(n_orb, orbital_order, tuple(range(n_orb)))
+    sigma_interpolated = np.linalg.inv(change_of_basis) @ sigma_interpolated @ change_of_basis
+    if not SOC:
+        sigma_interpolated *= np.eye(n_orb)
+
+    return sigma_interpolated.transpose(1,2,0)
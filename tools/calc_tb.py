@@ -25,6 +25,8 @@ from triqs.gf import BlockGf
 from triqs.gf import GfReFreq, MeshReFreq
 from triqs.utility.dichotomy import dichotomy
 import tools.tools as tools
+from tools.cache import LRUCache, DiskCache, hash_key
+import tools.array_store as store
 from tools.TB_functions import *
 
 def _convert_kpath(k_mesh):
@@ -37,49 +39,73 @@ def _convert_kpath(k_mesh):
 
     return k_path, k_point_labels
 
-def get_tb_bands(e_mat):
+# TB results along k-paths, keyed on hoppings, units, k-path, n_k, mu and SOC settings. The disk cache
+# is shared by all worker processes.
+tb_cache = LRUCache('tb_bands', max_bytes=2**28)
+tb_disk_cache = DiskCache('tb_bands_disk')
+
+def get_tb_bands(e_mat, vectors=True, single_precision=False):
     """
-    Compute band eigenvalues and eigenvectors from matrix per k-point
+    Compute band eigenvalues and eigenvectors of H(k) given as (n_orb, n_orb, ...) for all k-points
+    in one batched call. Without vectors only the eigenvalues are computed (None is returned for the
+    eigenvectors); single_precision uses complex64 and is meant for display-only paths.
     """
 
-    e_val = np.zeros((e_mat.shape[0], e_mat.shape[2]), dtype=complex)
-    e_vec = np.zeros(np.shape(e_mat), dtype=complex)
-    for ik in range(np.shape(e_mat)[2]):
-        e_val[:,ik], e_vec[:,:,ik] = np.linalg.eigh(e_mat[:,:,ik])
+    stack = np.moveaxis(e_mat, (0, 1), (-2, -1))
+    if single_precision:
+        stack = stack.astype(np.complex64)
+
+    if not vectors:
+        return np.moveaxis(np.linalg.eigvalsh(stack), -1, 0), None
 
-    return e_val.real, e_vec
+    e_val, e_vec = np.linalg.eigh(stack)
+    return np.moveaxis(e_val, -1, 0), np.moveaxis(e_vec, (-2, -1), (0, 1))
 
 def get_tb_kslice(tb, k_mesh, dft_mu):
     """
-    Compute band eigenvalues and eigenvectors...
+    Compute the Fermi-surface contours and their orbital character for the k-slice(s) in k_mesh.
+    k_mesh['kz'] and the optional k_mesh['fermi'] (relative to the chemical potential already
+    contained in tb) may be lists to obtain several slices at once. See get_kx_ky_FS for the
+    flat contour format.
     """
 
-    prim_to_cart = [[0,1,1],
-                    [1,0,1],
-                    [1,1,0]]
-    cart_to_prim = np.linalg.inv(prim_to_cart)
     k_path, _ = _convert_kpath(k_mesh)
     final_x, final_y = k_path[1]
     Z = np.array(k_mesh['Z'])
 
-    fermi = 0.
-    e_val, e_vec = get_kx_ky_FS(final_x, final_y, Z, tb, k_trans_back=cart_to_prim, N_kxy=k_mesh['n_k'], kz=k_mesh['kz'], fermi=fermi)
+    fermi = k_mesh.get('fermi', 0.)
+    fs = get_kx_ky_FS(final_x, final_y, Z, tb, N_kxy=k_mesh['n_k'], kz=k_mesh['kz'], fermi=fermi)
 
-    return e_val, e_vec
+    return fs
 
-def calc_tb_bands(data, add_spin, mu, add_local, k_mesh, fermi_slice, band_basis = False):
+def get_tb_fs3d(tb, k_mesh):
     """
-    calculate tight-binding bands based on a W90 Hamiltonian 
+    Compute the Fermi isosurfaces over the whole BZ on an n_k^3 grid, decimated by the optional
+    k_mesh['step_size']. See get_FS_3D for the flat surface format.
     """
 
+    fermi = k_mesh.get('fermi', 0.)
+    fs = get_FS_3D(tb, n_k=k_mesh['n_k'], fermi=fermi, step_size=k_mesh.get('step_size', 1))
+
+    return fs
+
+def _tb_lattice(data, add_spin, mu, add_local):
     # set up Wannier Hamiltonian
     n_orb_rescale = 2 * data['n_wf'] if add_spin else data['n_wf']
     H_add_loc = np.zeros((n_orb_rescale, n_orb_rescale), dtype=complex)
     H_add_loc += np.diag([-mu]*n_orb_rescale)
     if add_spin: H_add_loc += tools.lambda_matrix_w90_t2g(add_local)
 
-    hopping = {eval(key): np.array(value, dtype=complex) for key, value in data['hopping'].items()}
-    tb = tools.get_TBL(hopping, data['units'], data['n_wf'], extend_to_spin=add_spin, add_local=H_add_loc)
+    hopping = store.load_hopping(data['hopping'])
+    return tools.get_TBL(hopping, data['units'], data['n_wf'], extend_to_spin=add_spin, add_local=H_add_loc)
+
+def calc_tb_bands(data, add_spin, mu, add_local, k_mesh, fermi_slice, band_basis = False):
+    """
+    calculate tight-binding bands based on a W90 Hamiltonian 
+    """
+
+    n_orb_rescale = 2 * data['n_wf'] if add_spin else data['n_wf']
+    tb = _tb_lattice(data, add_spin, mu, add_local)
     # print local H(R)
     h_of_r = tb.hopping_dict()[(0,0,0)][2:5,2:5] if add_spin else tb.hopping_dict()[(0,0,0)]
     tools.print_matrix(h_of_r, data['n_wf'], 'H(R=0)')
@@ -93,22 +119,23 @@ def calc_tb_bands(data, add_spin, mu, add_local, k_mesh, fermi_slice, band_basis
         if add_spin: e_mat = e_mat[2:5,2:5]
 
         if band_basis:
-            e_vecs = np.zeros(e_mat.shape, dtype=complex)
-            for ik in range(np.shape(e_mat)[2]):
-                evals, e_vecs[:,:,ik] = np.linalg.eigh(e_mat[:,:,ik])
-                e_mat[:,:,ik] = np.zeros(e_mat[:,:,ik].shape)
-                np.fill_diagonal(e_mat[:,:,ik],evals)
+            evals, e_vecs = get_tb_bands(e_mat)
+            e_mat = np.zeros(e_mat.shape, dtype=complex)
+            e_mat[np.arange(e_mat.shape[0]), np.arange(e_mat.shape[0])] = evals
         else:
             e_vecs = np.array([None])
 
     else:
-        e_mat = np.zeros((n_orb_rescale, n_orb_rescale, k_mesh['n_k'], k_mesh['n_k']), dtype=complex)
         e_vecs = np.array([None])
         final_x, final_y = k_path[1]
         Z = np.array(k_mesh['Z'])
-        for ik_y in range(k_mesh['n_k']):
-            path_along_x = [(final_y / (k_mesh['n_k'] - 1) * ik_y + k_mesh['kz'] * Z, final_x + final_y / (k_mesh['n_k'] - 1) * ik_y + k_mesh['kz'] * Z)]
-            _, _, e_mat[:,:,:,ik_y] = energy_matrix_on_bz_paths(path_along_x, tb, n_pts=k_mesh['n_k'])
+        # all (k_x, k_y) points of all kz slices in one Fourier transform
+        kz = np.atleast_1d(np.asarray(k_mesh['kz'], dtype=float))
+        a = np.linspace(0., 1., k_mesh['n_k'])
+        k_grid = a[None,:,None,None] * final_x + a[None,None,:,None] * final_y + kz[:,None,None,None] * Z
+        e_mat = tbl_hk(tb, k_grid.reshape(-1, 3)).reshape(len(kz), k_mesh['n_k'], k_mesh['n_k'], n_orb_rescale, n_orb_rescale).transpose(3,4,0,1,2)
+        # a single kz gives one (n_orb, n_orb, n_kx, n_ky) slice, a list of kz a stack (n_orb, n_orb, n_kz, n_kx, n_ky)
+        if np.ndim(k_mesh['kz']) == 0: e_mat = e_mat[:,:,0]
         k_disc = k_points = np.array([0,1])
         if add_spin: e_mat = e_mat[2:5,2:5]
 
@@ -116,3 +143,60 @@ def calc_tb_bands(data, add_spin, mu, add_local, k_mesh, fermi_slice, band_basis
 
     return k_mesh, e_mat, e_vecs, tb
 
+def calc_tb_path(data, add_spin, mu, add_local, k_mesh, band_basis = False):
+    """
+    calculate tight-binding bands along the k-path as calc_tb_bands, together with the band
+    eigenvalues and eigenvectors. Results are cached on a hash of all inputs.
+    """
+
+    key = hash_key(store.content_id(data['hopping']), data['units'], data['n_wf'], bool(add_spin), mu, list(add_local),
+                   k_mesh['k_path'], k_mesh['n_k'], bool(band_basis))
+    result = tb_cache.get(key)
+    if result is None:
+        result = tb_disk_cache.get(key)
+    if result is not None:
+        return tb_cache.put(key, result)
+
+    k_mesh, e_mat, e_vecs, _ = calc_tb_bands(data, add_spin, mu, add_local, k_mesh, fermi_slice=False, band_basis=band_basis)
+    if band_basis:
+        eps_nuk, evec_nuk = np.einsum('iij -> ij', e_mat).real, e_vecs
+    else:
+        # eigen-data of the orbital basis is only used for display
+        eps_nuk, evec_nuk = get_tb_bands(e_mat, single_precision=True)
+
+    return tb_cache.put(key, tb_disk_cache.put(key, (k_mesh, e_mat, e_vecs, eps_nuk, evec_nuk)))
+
+def path_k_points(k_mesh, x):
+    """
+    k-points (n_x, 3) in units of the reciprocal lattice vectors at the positions x along the k-path of
+    a k_mesh returned by calc_tb_bands, i.e. in the units of k_mesh['k_disc']
+    """
+
+    k_path, _ = _convert_kpath({'k_path': k_mesh['k_points_dash']})
+    k_i, k_f = np.array([ki for ki, _ in k_path]), np.array([kf for _, kf in k_path])
+    K = np.asarray(k_mesh['k_points'], dtype=float)
+    x = np.asarray(x, dtype=float)
+
+    seg = np.clip(np.searchsorted(K, x, side='right') - 1, 0, len(k_path) - 1)
+    dK = K[seg + 1] - K[seg]
+    t = np.divide(x - K[seg], dK, out=np.zeros(len(x)), where=dK > 0)
+
+    return k_i[seg] + t[:, None] * (k_f[seg] - k_i[seg])
+
+# R vectors and H(R) of the Hamiltonian of calc_tb_bands
+hr_cache = LRUCache('tb_hr', max_bytes=2**26)
+
+def calc_tb_kpoints(data, add_spin, mu, add_local, k_points):
+    """
+    H(k) (n_orb, n_orb, n_k) of the Hamiltonian of calc_tb_bands at arbitrary k_points (n_k, 3)
+    """
+
+    key = hash_key(store.content_id(data['hopping']), data['units'], data['n_wf'], bool(add_spin), mu, list(add_local))
+    hr = hr_cache.get(key)
+    if hr is None:
+        hr = hr_cache.put(key, hopping_array(_tb_lattice(data, add_spin, mu, add_local).hopping_dict()))
+
+    e_mat = fourier_hk(*hr, k_points).transpose(1,2,0)
+    if add_spin: e_mat = e_mat[2:5,2:5]
+
+    return e_mat
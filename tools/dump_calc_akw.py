@@ -1,118 +1,125 @@
-def _linefit(x, y, interval, spacing=50, addspace=0.0):
-
-    calc_Z = lambda slope: 1/(1-slope)
-    
-    x = np.array(x)
-    lim_l, lim_r = interval
-    indices = np.where(np.logical_and(x>=lim_l, x<=lim_r))
-    fit = np.polyfit(x[indices], y[indices], 1)
-    slope = fit[1]
-    Z = calc_Z(slope)
-    f_x = np.poly1d(fit)
-    x_cont = np.linspace(x[indices][0] - addspace, x[indices][-1] + addspace, spacing)
-    
-    return x_cont, f_x(x_cont), fit
-
-def _sigma_from_model(n_orb, orbital_order, zeroth_order, first_order, efermi, eta=0.0, **w):
-    
-    print('Setting model Sigma')
-
-    mu = dft_mu = efermi
-    eta = eta * 1j
-    
-    # set up mesh
-    w_dict = w['w_mesh']
-    w_mesh = np.linspace(*w_dict['window'], w_dict['n_w'])
-    w_dict.update({'w_mesh': w_mesh})
-
-    # interpolate sigma
-    sigma_interpolated = np.zeros((n_orb, n_orb, w_dict['n_w']), dtype=complex)
-    approximate_sigma = lambda zeroth_order, first_order, orb: zeroth_order[orb] + w_dict['w_mesh'] * first_order[orb]
-    for ct, orb in enumerate(orbital_order):
-        sigma_interpolated[ct,ct] = approximate_sigma(zeroth_order, first_order, ct)
-    
-    return sigma_interpolated, mu, dft_mu, eta, w_dict
-
-def get_dmft_bands(n_orb, with_sigma=False, fermi_slice=False, solve=False, orbital_order=(0,1,2), band_basis=False, **specs):
-    
-    # dmft output
-    if with_sigma:
-        sigma_types = ['calc', 'model']
-        if isinstance(with_sigma, str):
-            if with_sigma not in sigma_types: raise ValueError('Invalid sigma type. Expected one of: {}'.format(sigma_types))
-        elif not isinstance(with_sigma, BlockGf):
-            raise ValueError('Invalid sigma type. Expected BlockGf.')
-
-        # get sigma
-        if with_sigma == 'model': delta_sigma, mu, dft_mu, eta, w_dict = _sigma_from_model(n_orb, orbital_order, **specs)
-        # else is from dmft or memory:
-        else: delta_sigma, mu, dft_mu, eta, w_dict = sigma_from_dmft(n_orb, orbital_order, with_sigma, **specs)
-        
-        # calculate alatt
-        if not fermi_slice:
-            alatt_k_w, new_mu = calc_alatt(n_orb, mu, eta, e_mat, delta_sigma, solve, band_basis,**w_dict)
-        else:
-            alatt_k_w = _calc_kslice(n_orb, mu, eta, e_mat, delta_sigma, solve, band_basis **w_dict)       
-    else:
-        dft_mu = new_mu
-        w_dict = {}
-        w_dict['w_mesh'] = None
-        w_dict['window'] = None
-        alatt_k_w = None
-    
-    return {'k_mesh': k_array, 'k_points': k_points, 'k_points_labels': k_points_labels, 'e_mat': e_mat, 'tb': tb}, alatt_k_w, w_dict, dft_mu
-
-def plot_bands(fig, ax, alatt_k_w, tb_data, w_dict, n_orb, dft_mu, tb=True, alatt=False, **plot_dict):
-    
-    if alatt:
-        if alatt_k_w is None: raise ValueError('A(k,w) unknown. Specify "with_sigma = True"')
-        kw_x, kw_y = np.meshgrid(tb_data['k_mesh'], w_dict['w_mesh'])
-        if len(alatt_k_w.shape) > 2:
-            for orb in range(n_orb):
-                ax.contour(kw_x, kw_y, alatt_k_w[:,:,orb].T, colors=np.array([eval('cm.'+plot_dict['colorscheme_solve'])(0.7)]), levels=1, zorder=2.)
-        else:
-            graph = ax.pcolormesh(kw_x, kw_y, alatt_k_w.T, cmap=plot_dict['colorscheme_bands'], norm=LogNorm(vmin=plot_dict['vmin'], vmax=np.max(alatt_k_w)))
-            colorbar = plt.colorbar(graph)
-            colorbar.set_label(r'$A(k, \omega)$')
-
-    if tb:
-        #eps_nuk, evec_nuk = _get_tb_bands(**tb_data)
-        for band in range(n_orb):
-            orbital_projected = [0] if not plot_dict['proj_on_orb'] else np.real(evec_nuk[plot_dict['proj_on_orb'], band] * evec_nuk[plot_dict['proj_on_orb'], band].conjugate())
-            ax.scatter(tb_data['k_mesh'], eps_nuk[band].real - dft_mu, c=cm.plasma(orbital_projected), s=1, label=r'tight-binding', zorder=1.)
-
-    _setup_plot_bands(ax, tb_data['k_points'], tb_data['k_points_labels'], w_dict)
-
-def plot_kslice(fig, ax, alatt_k_w, tb_data, w_dict, n_orb, tb_dict, tb=True, alatt=False, quarter=0, dft_mu=0.0, **plot_dict):
-    
-    sign = [1,-1]
-    quarters = np.array([sign,sign])
-    
-    if alatt:
-        if alatt_k_w is None: raise ValueError('A(k,w) unknown. Specify "with_sigma = True"')
-        n_kx, n_ky = tb_data['e_mat'].shape[2:4]
-        kx, ky = np.meshgrid(range(n_kx), range(n_ky))
-        for qrt in list(itertools.product(*quarters))[quarter:quarter+1]:
-            if len(alatt_k_w.shape) > 2:
-                for orb in range(n_orb):
-                    ax.contour(qrt[0] * kx/(n_kx-1), qrt[1] * ky/(n_ky-1), alatt_k_w[:,:,orb].T, colors=np.array([eval('cm.'+plot_dict['colorscheme_solve'])(0.7)]), levels=1, zorder=2)
-            else:
-                graph = ax.pcolormesh(qrt[0] * kx/(n_kx-1), qrt[1] * ky/(n_ky-1), alatt_k_w.T, cmap=plot_dict['colorscheme_kslice'],
-                                      norm=LogNorm(vmin=plot_dict['vmin'], vmax=np.max(alatt_k_w)))
-                #colorbar = plt.colorbar(graph)
-                #colorbar.set_label(r'$A(k, 0$)')
-
-    if tb:
-        quarters *= 2
-        eps_nuk, evec_nuk = _get_tb_kslice(tb_data['tb'], dft_mu, **tb_dict)
-        for qrt in list(itertools.product(*quarters))[quarter:quarter+1]:
-            for band in range(len(eps_nuk)):
-                for segment in range(eps_nuk[band].shape[0]):
-                    #orbital_projected = evec_nuk[band][segment][plot_dict['proj_on_orb']]
-                    ax.plot(qrt[0] * eps_nuk[band][segment:segment+2,0], qrt[1] * eps_nuk[band][segment:segment+2,1], '-',
-                            solid_capstyle='round', c=eval('cm.'+plot_dict['colorscheme_kslice'])(1.0), lw=1., zorder=1.)
-
-    _setup_plot_kslice(ax, tb_data['k_points'], w_dict)
-
-    return ax
+"""
+Headless batch computation of spectra from spectrometer.h5 config files, as written by the
+"Download config" button: TB bands, chemical potential, A(k,w) along the k-path and optional
+Fermi slices are written to one HDF5 file per config and parameter set. Runs are spread over
+a process pool.
 
+usage: python -m tools.dump_calc_akw spectrometer.h5 [...] -o results --eta 0.01 0.05 --fermi-slice
+"""
+
+import os
+import sys
+import time
+import argparse
+import itertools
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from h5 import HDFArchive
+
+from load_data import read_config
+import tools.calc_tb as tb
+import tools.calc_akw as akw
+import tools.array_store as store
+
+def run(config, out_file, eta, n_k=None, solve=False, band_basis=False, solve_mu=True,
+        fermi_slice=False, kz=(0.0,), Z=(0.25, 0.25, -0.25)):
+    """
+    Compute TB bands, mu, A(k,w) and optionally A(k,0) and the Fermi-surface contours for one
+    config file and parameter set, and write them to out_file
+    """
+
+    start = time.perf_counter()
+    data = read_config(config, {})
+    if data['error'] or 'tb_data' not in data or 'sigma_data' not in data:
+        raise ValueError('{} does not contain tb_data and sigma_data'.format(config))
+    tb_data, sigma_data = data['tb_data'], data['sigma_data']
+    session = store.session(data)
+
+    add_spin = bool(tb_data.get('add_spin', False))
+    add_local = [0.] * tb_data['n_wf']
+    dft_mu = float(tb_data['dft_mu'])
+    k_path = tb_data['k_mesh']['k_points_dash']
+    if n_k is None:
+        n_k = len(tb_data['k_mesh']['k_disc']) // (len(k_path) - 1)
+
+    # chemical potential of the TB model
+    mu_info = {}
+    if solve_mu and float(tb_data.get('n_elect', 0.)) > 0:
+        dft_mu, mu_info = akw.calc_mu_adaptive(tb_data, float(tb_data['n_elect']), add_spin, add_local, mu_guess=dft_mu)
+    tb_data['dft_mu'] = dft_mu
+
+    # TB bands along the k-path
+    k_mesh, e_mat, e_vecs, eps_nuk, _ = tb.calc_tb_path(tb_data, add_spin, dft_mu, add_local, {'n_k': n_k, 'k_path': k_path},
+                                                        band_basis=band_basis)
+    tb_data['e_mat'] = store.save(e_mat.real, session, 'e_mat')
+    if band_basis:
+        tb_data['evecs_re'] = store.save(e_vecs.real, session, 'evecs_re')
+        tb_data['evecs_im'] = store.save(e_vecs.imag, session, 'evecs_im')
+
+    # A(k,w) along the k-path
+    akw_data = {'eta': float(eta), 'dmft_mu': dft_mu - float(sigma_data['dmft_mu'])}
+    alatt, dmft_mu = akw.calc_alatt(tb_data, sigma_data, akw_data, solve, band_basis)
+
+    with HDFArchive(out_file, 'w') as ar:
+        ar['config'] = {'config': os.path.abspath(config), 'eta': float(eta), 'n_k': n_k, 'solve': solve,
+                        'band_basis': band_basis, 'add_spin': add_spin}
+        ar['tb'] = {'k_disc': np.array(k_mesh['k_disc']), 'k_points': np.array(k_mesh['k_points']),
+                    'k_point_labels': list(k_mesh['k_point_labels']), 'eps_nuk': np.array(eps_nuk, dtype=float),
+                    'dft_mu': dft_mu, 'mu_info': mu_info}
+        ar['akw'] = {'Akw': np.array(alatt), 'w_mesh': np.array(sigma_data['w_dict']['w_mesh']), 'dmft_mu': dmft_mu,
+                     'eta': float(eta), 'path': akw_data.get('akw_path', 'solve')}
+
+        if fermi_slice:
+            # one slice per kz, computed as one stack
+            k_mesh_fs = {'n_k': n_k, 'k_path': k_path, 'kz': list(kz) if len(kz) > 1 else kz[0], 'Z': np.array(Z)}
+            _, e_mat_fs, _, tbl = tb.calc_tb_bands(tb_data, add_spin, dft_mu, add_local, k_mesh_fs, fermi_slice=True)
+            tb_kslice_data = dict(tb_data, e_mat=store.save(e_mat_fs.real, session, 'e_mat_kslice'))
+            ak0, _ = akw.calc_kslice(tb_kslice_data, sigma_data, {'eta': float(eta), 'dmft_mu': dmft_mu}, solve, band_basis)
+            fs = tb.get_tb_kslice(tbl, k_mesh_fs, dft_mu)
+            ar['kslice'] = {'Ak0': np.array(ak0), 'kz': np.array(kz, dtype=float), 'Z': np.array(Z, dtype=float),
+                            'contours': {key: np.array(value) for key, value in fs.items()}}
+
+    return out_file, time.perf_counter() - start
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compute TB bands, mu, A(k,w) and Fermi slices of spectrometer.h5 configs '
+                                                 'for all combinations of the given parameters.')
+    parser.add_argument('configs', nargs='+', help='spectrometer.h5 config files')
+    parser.add_argument('-o', '--out', default='.', help='output directory (default: current directory)')
+    parser.add_argument('--eta', type=float, nargs='+', default=[0.01], help='broadening(s) eta in eV (default: 0.01)')
+    parser.add_argument('--n-k', type=int, nargs='+', default=[None],
+                        help='number of k-points per path segment and slice direction (default: as in the config)')
+    parser.add_argument('--solve', action='store_true', help='quasiparticle dispersion instead of A(k,w)')
+    parser.add_argument('--band-basis', action='store_true', help='evaluate A(k,w) in the band basis')
+    parser.add_argument('--keep-mu', action='store_true', help='use the dft_mu of the config instead of solving for n_elect')
+    parser.add_argument('--fermi-slice', action='store_true', help='also compute A(k,0) and Fermi-surface contours')
+    parser.add_argument('--kz', type=float, nargs='+', default=[0.0], help='kz of the Fermi slices in units of Z (default: 0)')
+    parser.add_argument('--Z', type=float, nargs=3, default=[0.25, 0.25, -0.25], help='kz direction (default: 0.25 0.25 -0.25)')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(), help='number of parallel processes (default: all cores)')
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.out, exist_ok=True)
+    tasks = []
+    for config, eta, n_k in itertools.product(args.configs, args.eta, args.n_k):
+        name = '{}_eta{:g}{}.h5'.format(os.path.splitext(os.path.basename(config))[0], eta, '' if n_k is None else '_nk{}'.format(n_k))
+        tasks.append((config, os.path.join(args.out, name), eta, n_k))
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=max(1, min(args.jobs, len(tasks)))) as pool:
+        futures = {pool.submit(run, config, out_file, eta, n_k, args.solve, args.band_basis, not args.keep_mu,
+                               args.fermi_slice, tuple(args.kz), tuple(args.Z)): out_file
+                   for config, out_file, eta, n_k in tasks}
+        for future in as_completed(futures):
+            try:
+                out_file, elapsed = future.result()
+                print('wrote {} in {:.1f}s'.format(out_file, elapsed))
+            except Exception as error:
+                failed += 1
+                print('failed {}: {}'.format(futures[future], error), file=sys.stderr)
+
+    print('{} of {} runs done'.format(len(tasks) - failed, len(tasks)))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
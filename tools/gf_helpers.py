@@ -1,14 +1,14 @@
 import numpy as np
-from itertools import product
-from triqs.gf import GfReFreq
+import tools.tools as tools
+import tools.array_store as store
 
-def sigma_analytic_to_data(sigma, w_dict, n_orb):
+def sigma_analytic_to_data(sigma, w_dict, n_orb, session):
     
-    w_dict['w_mesh'] = [w.value for w in w_dict['w_mesh']]
+    w_dict['w_mesh'] = [float(w) for w in w_dict['w_mesh']]
 
     temp_sigma_data = {}
-    temp_sigma_data['sigma_re'] = sigma.real.tolist()
-    temp_sigma_data['sigma_im'] = sigma.imag.tolist()
+    temp_sigma_data['sigma_re'] = store.save(sigma.real, session, 'sigma_re')
+    temp_sigma_data['sigma_im'] = store.save(sigma.imag, session, 'sigma_im')
     temp_sigma_data['w_dict'] = w_dict
     temp_sigma_data['dmft_mu'] = 0.0
     temp_sigma_data['n_orb'] = n_orb
@@ -16,16 +16,21 @@ def sigma_analytic_to_data(sigma, w_dict, n_orb):
 
     return temp_sigma_data
 
-def sigma_analytic_to_gf(c_sigma, n_orb, w_dict, soc, lambdas):
+def sigma_analytic(f_sigma, n_orb, w_mesh, lambdas):
+    """
+    Evaluates an analytic sigma(w, *lambdas) on the orbital diagonal for the whole frequency mesh.
+    The function is called once with the array of frequencies, and point by point through np.vectorize
+    only if that fails (e.g. for math functions or branches on w). Returns (n_orb, n_orb, n_w).
+    """
 
-    Sigma_freq = GfReFreq(target_shape=(n_orb, n_orb), mesh=w_dict['w_mesh'])
-    for w in Sigma_freq.mesh:
-        Sigma_freq[:,:][w] = c_sigma(w.value)(*lambdas) * np.eye(n_orb)
+    w_mesh = np.asarray(w_mesh, dtype=float)
+    try:
+        values = np.broadcast_to(np.asarray(f_sigma(w_mesh, *lambdas), dtype=complex), w_mesh.shape)
+    except Exception:
+        values = np.vectorize(lambda w: f_sigma(w, *lambdas), otypes=[complex])(w_mesh)
 
-    sigma_array = np.zeros((n_orb, n_orb, w_dict['n_w']), dtype=complex)
-    for ct1, ct2 in product(range(n_orb), range(n_orb)):
-        if ct1 != ct2 and not soc: continue
-        sigma_array[ct1,ct2] = Sigma_freq.data[:,ct1,ct2].real + 1j * Sigma_freq.data[:,ct1,ct2].imag
+    sigma_array = np.zeros((n_orb, n_orb, len(w_mesh)), dtype=complex)
+    sigma_array[range(n_orb), range(n_orb)] = values
 
     return sigma_array
 
@@ -34,12 +39,13 @@ def reorder_sigma(sigma_data, new_order, old_order):
     This function takes a sigma and rotates into new orbital basis.
     """
 
-    sigma = np.array(sigma_data['sigma_re']) + 1j * np.array(sigma_data['sigma_im'])
+    sigma = store.load_complex(sigma_data['sigma_re'], sigma_data['sigma_im'])
     change_of_basis = tools.change_basis(len(new_order), new_order,  old_order)
     
     sigma = np.einsum('ij, jlk -> ilk', np.linalg.inv(change_of_basis), np.einsum('jki, kl -> jli', sigma, change_of_basis))
-    sigma_data['sigma_re'] = sigma.real.tolist()
-    sigma_data['sigma_im'] = sigma.imag.tolist()
+    session = store.session(sigma_data)
+    sigma_data['sigma_re'] = store.save(sigma.real, session, 'sigma_re')
+    sigma_data['sigma_im'] = store.save(sigma.imag, session, 'sigma_im')
     sigma_data['orbital_order'] = new_order
 
     return sigma_data
@@ -0,0 +1,385 @@
+"""
+Process-pool execution of long computations (A(k,w), k-slices, mu, TB bands), so that they do not
+block the Dash callback thread. Jobs are split into k-chunks; every chunk writes its result into a
+job directory in the cache directory, so that the state of a job can be read from any process. A step
+whose pool process dies, or a job whose submitting process has ended, reports an error.
+Submitting a new job for the same owner cancels the previous one. Finished A(k,w) and k-slice results
+are kept in a disk cache shared by all worker processes, keyed on the content of their inputs.
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import threading
+import traceback
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import tools.array_store as store
+from tools.cache import DiskCache, hash_key, write_stats, cache_dir
+import tools.calc_akw as akw
+import tools.calc_tb as tb
+import tools.pipeline as pipeline
+import tools.viewport as viewport
+
+# apart from the array store, whose eviction would remove the step files of running jobs
+job_dir = os.environ.get('SPECTROMETER_JOB_DIR', os.path.join(cache_dir, 'jobs'))
+# number of pool processes, defaults to the number of cores
+max_workers = int(os.environ.get('SPECTROMETER_WORKERS', os.cpu_count() or 1))
+# job directories older than this (in seconds) are removed
+max_age = 3600
+
+result_caches = {'akw': DiskCache('akw_disk'), 'kslice': DiskCache('kslice_disk')}
+
+_executor = None
+_futures = {}
+_lock = threading.Lock()
+
+def _pool():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=max_workers)
+    return _executor
+
+def _path(job, *names):
+    return os.path.join(job_dir, job, *names)
+
+def _write_json(path, value):
+    tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+    with open(tmp_path, 'w') as fd:
+        json.dump(value, fd)
+    os.replace(tmp_path, path)
+
+def _read_json(path, default=None):
+    try:
+        with open(path) as fd:
+            return json.load(fd)
+    except (FileNotFoundError, ValueError):
+        return default
+
+def k_ranges(n_k, n_chunks=None):
+    """
+    Split n_k k-points into at most n_chunks contiguous (start, stop) ranges
+    """
+
+    n_chunks = 2 * max_workers if n_chunks is None else n_chunks
+    bounds = np.unique(np.linspace(0, n_k, min(n_chunks, n_k) + 1).astype(int))
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+def _new_job(owner, kind, n_steps, info=None):
+    cancel(owner)
+    _cleanup()
+
+    job = uuid.uuid4().hex
+    os.makedirs(_path(job))
+    _write_json(_path(job, 'meta.json'), {'kind': kind, 'owner': owner, 'n_steps': n_steps, 'submitted': time.time(),
+                                          'pid': os.getpid()})
+    _write_json(_path(job, 'info.json'), info or {})
+    os.makedirs(_path('owners'), exist_ok=True)
+    _write_json(_path('owners', owner + '.json'), job)
+    _futures[job] = []
+
+    return job
+
+def _submit(job, func, *args):
+    global _executor
+    try:
+        future = _pool().submit(_run, job, func, *args)
+    except BrokenProcessPool:
+        # a pool process died, e.g. killed for its memory use, and took the pool with it
+        with _lock:
+            _executor = None
+        future = _pool().submit(_run, job, func, *args)
+    future.add_done_callback(lambda future: _check_future(job, future))
+    _futures.setdefault(job, []).append(future)
+    return future
+
+def _check_future(job, future):
+    # a step whose process died never writes its files, the job fails instead of running forever
+    if future.cancelled() or future.exception() is None or os.path.exists(_path(job, 'error')):
+        return
+    try:
+        with open(_path(job, 'error'), 'w') as fd:
+            fd.write(repr(future.exception()))
+    except FileNotFoundError:
+        pass
+
+def _run(job, func, step, *args):
+    """
+    Run one step of a job in a pool process and write its result arrays and info
+    """
+
+    if os.path.exists(_path(job, 'cancelled')):
+        return None
+    try:
+        arrays, info = func(*args)
+        _write_step(job, step, arrays, info)
+    except Exception:
+        with open(_path(job, 'error'), 'w') as fd:
+            fd.write(traceback.format_exc())
+        raise
+    finally:
+        write_stats('pool')
+    return info
+
+def _write_step(job, step, arrays, info):
+    for idx, array in enumerate(arrays):
+        with open(_path(job, 'step-{}-{}.npy'.format(step, idx)), 'wb') as fd:
+            np.save(fd, array)
+    # the info file marks the step as done
+    _write_json(_path(job, 'step-{}.json'.format(step)), info)
+
+def _cached_job(owner, kind, key):
+    """
+    A job that is done right away if the result for key is in the disk cache, else None
+    """
+
+    cached = result_caches[kind].get(key)
+    if cached is None:
+        return None
+    job = _new_job(owner, kind, 1, {'cached': True})
+    array, info = cached
+    _write_step(job, 0, [array], info)
+    return job
+
+def _cleanup():
+    if not os.path.isdir(job_dir):
+        return
+    now = time.time()
+    for job in os.listdir(job_dir):
+        meta = _read_json(_path(job, 'meta.json'))
+        if meta is not None and now - meta['submitted'] > max_age:
+            shutil.rmtree(_path(job), ignore_errors=True)
+            _futures.pop(job, None)
+
+def cancel(owner):
+    """
+    Cancel the current job of owner, if any. Pending chunks are dropped, running ones finish but
+    their results are ignored.
+    """
+
+    job = _read_json(_path('owners', owner + '.json'))
+    if job is None or not os.path.isdir(_path(job)):
+        return
+    open(_path(job, 'cancelled'), 'w').close()
+    for future in _futures.pop(job, []):
+        future.cancel()
+
+def _is_alive(pid):
+    if pid is None:
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def status(job):
+    """
+    State ('running', 'done', 'cancelled', 'error' or 'unknown') and progress of a job
+    """
+
+    meta = _read_json(_path(job, 'meta.json'))
+    if meta is None:
+        return {'state': 'unknown', 'progress': 0.0}
+
+    done = len([name for name in os.listdir(_path(job)) if name.startswith('step-') and name.endswith('.json')])
+    if os.path.exists(_path(job, 'error')):
+        state = 'error'
+    elif os.path.exists(_path(job, 'cancelled')):
+        state = 'cancelled'
+    else:
+        state = 'done' if done == meta['n_steps'] else 'running'
+    if state == 'running' and not _is_alive(meta.get('pid')):
+        # the process owning the pool of the job has ended
+        state = 'error'
+
+    return {'state': state, 'kind': meta['kind'], 'done': done, 'total': meta['n_steps'],
+            'progress': done / meta['n_steps'], 'time': time.time() - meta['submitted']}
+
+def result(job):
+    """
+    Result arrays of a finished job, concatenated along the chunks and reshaped to info['shape'] if
+    given, and the merged info of the job and all its steps, with the pipeline stages recomputed by
+    the steps in info['recomputed']
+    """
+
+    meta = _read_json(_path(job, 'meta.json'))
+    info = _read_json(_path(job, 'info.json'), {})
+    arrays = {}
+    recomputed = []
+    for step in range(meta['n_steps']):
+        step_info = _read_json(_path(job, 'step-{}.json'.format(step)), {})
+        recomputed += step_info.pop('recomputed', [])
+        info.update(step_info)
+        idx = 0
+        while os.path.exists(_path(job, 'step-{}-{}.npy'.format(step, idx))):
+            arrays.setdefault(idx, []).append(np.load(_path(job, 'step-{}-{}.npy'.format(step, idx))))
+            idx += 1
+
+    arrays = [np.concatenate(arrays[idx]) for idx in sorted(arrays)]
+    if 'shape' in info:
+        arrays[0] = arrays[0].reshape(info['shape'])
+
+    key = info.pop('cache_key', None)
+    if key is not None and not info.get('cached', False):
+        result_caches[meta['kind']].put(key, (arrays[0], info))
+    # pipeline stages recomputed by any of the steps
+    info['recomputed'] = list(dict.fromkeys(recomputed))
+
+    return arrays, info
+
+# job steps, run in the pool processes
+
+def _alatt_mu_step(tb_data, sigma_data, akw_data):
+    mu, recomputed = pipeline.run('mu', tb_data, sigma_data, pipeline.inputs(tb_data, sigma_data, akw_data))
+    return [], {'dmft_mu': mu, 'recomputed': recomputed}
+
+def _alatt_step(tb_data, sigma_data, akw_data, k_range, solve, band_basis):
+    inputs = pipeline.inputs(tb_data, sigma_data, akw_data, band_basis, k_range)
+    if solve:
+        alatt_k_w, recomputed = pipeline.run('qp', tb_data, sigma_data, inputs)
+        return [alatt_k_w], {'akw_path': 'solve', 'recomputed': recomputed}
+
+    stage, path = pipeline.akw_stage(sigma_data)
+    result, recomputed = pipeline.run(stage, tb_data, sigma_data, inputs)
+    if path is None:
+        result, path = result
+    return [result], {'akw_path': path, 'recomputed': recomputed}
+
+def _kslice_step(tb_data, sigma_data, akw_data, mu, k_range):
+    alatt_k_w, path = akw.kslice_chunk(tb_data, sigma_data, akw_data, mu, k_range)
+    return [alatt_k_w], {'akw_path': path}
+
+def _kslice_solve_step(tb_data, sigma_data, akw_data, band_basis):
+    alatt_k_w, _ = akw.calc_kslice(tb_data, sigma_data, akw_data, True, band_basis)
+    return [alatt_k_w], {}
+
+def _tile_step(tb_data, sigma_data, akw_data, level, index):
+    # A(k,w) of the viewport tile index = (i_k, i_w) at level = (l_k, l_w), with the mu of the last calc_alatt
+    full = viewport.extent(tb_data, sigma_data)
+    k_disc = viewport.axis_points(full[0], level[0], index[0])
+    w_tile = viewport.axis_points(full[1], level[1], index[1])
+
+    # H(k) - dft_mu as tb_data['e_mat'], which only keeps the real part
+    add_local = [0.] * tb_data['n_wf']
+    e_mat = tb.calc_tb_kpoints(tb_data, tb_data['add_spin'], float(tb_data['dft_mu']), add_local,
+                               tb.path_k_points(tb_data['k_mesh'], k_disc)).real
+
+    sigma = store.load_complex(sigma_data['sigma_re'], sigma_data['sigma_im']).transpose(2,0,1)
+    sigma_tile = akw.resample_sigma(sigma_data['w_dict']['w_mesh'], sigma, w_tile)
+    mu = float(tb_data['dft_mu']) - float(akw_data['dmft_mu'])
+
+    alatt_k_w, _ = akw.spectral_function(e_mat.transpose(2,0,1), sigma_tile, w_tile, float(akw_data['eta']), mu)
+    return [alatt_k_w[None]], {}
+
+def _mu_step(tb_data, n_elect, add_spin, add_local, mu_guess):
+    mu, info = akw.calc_mu_adaptive(tb_data, n_elect, add_spin, add_local, mu_guess=mu_guess)
+    return [], {'mu': mu, 'mu_info': info}
+
+def _tb_bands_step(e_mat, n_orb, k_range):
+    e_val, e_vec = tb.get_tb_bands(akw._k_block(store.load(e_mat), n_orb, k_range).transpose(1,2,0))
+    return [e_val.T, e_vec.transpose(2,0,1)], {}
+
+# job submission
+
+def submit_akw(owner, tb_data, sigma_data, akw_data, solve=False, band_basis=False, n_chunks=None):
+    """
+    A(k,w) as calc_alatt: mu is solved first, then the k-chunks are evaluated in parallel. Both go
+    through the stages of tools.pipeline, so that only the stages invalidated since the last job of
+    the same inputs are recomputed.
+    """
+
+    key = hash_key('akw', store.content_id([tb_data['e_mat'], sigma_data['sigma_re'], sigma_data['sigma_im']]),
+                   store.content_id([tb_data['evecs_re'], tb_data['evecs_im']]) if band_basis else None,
+                   sigma_data['w_dict'], tb_data['dft_mu'], tb_data['n_elect'], tb_data['add_spin'],
+                   store.content_id(tb_data['hopping']), tb_data['units'], akw_data['eta'], akw_data['dmft_mu'],
+                   bool(solve), bool(band_basis))
+    job = _cached_job(owner, 'akw', key)
+    if job is not None:
+        return job
+
+    n_k = store.load(tb_data['e_mat']).shape[2]
+    ranges = k_ranges(n_k, n_chunks)
+    job = _new_job(owner, 'akw', len(ranges) + 1, {'cache_key': key})
+
+    def submit_chunks(future):
+        # the chunks take mu from the pipeline cache, so they are only submitted once it is there
+        if future.cancelled() or future.exception() is not None or future.result() is None:
+            return
+        for step, k_range in enumerate(ranges):
+            _submit(job, _alatt_step, step + 1, tb_data, sigma_data, akw_data, k_range, solve, band_basis)
+
+    _submit(job, _alatt_mu_step, 0, tb_data, sigma_data, akw_data).add_done_callback(submit_chunks)
+
+    return job
+
+def submit_kslice(owner, tb_data, sigma_data, akw_data, solve=False, band_basis=False, n_chunks=None):
+    """
+    A(k,0) of a k-slice or a stack of slices as calc_kslice, split into k-chunks. The QP crossing
+    search runs as a single step.
+    """
+
+    key = hash_key('kslice', store.content_id([tb_data['e_mat'], sigma_data['sigma_re'], sigma_data['sigma_im']]),
+                   sigma_data['w_dict'], tb_data['dft_mu'], akw_data['eta'], akw_data['dmft_mu'], bool(solve))
+    job = _cached_job(owner, 'kslice', key)
+    if job is not None:
+        return job
+
+    k_shape = store.load(tb_data['e_mat']).shape[2:]
+    info = {'dmft_mu': float(akw_data['dmft_mu']), 'cache_key': key}
+    if solve:
+        job = _new_job(owner, 'kslice', 1, info)
+        _submit(job, _kslice_solve_step, 0, tb_data, sigma_data, akw_data, band_basis)
+        return job
+
+    ranges = k_ranges(int(np.prod(k_shape)), n_chunks)
+    info['shape'] = list(k_shape)
+    job = _new_job(owner, 'kslice', len(ranges), info)
+    mu = float(tb_data['dft_mu']) - float(akw_data['dmft_mu'])
+    for step, k_range in enumerate(ranges):
+        _submit(job, _kslice_step, step, tb_data, sigma_data, akw_data, mu, k_range)
+
+    return job
+
+def submit_tiles(owner, tb_data, sigma_data, akw_data, level, indices):
+    """
+    A(k,w) tiles (n, tile_px, tile_px) with indices (i_k, i_w) at level of the zoomed A(k,w) figure, one
+    step per tile. The indices and the level are returned in the info.
+    """
+
+    indices = [list(index) for index in indices]
+    job = _new_job(owner, 'tiles', len(indices), {'level': list(level), 'indices': indices})
+    for step, index in enumerate(indices):
+        _submit(job, _tile_step, step, tb_data, sigma_data, akw_data, list(level), index)
+
+    return job
+
+def submit_mu(owner, tb_data, n_elect, add_spin, add_local, mu_guess=0.0):
+    """
+    Non-interacting chemical potential as calc_mu_adaptive
+    """
+
+    job = _new_job(owner, 'mu', 1)
+    _submit(job, _mu_step, 0, tb_data, n_elect, add_spin, list(add_local), mu_guess)
+
+    return job
+
+def submit_tb_bands(owner, e_mat, n_orb, n_chunks=None):
+    """
+    Band eigenvalues (n_k, n_orb) and eigenvectors (n_k, n_orb, n_orb) of H(k) stored as e_mat, split into k-chunks
+    """
+
+    n_k = int(np.prod(store.load(e_mat).shape[2:]))
+    ranges = k_ranges(n_k, n_chunks)
+    job = _new_job(owner, 'tb', len(ranges))
+    for step, k_range in enumerate(ranges):
+        _submit(job, _tb_bands_step, step, e_mat, n_orb, k_range)
+
+    return job
@@ -0,0 +1,161 @@
+"""
+Dependency-aware evaluation of A(k,w) along the k-path,
+
+    TBLattice -> H(k) -> eigen-data -> mu -> A(k,w)
+
+Every stage lists the inputs and upstream stages it depends on. Its key is a content hash of those
+inputs and of the keys of its upstream stages, and its result is cached under that key, so that a
+change of inputs only recomputes the stages downstream of it. The eigen-data are the poles of G(k,w),
+i.e. the eigenvalues of H(k) + sigma(w), which do not depend on eta or mu: a new eta, DFT mu or
+interacting mu only re-broadens them (see calc_akw.alatt_poles). They are used for A(k,w) when they
+have a closed form, else A(k,w) is evaluated from H(k) by calc_akw.spectral_function (see akw_stage).
+"""
+
+import numpy as np
+
+import tools.array_store as store
+import tools.calc_akw as akw
+from tools.cache import LRUCache, DiskCache, hash_key
+
+# BZ grid of the interacting mu, as calc_akw.calc_mu
+n_k_mu = 10
+
+class Stage(object):
+    """
+    A stage computing func(tb_data, sigma_data, inputs, *results of deps). Results are cached in memory
+    and, with disk, also in a disk cache shared by all worker processes.
+    """
+
+    def __init__(self, name, func, inputs=(), deps=(), disk=False, max_bytes=2**27):
+        self.name = name
+        self.func = func
+        self.inputs = inputs
+        self.deps = deps
+        self.cache = LRUCache('pipeline_' + name, max_bytes=max_bytes)
+        self.disk_cache = DiskCache('pipeline_{}_disk'.format(name)) if disk else None
+
+    def get(self, key):
+        result = self.cache.get(key)
+        if result is None and self.disk_cache is not None:
+            result = self.disk_cache.get(key)
+            if result is not None:
+                self.cache.put(key, result)
+        return result
+
+    def put(self, key, result):
+        if self.disk_cache is not None:
+            self.disk_cache.put(key, result)
+        return self.cache.put(key, result)
+
+def _w_mesh(sigma_data):
+    return np.asarray(sigma_data['w_dict']['w_mesh'], dtype=float)
+
+def _sigma(sigma_data):
+    return store.load_complex(sigma_data['sigma_re'], sigma_data['sigma_im']).transpose(2,0,1)
+
+def _lattice(tb_data, sigma_data, inputs):
+    # TBLattice, H(k) and its eigenvalues on the BZ grid
+    return akw.bz_grid(tb_data, inputs['add_spin'], [0.] * tb_data['n_wf'], n_k_mu)
+
+def _bz_eigen(tb_data, sigma_data, inputs, lattice):
+    # the density only takes the real part of sigma on the occupied part of the mesh, as calc_akw.sumk
+    hopping_k, _, eps_k = lattice
+    occupied = _w_mesh(sigma_data) <= 0
+    return akw.resolvent_poles(hopping_k, _sigma(sigma_data)[occupied].real, eps_k=eps_k)
+
+def _mu(tb_data, sigma_data, inputs, lattice, bz_poles):
+    _, bz_weights, _ = lattice
+    w_mesh = _w_mesh(sigma_data)
+
+    # 2 times for spin degeneracy
+    sp_factor = 1 if inputs['add_spin'] else 2
+    dens = akw.density_poles(bz_poles, bz_weights, w_mesh[w_mesh <= 0], inputs['eta'])
+    mu = akw.find_mu(lambda mu: sp_factor * dens(mu), inputs['n_elect'], inputs['mu_guess'])
+    print('chemical potential: {:.4f}, density: {:.4f}'.format(mu, sp_factor * dens(mu)))
+
+    return float(mu)
+
+def _hk(tb_data, sigma_data, inputs):
+    # e_mat holds the real part of H(k) in the orbital basis, or its eigenvalues with the eigenvectors
+    # in evecs_re/im in the band basis, which keeps the imaginary part of complex hoppings
+    n_orb = tb_data['n_wf']
+    e_k = akw._k_block(store.load(tb_data['e_mat']), n_orb, inputs['k_range'])
+    if inputs['band_basis']:
+        e_vecs = akw._k_block(store.load(tb_data['evecs_re']), n_orb, inputs['k_range']) + 1j * akw._k_block(store.load(tb_data['evecs_im']), n_orb, inputs['k_range'])
+        e_k = np.einsum('kij,kj,klj->kil', e_vecs, np.diagonal(e_k, axis1=1, axis2=2), e_vecs.conjugate())
+
+    # e_mat contains -dft_mu, which is applied as a shift of the poles instead
+    return e_k + inputs['dft_mu'] * np.eye(n_orb)
+
+def _eigen(tb_data, sigma_data, inputs, e_k):
+    return akw.resolvent_poles(e_k, _sigma(sigma_data))
+
+def _akw(tb_data, sigma_data, inputs, poles, mu):
+    # calc_alatt evaluates e_mat = H(k) - dft_mu at mu = dft_mu - mu
+    return akw.alatt_poles(poles, _w_mesh(sigma_data), inputs['eta'], 2 * inputs['dft_mu'] - mu)
+
+def _akw_inverse(tb_data, sigma_data, inputs, e_k, mu):
+    return akw.spectral_function(e_k, _sigma(sigma_data), _w_mesh(sigma_data), inputs['eta'], 2 * inputs['dft_mu'] - mu)
+
+def _qp(tb_data, sigma_data, inputs, e_k, mu):
+    return akw.qp_dispersion(e_k, _sigma(sigma_data), _w_mesh(sigma_data), 2 * inputs['dft_mu'] - mu)
+
+stages = {stage.name: stage for stage in [
+    Stage('lattice', _lattice, ('hopping', 'units', 'n_wf', 'add_spin')),
+    Stage('bz_eigen', _bz_eigen, ('sigma', 'w_dict'), ('lattice',), disk=True),
+    Stage('mu', _mu, ('n_elect', 'eta'), ('lattice', 'bz_eigen'), disk=True),
+    Stage('hk', _hk, ('hopping', 'units', 'n_wf', 'add_spin', 'k_mesh', 'band_basis', 'k_range')),
+    Stage('eigen', _eigen, ('sigma', 'w_dict'), ('hk',), disk=True, max_bytes=2**28),
+    Stage('akw', _akw, ('eta', 'dft_mu'), ('eigen', 'mu')),
+    Stage('akw_inverse', _akw_inverse, ('sigma', 'w_dict', 'eta', 'dft_mu'), ('hk', 'mu')),
+    Stage('qp', _qp, ('sigma', 'w_dict', 'dft_mu'), ('hk', 'mu')),
+]}
+
+def akw_stage(sigma_data):
+    """
+    Stage evaluating A(k,w) and the name of its path: the re-broadened poles if they have a closed form,
+    i.e. for a scalar sigma (see calc_akw.resolvent_poles), else calc_akw.spectral_function, which picks
+    the cheapest of its paths and is cheaper than the eigenvalues of H(k) + sigma(w) for a full sigma
+    """
+
+    if akw.sigma_structure(_sigma(sigma_data)) == 'scalar':
+        return 'akw', 'eigen'
+    return 'akw_inverse', None
+
+def inputs(tb_data, sigma_data, akw_data, band_basis=False, k_range=None):
+    """
+    Inputs of all stages for the k-points k_range of the k-path. Arrays enter by their content id.
+    The starting point mu_guess of the mu search is not part of any key.
+    """
+
+    return {'hopping': store.content_id(tb_data['hopping']), 'units': tb_data['units'], 'n_wf': tb_data['n_wf'],
+            'add_spin': bool(tb_data['add_spin']), 'n_elect': float(tb_data['n_elect']), 'k_mesh': tb_data['k_mesh'],
+            'band_basis': bool(band_basis), 'k_range': None if k_range is None else list(k_range),
+            'sigma': store.content_id([sigma_data['sigma_re'], sigma_data['sigma_im']]), 'w_dict': sigma_data['w_dict'],
+            'eta': float(akw_data['eta']), 'dft_mu': float(tb_data['dft_mu']), 'mu_guess': float(akw_data['dmft_mu'])}
+
+def key(name, inputs):
+    """
+    Key of stage name, a hash of its inputs and of the keys of its upstream stages
+    """
+
+    stage = stages[name]
+    return hash_key(name, [inputs[item] for item in stage.inputs], [key(dep, inputs) for dep in stage.deps])
+
+def run(name, tb_data, sigma_data, inputs, recomputed=None):
+    """
+    Result of stage name. Upstream stages are only evaluated if the result is not cached, and only
+    those that are not cached themselves. Returns the result and the names of the recomputed stages
+    in the order of evaluation.
+    """
+
+    recomputed = [] if recomputed is None else recomputed
+    stage = stages[name]
+    stage_key = key(name, inputs)
+    result = stage.get(stage_key)
+    if result is None:
+        deps = [run(dep, tb_data, sigma_data, inputs, recomputed)[0] for dep in stage.deps]
+        result = stage.put(stage_key, stage.func(tb_data, sigma_data, inputs, *deps))
+        recomputed.append(name)
+
+    return result, recomputed
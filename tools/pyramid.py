@@ -0,0 +1,113 @@
+"""
+Multi-resolution tile pyramids of 2D maps such as A(k,w) and A(k,0), kept in the array store. Level
+(i, j) is the map with its rows pooled i times and its columns pooled j times, by max or mean pooling
+over pairs, down to at most tile rows and columns. Levels are stored as float16 and memory-mapped on
+access, so that a figure only reads the part of the level that matches its zoom on each axis, and the
+data sent to the browser is bounded by the pixel size of the figure instead of the computed
+resolution, also for maps such as A(k,w) with many more frequencies than k-points.
+"""
+
+import numpy as np
+
+import tools.array_store as store
+
+# rows and columns of the coarsest levels
+tile = 256
+# approximate size of a map figure in pixels, rows and columns
+figure_px = (600, 600)
+f16_max = float(np.finfo(np.float16).max)
+
+def _pool(array, axis, pooling):
+    # pairs along axis, an odd axis is padded with its last entry
+    array = np.moveaxis(array, axis, -1)
+    array = np.pad(array, [(0, 0)] * (array.ndim - 1) + [(0, array.shape[-1] % 2)], mode='edge')
+    pairs = array.reshape(*array.shape[:-1], array.shape[-1] // 2, 2)
+    return np.moveaxis(pairs.max(axis=-1) if pooling == 'max' else pairs.mean(axis=-1), -1, axis)
+
+def build(array, session, name, pooling='max'):
+    """
+    Pyramid of a map (..., n_rows, n_cols), pooled over the last two axes with 'max' (keeps sharp
+    features such as QP peaks) or 'mean' (keeps the integrated weight). Returns a handle with the
+    store handles of all levels, levels[i][j], and the range of the values.
+    """
+
+    array = np.asarray(array, dtype=float)
+    finite = np.isfinite(array)
+    handle = {'pyramid': True, 'shape': list(array.shape), 'pooling': pooling, 'tile': tile,
+              'min': float(np.min(array[finite])), 'max': float(np.max(array[finite])), 'levels': []}
+
+    rows = array
+    while True:
+        level, col_levels = rows, []
+        while True:
+            col_levels.append(store.save(np.clip(level, -f16_max, f16_max).astype(np.float16), session,
+                                         '{}-{}-{}'.format(name, len(handle['levels']), len(col_levels))))
+            if level.shape[-1] <= tile:
+                break
+            level = _pool(level, -1, pooling)
+        handle['levels'].append(col_levels)
+        if rows.shape[-2] <= tile:
+            break
+        rows = _pool(rows, -2, pooling)
+
+    return handle
+
+def _bounds(bounds, scale, size):
+    # first and last sample of a level with scale x pooling covering the fractional full-resolution indices bounds
+    first = int(np.clip(np.floor(bounds[0] / scale), 0, size - 1))
+    return first, int(np.clip(np.ceil(bounds[1] / scale), first, size - 1))
+
+def select_level(pyramid, ranges, n_px):
+    """
+    Level (i, j) with the least pooling on each axis that still reads at most n_px = (n_rows, n_cols)
+    samples across ranges = ((row_0, row_1), (col_0, col_1)) of the full-resolution map, or the
+    coarsest level of an axis with n_px below tile
+    """
+
+    n_levels = (len(pyramid['levels']), len(pyramid['levels'][0]))
+    level = []
+    for bounds, size, n, n_level in zip(ranges, pyramid['shape'][-2:], n_px, n_levels):
+        for idx in range(n_level):
+            first, last = _bounds(bounds, 2**idx, -(-size // 2**idx))
+            if last - first + 1 <= n:
+                break
+        level.append(idx)
+    return tuple(level)
+
+def fetch(pyramid, ranges, n_px=figure_px, select=()):
+    """
+    The part of the level matching n_px pixels across ranges = ((row_0, row_1), (col_0, col_1)), given as
+    (fractional) indices of the full-resolution map. Leading axes are indexed by select first.
+    Returns the level (i, j), the rows and columns as fractional full-resolution indices of their centers
+    and the values (n_rows, n_cols) as float.
+    """
+
+    ranges = [sorted(bounds) for bounds in ranges]
+    level = select_level(pyramid, ranges, n_px)
+    array = store.load(pyramid['levels'][level[0]][level[1]])[select]
+
+    index = []
+    centers = []
+    for bounds, idx, size, full_size in zip(ranges, level, array.shape[-2:], pyramid['shape'][-2:]):
+        first, last = _bounds(bounds, 2**idx, size)
+        index.append(np.arange(first, last + 1))
+        # center of a block of 2**idx samples, at most the last sample
+        centers.append(np.minimum(index[-1] * 2**idx + (2**idx - 1) / 2, full_size - 1))
+    rows, cols = index
+
+    values = np.asarray(array[..., rows[0]:rows[-1]+1, cols[0]:cols[-1]+1], dtype=float)
+    return level, centers[0], centers[1], values
+
+def axis_values(values, index):
+    """
+    Coordinates of the fractional indices index on an axis with coordinates values
+    """
+
+    return np.interp(index, np.arange(len(values)), values)
+
+def axis_index(values, coords):
+    """
+    Fractional indices of the coordinates coords on an axis with (increasing) coordinates values
+    """
+
+    return np.interp(coords, values, np.arange(len(values)))
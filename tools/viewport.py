@@ -0,0 +1,166 @@
+"""
+Viewport-driven evaluation of A(k,w) along the k-path. The (k, w) plane is divided into tiles on a
+quadtree of zoom levels: at level l an axis is split into 2**l intervals, and every tile is evaluated
+on tile_px x tile_px points from H(k) at the k-points of the tile and Sigma interpolated onto its
+frequencies. A viewport is covered by the tiles of the level closest to the pixel resolution of the
+figure, reached from coarser levels by progressive refinement. Missing tiles are evaluated in the
+process pool (see jobs.submit_tiles), and all tiles of a level are cached as one entry apart from the
+full A(k,w) overview, so that panning back or zooming out again does not recompute them.
+"""
+
+import numpy as np
+
+import tools.array_store as store
+from tools.cache import LRUCache, DiskCache, hash_key
+
+# k- and w-points per tile and axis
+tile_px = 128
+max_level = 12
+# approximate size (k, w) of the A(k,w) figure in pixels
+figure_px = (600, 750)
+# number of levels below the target level at which the refinement starts
+n_coarse = 2
+
+# one entry (indices (n, 2), tiles (n, tile_px, tile_px)) per data key and level
+tile_cache = LRUCache('akw_tiles', max_bytes=2**28)
+tile_disk_cache = DiskCache('akw_tiles_disk')
+
+def extent(tb_data, sigma_data):
+    """
+    Full range of the k-path and of the w mesh, [[k_min, k_max], [w_min, w_max]]
+    """
+
+    k_disc, w_mesh = tb_data['k_mesh']['k_disc'], sigma_data['w_dict']['w_mesh']
+    return [[float(k_disc[0]), float(k_disc[-1])], [float(w_mesh[0]), float(w_mesh[-1])]]
+
+def target_level(view, full, n_px):
+    """
+    Level at which the tiles covering the range view of an axis with range full come closest to n_px
+    points across the view
+    """
+
+    ratio = n_px * (full[1] - full[0]) / (tile_px * max(view[1] - view[0], 1e-12))
+    return int(np.clip(np.rint(np.log2(max(ratio, 1.0))), 0, max_level))
+
+def path_key(tb_data):
+    """
+    Hash of the k-path of tb_data, a view is reset to the full range only if it changes
+    """
+
+    return hash_key(tb_data.get('k_mesh'))
+
+def full_view(tb_data):
+    return {'path': path_key(tb_data)}
+
+def make_view(k_range, w_range, tb_data, sigma_data):
+    """
+    View of the ranges k_range and w_range (None for the full range) of the k-path 'path', with tiles
+    starting n_coarse levels below the target level of each axis. The view has no tiles ('target' and
+    'level') if the overview already resolves the figure on both axes. 'shown' is the finest level
+    whose tiles are all cached, and 'job' the job evaluating the missing tiles of 'level'.
+    """
+
+    full = extent(tb_data, sigma_data)
+    ranges = [full[0] if k_range is None else sorted(k_range), full[1] if w_range is None else sorted(w_range)]
+    target = [target_level(view, axis, n_px) for view, axis, n_px in zip(ranges, full, figure_px)]
+
+    # points of the overview on each axis
+    n_overview = (len(tb_data['k_mesh']['k_disc']), len(sigma_data['w_dict']['w_mesh']))
+    if all(2**level * tile_px <= n for level, n in zip(target, n_overview)):
+        return {'path': path_key(tb_data), 'k': ranges[0], 'w': ranges[1]}
+
+    return {'path': path_key(tb_data), 'k': ranges[0], 'w': ranges[1], 'target': target,
+            'level': [max(level - n_coarse, 0) for level in target]}
+
+def refine(view):
+    """
+    The view one level finer on each axis that has not reached its target level
+    """
+
+    view = dict(view)
+    view['level'] = [min(level + 1, target) for level, target in zip(view['level'], view['target'])]
+    return view
+
+def is_refined(view):
+    return 'job' not in view and ('target' not in view or view['level'] == view['target'])
+
+def axis_points(full, level, index):
+    """
+    tile_px points at the centers of the pixels of the tile index on an axis with range full at level
+    """
+
+    width = (full[1] - full[0]) / 2**level
+    return full[0] + (index + (np.arange(tile_px) + 0.5) / tile_px) * width
+
+def _tile_indices(view, full, level):
+    width = (full[1] - full[0]) / 2**level
+    first = int(np.clip(np.floor((view[0] - full[0]) / width), 0, 2**level - 1))
+    last = int(np.clip(np.ceil((view[1] - full[0]) / width) - 1, first, 2**level - 1))
+    return range(first, last + 1)
+
+def data_key(tb_data, sigma_data, akw_data):
+    # everything the tiles depend on
+    return hash_key(store.content_id(tb_data['hopping']), tb_data['units'], tb_data['n_wf'], bool(tb_data['add_spin']),
+                    tb_data['k_mesh'], float(tb_data['dft_mu']), store.content_id([sigma_data['sigma_re'], sigma_data['sigma_im']]),
+                    sigma_data['w_dict'], float(akw_data['eta']), float(akw_data['dmft_mu']))
+
+def _view_tiles(tb_data, sigma_data, view, level):
+    full = extent(tb_data, sigma_data)
+    return _tile_indices(view['k'], full[0], level[0]), _tile_indices(view['w'], full[1], level[1])
+
+def _load_level(key):
+    entry = tile_cache.get(key)
+    if entry is None:
+        entry = tile_disk_cache.get(key)
+        if entry is None:
+            return {}
+        tile_cache.put(key, entry)
+    indices, tiles = entry
+    return {tuple(int(i) for i in index): tile for index, tile in zip(indices, tiles)}
+
+def missing_tiles(tb_data, sigma_data, akw_data, view):
+    """
+    Indices (i_k, i_w) of the tiles at view['level'] covering the view that are not cached
+    """
+
+    level = tuple(view['level'])
+    cached = _load_level(hash_key(data_key(tb_data, sigma_data, akw_data), level))
+    k_tiles, w_tiles = _view_tiles(tb_data, sigma_data, view, level)
+    return [(i_k, i_w) for i_k in k_tiles for i_w in w_tiles if (i_k, i_w) not in cached]
+
+def store_tiles(tiles_key, level, indices, tiles):
+    """
+    Add the tiles (n, tile_px, tile_px) with indices (n, 2) at level, evaluated for the data key
+    tiles_key, to the cached entry of the level. The entry is replaced as a whole, tiles added
+    concurrently by another process may be dropped and are evaluated again when needed.
+    """
+
+    key = hash_key(tiles_key, tuple(level))
+    cached = _load_level(key)
+    cached.update({tuple(int(i) for i in index): tile for index, tile in zip(indices, tiles)})
+    entry = (np.array(list(cached.keys()), dtype=int), np.array(list(cached.values())))
+
+    tile_disk_cache.remove(key)
+    tile_cache.put(key, tile_disk_cache.put(key, entry))
+
+def render(tb_data, sigma_data, akw_data, view):
+    """
+    A(k,w) on the cached tiles at view['shown'] covering the ranges of the view. Returns the k-points,
+    the frequencies and A(k,w) (n_k, n_w), or None if a tile is not cached.
+    """
+
+    full = extent(tb_data, sigma_data)
+    level = tuple(view['shown'])
+    cached = _load_level(hash_key(data_key(tb_data, sigma_data, akw_data), level))
+    k_tiles, w_tiles = _view_tiles(tb_data, sigma_data, view, level)
+    if any((i_k, i_w) not in cached for i_k in k_tiles for i_w in w_tiles):
+        return None
+
+    alatt_k_w = np.zeros((len(k_tiles) * tile_px, len(w_tiles) * tile_px))
+    for ik, i_k in enumerate(k_tiles):
+        for iw, i_w in enumerate(w_tiles):
+            alatt_k_w[ik*tile_px:(ik+1)*tile_px, iw*tile_px:(iw+1)*tile_px] = cached[(i_k, i_w)]
+
+    k_disc = np.concatenate([axis_points(full[0], level[0], i_k) for i_k in k_tiles])
+    w_mesh = np.concatenate([axis_points(full[1], level[1], i_w) for i_w in w_tiles])
+    return k_disc, w_mesh, alatt_k_w
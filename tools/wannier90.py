@@ -23,7 +23,6 @@
 
 import numpy as np
 from io import StringIO
-from collections import OrderedDict
 
 # ----------------------------------------------------------------------
 
@@ -36,7 +35,39 @@ class Units(object):
 units = Units()
 
 # ----------------------------------------------------------------------
-def parse_hopping_from_wannier90_hr(file):
+def _hopping_from_table(hopp, deg, num_wann, dense=False):
+
+    r""" Group the ``(num_wann**2 * nrpts, 7)`` table of a ``*_hr.dat`` file by R
+    and divide by the degeneracy of the Wigner-Seitz points. """
+
+    R = np.array(hopp[:, :3], dtype=int) # Lattice coordinates in multiples of lattice vectors
+    nm = np.array(hopp[:, 3:5], dtype=int) - 1 # orbital index pairs, wannier90 counts from 1, fix by remove 1
+    t = hopp[:, 5] + 1.j * hopp[:, 6] # complex hopping amplitudes for each R, mn (H(R)_{mn})
+
+    # -- R vectors in order of first appearance, which is the order of the degeneracies
+
+    R_unique, first, inverse = np.unique(R, axis=0, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    R_vecs = R_unique[order]
+
+    assert( len(R_vecs) == len(deg) )
+
+    H_R = np.zeros((len(R_vecs), num_wann, num_wann), dtype=complex)
+    H_R[rank[inverse.ravel()], nm[:, 0], nm[:, 1]] = t
+
+    # -- Account for degeneracy of the Wigner-Seitz points
+
+    H_R /= np.asarray(deg)[:, None, None]
+
+    if dense:
+        return R_vecs, H_R
+
+    return {tuple(r): H for r, H in zip(R_vecs.tolist(), H_R)}
+
+# ----------------------------------------------------------------------
+def parse_hopping_from_wannier90_hr(file, dense=False):
 
     r""" Wannier90 real space hopping parser of ``*_hr.dat`` files.
 
@@ -47,8 +78,11 @@ def parse_hopping_from_wannier90_hr(file):
     Parameters
     ----------
 
-    filename : str
-        Wannier90 ``*_hr.dat`` file to parse.
+    file : str
+        Content of a Wannier90 ``*_hr.dat`` file.
+    dense : bool
+        Return the hoppings as a tuple of the ``(nrpts, 3)`` R vectors and the
+        ``(nrpts, num_wann, num_wann)`` stacked hopping matrices instead of a dict.
 
     Returns
     -------
@@ -67,53 +101,60 @@ def parse_hopping_from_wannier90_hr(file):
     num_wann = int(lines.pop(0))
     nrpts = int(lines.pop(0))
 
-    # print( 'num_wann =', num_wann)
-    # print( 'nrpts =', nrpts)
-
     nlines = int(np.ceil(float(nrpts / 15.)))
 
-    deg = np.array([])
-    for line in lines[:nlines]:
-        deg = np.concatenate((deg, np.loadtxt(StringIO(line), dtype=np.int, ndmin=1)))
-    
+    deg = np.array(" ".join(lines[:nlines]).split(), dtype=int)
     assert( deg.shape == (nrpts,) )
 
-    hopp = "\n".join(lines[nlines:])
-    hopp = np.loadtxt(StringIO(hopp))
+    # -- read the whole body in one pass
+
+    hopp = np.array(" ".join(lines[nlines:]).split(), dtype=float).reshape(-1, 7)
     assert( hopp.shape == (num_wann**2 * nrpts, 7) )
-    
-    R = np.array(hopp[:, :3], dtype=np.int) # Lattice coordinates in multiples of lattice vectors
-    nm = np.array(hopp[:, 3:5], dtype=np.int) - 1 # orbital index pairs, wannier90 counts from 1, fix by remove 1
 
-    t_re = hopp[:, 5]
-    t_im = hopp[:, 6]
-    t = t_re + 1.j * t_im # complex hopping amplitudes for each R, mn (H(R)_{mn})
+    return _hopping_from_table(hopp, deg, num_wann, dense), num_wann
+        
+# ----------------------------------------------------------------------
+def parse_hopping_from_wannier90_hr_file(filename, dense=False):
+
+    r""" Wannier90 real space hopping parser of ``*_hr.dat`` files on disk.
 
-    # -- Dict with hopping matrices
+    Same as ``parse_hopping_from_wannier90_hr``, but the file is read line by
+    line instead of holding its full content as a string.
 
-    r_dict = OrderedDict()
-    hopp_dict = {}
-    for idx in range(R.shape[0]):
-        r = tuple(R[idx])
+    Parameters
+    ----------
 
-        if r not in r_dict:
-            r_dict[r] = 1
-        else:
-            r_dict[r] += 1
+    filename : str
+        Wannier90 ``*_hr.dat`` file to parse.
+    dense : bool
+        Return the R vectors and stacked hopping matrices instead of a dict.
 
-        if r not in hopp_dict:
-            hopp_dict[r] = np.zeros((num_wann, num_wann), dtype=np.complex)
+    Returns
+    -------
 
-        n, m = nm[idx]
-        hopp_dict[r][n, m] = t[idx]
+    hopp_dict : dict
+        Dictionary of real space hoppings.
+    num_wann : int
+        Total number of Wannier functions per unit-cell.
 
-    # -- Account for degeneracy of the Wigner-Seitz points
-    
-    for r, weight in zip(list(r_dict.keys()), deg):
-        hopp_dict[r] /= weight
+    """
+
+    with open(filename, 'r') as fd:
+        fd.readline() # pop time header
+
+        num_wann = int(fd.readline())
+        nrpts = int(fd.readline())
+
+        deg = []
+        while len(deg) < nrpts:
+            deg += [int(x) for x in fd.readline().split()]
+        deg = np.array(deg)
+
+        hopp = np.loadtxt(fd, ndmin=2)
+        assert( hopp.shape == (num_wann**2 * nrpts, 7) )
+
+    return _hopping_from_table(hopp, deg, num_wann, dense), num_wann
 
-    return hopp_dict, num_wann
-        
 # ----------------------------------------------------------------------
 def parse_lattice_vectors_from_wannier90_wout(file):
 